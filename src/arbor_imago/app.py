@@ -1,13 +1,16 @@
-from arbor_imago.core import config, LOGGER
-from arbor_imago.routers import user, auth, user_access_token, api_key_scope, gallery, api_key, pages
+from arbor_imago import core
+from arbor_imago.core import config, metrics as metrics_core, LOGGER
+from arbor_imago.routers import user, auth, user_access_token, api_key_scope, gallery, api_key, pages, metrics
 from arbor_imago.auth import utils as auth_utils
+from arbor_imago.services import purge, revocations
+from arbor_imago.services.models.gallery import Gallery as GalleryService
 
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from contextlib import asynccontextmanager
-from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import JSONResponse
-import uvicorn
+from contextlib import asynccontextmanager, suppress
+from fastapi import FastAPI, HTTPException, Request, status
+from fastapi.responses import JSONResponse, Response
+import asyncio
 from pathlib import Path
 import os
 
@@ -15,7 +18,16 @@ import os
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     print('startingup')
+    async with core.ASYNC_SESSIONMAKER() as session:
+        await GalleryService.replay_moves(session)
+        if config.AUTH['stateless_access_tokens']:
+            await revocations.REVOCATIONS.sync(session)
+    purge_task = asyncio.create_task(purge.run_forever())
     yield
+    purge_task.cancel()
+    # let an interrupted batch roll back and close its session before the engine goes
+    with suppress(asyncio.CancelledError):
+        await purge_task
     print('closingdown')
 
 app = FastAPI(lifespan=lifespan)
@@ -27,11 +39,17 @@ app.add_middleware(
     allow_headers=["*"],
     expose_headers=list(config.HEADER_KEYS.values()),
 )
+# outermost, so the time spent in the other middleware counts as well
+app.add_middleware(metrics_core.MetricsMiddleware)
 
 
 @app.exception_handler(HTTPException)
 async def custom_http_exception_handler(request: Request, exc: HTTPException):
 
+    # a 304 has no body, only the validators in its headers
+    if exc.status_code == status.HTTP_304_NOT_MODIFIED:
+        return Response(status_code=exc.status_code, headers=exc.headers)
+
     response = JSONResponse(status_code=exc.status_code,
                             content={"detail": exc.detail}, headers=exc.headers)
 
@@ -54,9 +72,11 @@ app.include_router(gallery.GalleryAdminRouter().router)
 app.include_router(user_access_token.UserAccessTokenAdminRouter().router)
 app.include_router(api_key.ApiKeyAdminRouter().router)
 app.include_router(api_key_scope.ApiKeyScopeAdminRouter().router)
+app.include_router(metrics.MetricsAdminRouter().router)
 
 
 def run():
+    import uvicorn
 
     if config.UVICORN.get('use_string_import', False) is True:
         app_module_path = Path(__file__).resolve()
@@ -98,3 +98,11 @@ def authorization_type_not_permitted(type: types.AuthCredential.type) -> HTTPExc
             type),
         logout=False
     )
+
+
+def refresh_token_required() -> HTTPException:
+    return Base(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        detail="A refresh token is required, not a stateless access token",
+        logout=False
+    )
@@ -0,0 +1,127 @@
+"""Verification of Google ID tokens against Google's signing certificates, cached in memory
+
+Google ID tokens are RS256 JWTs signed with one of a handful of keys Google rotates every few days. The
+certificates are fetched with an async client and kept in memory for as long as Google's Cache-Control allows, so
+verifying a login is a local signature check. A login close to expiry starts a refresh in the background, only a
+cold or fully expired cache, or a token signed with a key not seen yet, waits for a fetch.
+"""
+
+from arbor_imago import core
+
+from google.auth import jwt as google_jwt
+from collections.abc import Callable, Mapping
+import asyncio
+import base64
+import binascii
+import httpx
+import json
+import re
+import time
+
+CERTS_URL = 'https://www.googleapis.com/oauth2/v1/certs'
+ISSUERS = ('accounts.google.com', 'https://accounts.google.com')
+
+# seconds
+DEFAULT_MAX_AGE = 3600
+REFRESH_AHEAD = 300
+MIN_REFRESH_INTERVAL = 60
+FETCH_TIMEOUT = 10
+
+
+class CertificatesUnavailableError(Exception):
+    """Google's certificates could not be fetched and none are cached"""
+
+
+def _max_age(cache_control: str | None) -> int:
+    match = re.search(r'max-age=(\d+)', cache_control or '')
+    return int(match.group(1)) if match is not None else DEFAULT_MAX_AGE
+
+
+def _key_id(token: str) -> str | None:
+    try:
+        header = token.split('.', 1)[0]
+        return json.loads(base64.urlsafe_b64decode(header + '=' * (-len(header) % 4))).get('kid')
+    except (binascii.Error, ValueError, AttributeError) as e:
+        raise ValueError('Malformed ID token') from e
+
+
+class Certificates:
+    """Google's signing certificates by key id, cached in memory
+
+    `transport` and `clock` are for tests, which serve the certificates locally and move time forward.
+    """
+
+    def __init__(self, url: str = CERTS_URL, transport: httpx.AsyncBaseTransport | None = None, clock: Callable[[], float] = time.monotonic):
+        self.url = url
+        self.transport = transport
+        self.clock = clock
+        self.fetches = 0
+        self._certs: dict[str, str] = {}
+        self._fetched_at: float | None = None
+        self._expires_at = 0.0
+        self._lock = asyncio.Lock()
+        self._refresh_task: asyncio.Task | None = None
+
+    async def _fetch(self) -> None:
+
+        try:
+            # a client per fetch, fetches are hours apart and a client is bound to the loop it first runs on
+            async with httpx.AsyncClient(transport=self.transport, timeout=FETCH_TIMEOUT) as client:
+                response = await client.get(self.url)
+                response.raise_for_status()
+                certs = response.json()
+        except (httpx.HTTPError, ValueError) as e:
+            raise CertificatesUnavailableError(
+                'Could not fetch Google certificates from {}'.format(self.url)) from e
+
+        self.fetches += 1
+        self._certs = certs
+        self._fetched_at = self.clock()
+        self._expires_at = self._fetched_at + \
+            _max_age(response.headers.get('Cache-Control'))
+
+    async def _refresh(self, seen: int) -> None:
+        """Fetch the certificates, unless someone else did since the caller saw `seen` fetches"""
+
+        async with self._lock:
+            if self.fetches == seen:
+                await self._fetch()
+
+    async def _refresh_in_background(self, seen: int) -> None:
+        try:
+            await self._refresh(seen)
+        except CertificatesUnavailableError:
+            core.LOGGER.exception(
+                'Refreshing Google certificates failed, the cached ones are used until they expire')
+
+    async def get(self) -> Mapping[str, str]:
+
+        now = self.clock()
+        if now >= self._expires_at:
+            await self._refresh(self.fetches)
+        elif now >= self._expires_at - REFRESH_AHEAD and (self._refresh_task is None or self._refresh_task.done()):
+            self._refresh_task = asyncio.create_task(
+                self._refresh_in_background(self.fetches))
+        return self._certs
+
+    async def get_for_key_id(self, key_id: str | None) -> Mapping[str, str]:
+
+        certs = await self.get()
+        # an unknown key id means Google rotated its keys since the last fetch, refetch at most once a minute
+        if key_id is not None and key_id not in certs and self._fetched_at is not None and self.clock() - self._fetched_at >= MIN_REFRESH_INTERVAL:
+            await self._refresh(self.fetches)
+            certs = self._certs
+        return certs
+
+
+CERTIFICATES = Certificates()
+
+
+async def verify_id_token(token: str, audience: str, certificates: Certificates = CERTIFICATES) -> Mapping[str, object]:
+    """The claims of a Google ID token, raises ValueError if it is not a valid token issued by Google for audience"""
+
+    certs = await certificates.get_for_key_id(_key_id(token))
+    claims = google_jwt.decode(token, certs=certs, audience=audience)
+    if claims.get('iss') not in ISSUERS:
+        raise ValueError('Wrong issuer {}'.format(claims.get('iss')))
+    return claims
@@ -12,10 +12,11 @@ import typing
 from typing import Annotated, Generic
 from fastapi import Request, HTTPException, status, Response
 import datetime as datetime_module
+import hashlib
 
 from arbor_imago import auth, models, schemas
 from arbor_imago.auth import exceptions
-from arbor_imago.core import config, types, utils
+from arbor_imago.core import config, types, utils, cache, dependencies
 from arbor_imago.models import tables
 from arbor_imago.schemas import user as user_schema, user_access_token as user_access_token_schema, sign_up as sign_up_schema, otp as otp_schema, auth_credential as auth_credential_schema
 from arbor_imago.services.models.user import User as UserService
@@ -23,8 +24,18 @@ from arbor_imago.services.models.user_access_token import UserAccessToken as Use
 from arbor_imago.services.models.sign_up import SignUp as SignUpService
 from arbor_imago.services.models.otp import OTP as OTPService
 from arbor_imago.services.models.api_key import ApiKey as ApiKeyService
-from arbor_imago.services.models import auth_credential as auth_credential_service
-from arbor_imago.services import models as model_services
+from arbor_imago.services.models import auth_credential as auth_credential_service, base as base_service
+from arbor_imago.services import models as model_services, revocations
+
+
+# payloads of tokens that were verified and had every required claim, by token digest
+JWT_PAYLOAD_CACHE: cache.Cache[bytes, auth_credential_schema.JwtPayload[typing.Any]] = cache.Cache(
+    'jwt_payloads', **config.CACHES['jwt_payloads'])
+
+
+def jwt_digest(token: types.JwtEncodedStr) -> bytes:
+    # keyed by digest so the cache never holds a usable token
+    return hashlib.blake2b(token.encode(), digest_size=32).digest()
 
 
 def set_access_token_cookie(response: Response, access_token: types.JwtEncodedStr,  expiry: datetime_module.datetime | None = None):
@@ -42,6 +53,47 @@ def set_access_token_cookie(response: Response, access_token: types.JwtEncodedSt
 
 def delete_access_token_cookie(response: Response):
     response.delete_cookie(config.ACCESS_TOKEN_COOKIE['key'])
+    if config.AUTH['stateless_access_tokens']:
+        response.delete_cookie(
+            config.REFRESH_TOKEN_COOKIE['key'], path=config.REFRESH_TOKEN_COOKIE.get('path', '/'))
+
+
+def set_refresh_token_cookie(response: Response, refresh_token: types.JwtEncodedStr,  expiry: datetime_module.datetime | None = None):
+
+    kwargs = {}
+    if expiry:
+        kwargs['expires'] = expiry
+
+    response.set_cookie(
+        **config.REFRESH_TOKEN_COOKIE,
+        value=refresh_token,
+        **kwargs
+    )
+
+
+class IssuedTokens(typing.NamedTuple):
+    access_token: types.JwtEncodedStr
+    refresh_token: types.JwtEncodedStr | None
+
+
+def issue_tokens(response: Response, user_access_token: tables.UserAccessToken, user: tables.User | user_schema.UserClaims, expiry: datetime_module.datetime | None = None) -> IssuedTokens:
+    """Set the cookies for a new user access token, expiry is the cookies' expiry, None for session cookies
+
+    With stateless access tokens, the user access token is the refresh token and the access token is minted from it.
+    """
+
+    encoded_jwt = utils.jwt_encode(typing.cast(
+        dict, UserAccessTokenService.to_jwt_payload(user_access_token)))
+
+    if not config.AUTH['stateless_access_tokens']:
+        set_access_token_cookie(response, encoded_jwt, expiry)
+        return IssuedTokens(access_token=encoded_jwt, refresh_token=None)
+
+    access_token = utils.jwt_encode(typing.cast(
+        dict, UserAccessTokenService.to_stateless_jwt_payload(user_access_token, user)))
+    set_access_token_cookie(response, access_token, expiry)
+    set_refresh_token_cookie(response, encoded_jwt, expiry)
+    return IssuedTokens(access_token=access_token, refresh_token=encoded_jwt)
 
 
 class OAuth2PasswordBearerMultiSource(OAuth2):
@@ -91,7 +143,8 @@ oauth2_scheme = OAuth2PasswordBearerMultiSource(
 class GetAuthReturn(BaseModel, Generic[schemas.TAuthCredentialInstance_co]):
     isAuthorized: bool = False
     exception: typing.Optional[HTTPException] = None
-    user: typing.Optional[user_schema.UserPrivate] = None
+    # the whole UserPrivate, except from a stateless access token
+    user: typing.Optional[user_schema.UserClaims] = None
     scope_ids: typing.Optional[set[types.Scope.id]] = None
     auth_credential: typing.Optional[schemas.TAuthCredentialInstance_co] = None
 
@@ -122,11 +175,17 @@ class _WithRaiseExceptions(typing.TypedDict):
     raise_exceptions: typing.NotRequired[bool]
 
 
+class _WithPermitStateless(typing.TypedDict):
+    # False where the user access token itself is needed: refreshing, or swapping a magic link
+    permit_stateless: typing.NotRequired[bool]
+
+
 class MakeGetAuthDepedencyKwargs(
         _WithRequiredScopes,
         _WithOverrideLifetime,
         _WithPermittedTypes,
         _WithRaiseExceptions,
+        _WithPermitStateless,
 ):
     pass
 
@@ -142,8 +201,10 @@ class GetAuthFromTableKwargs(
 class GetAuthFromJwtKwargs(
         _WithRequiredScopes,
         _WithOverrideLifetime,
-        _WithPermittedTypes):
+        _WithPermittedTypes,
+        _WithPermitStateless):
     token: typing.Optional[types.JwtEncodedStr]
+    session: AsyncSession
 
 
 def is_valid_time_bounds(
@@ -192,15 +253,16 @@ async def get_auth_from_auth_credential_table_inst(
         return GetAuthReturn(exception=exceptions.authorization_expired())
 
     # if no user is associated with the auth_credential, raise an exception
-    user = await UserService.read(
-        {
-            'session': session,
-            'id': auth_credential_table_inst.user_id,
-            'admin': True,
-            'authorized_user_id': auth_credential_table_inst.user_id,
-        })
-
-    if user is None:
+    # a soft deleted user keeps their credentials until the purge, but is no longer found
+    try:
+        user = await UserService.read(
+            {
+                'session': session,
+                'id': auth_credential_table_inst.user_id,
+                'admin': True,
+                'authorized_user_id': auth_credential_table_inst.user_id,
+            })
+    except base_service.NotFoundError:
         return GetAuthReturn(exception=exceptions.user_not_found())
 
     required_scope_ids = set(
@@ -221,33 +283,72 @@ async def get_auth_from_auth_credential_table_inst(
     )
 
 
+async def get_auth_from_stateless_jwt_payload(payload: user_access_token_schema.StatelessJwtPayload, session: AsyncSession, required_scopes: set[types.Scope.name], revocation_log: revocations.Revocations = revocations.REVOCATIONS) -> GetAuthReturn[tables.UserAccessToken]:
+    """Authorize from the claims and the in-memory revocation log, the user access token is only read when the access token is refreshed"""
+
+    try:
+        UserAccessTokenService.validate_stateless_jwt_claims(payload)
+    except auth_credential_service.MissingRequiredClaimsError as e:
+        return GetAuthReturn(exception=exceptions.missing_required_claims(set(e.claims)))
+
+    # a query once per sync interval, not per request
+    await revocation_log.sync(session)
+    if revocation_log.is_revoked(payload['sub'], payload['user_id'], payload['iat']):
+        return GetAuthReturn(exception=exceptions.authorization_expired())
+
+    scope_ids = UserAccessTokenService.bitmask_to_scope_ids(payload['scopes'])
+    if not {config.SCOPE_NAME_MAPPING[scope_name] for scope_name in required_scopes}.issubset(scope_ids):
+        return GetAuthReturn(exception=exceptions.not_permitted())
+
+    return GetAuthReturn(
+        isAuthorized=True,
+        user=user_schema.UserClaims(
+            id=payload['user_id'],
+            user_role_id=payload['user_role_id'],
+        ),
+        scope_ids=scope_ids,
+        auth_credential=UserAccessTokenService.model_inst_from_stateless_jwt_payload(
+            payload)
+    )
+
+
 async def get_auth_from_auth_credential_jwt(**kwargs: typing.Unpack[GetAuthFromJwtKwargs]) -> GetAuthReturn[schemas.AuthCredentialJwtInstance]:
 
     token = kwargs.get('token', None)
+    session = kwargs['session']
     required_scopes = kwargs.get('required_scopes', set())
     permitted_types = kwargs.get(
         'permitted_types', {UserAccessTokenService.auth_type.value, ApiKeyService.auth_type.value})
     override_lifetime = kwargs.get('override_lifetime', None)
+    permit_stateless = kwargs.get('permit_stateless', True)
 
     # 1. if token is blank
     if token is None:
         return GetAuthReturn(exception=exceptions.missing_authorization())
 
-    # 2. make sure the token is a valid jwt
-    try:
-        payload = typing.cast(
-            auth_credential_schema.JwtPayload[typing.Any], utils.jwt_decode(token))
-    except:
-        return GetAuthReturn(exception=exceptions.improper_format())
-
-    # 3. make sure the jwt is a valid payload
-    try:
-        auth_credential_service.JwtIO.validate_jwt_claims(
-            payload)  # type: ignore
-    except auth_credential_service.MissingRequiredClaimsError as e:
-        return GetAuthReturn(exception=exceptions.missing_required_claims(set(e.claims)))
-    except Exception:
-        raise
+    # a token seen before already passed 2. and 3., its payload is reused until the token expires
+    digest = jwt_digest(token)
+    payload = JWT_PAYLOAD_CACHE.get(digest, None)
+    if payload is None:
+
+        # 2. make sure the token is a valid jwt
+        try:
+            payload = typing.cast(
+                auth_credential_schema.JwtPayload[typing.Any], utils.jwt_decode(token))
+        except:
+            return GetAuthReturn(exception=exceptions.improper_format())
+
+        # 3. make sure the jwt is a valid payload
+        try:
+            auth_credential_service.JwtIO.validate_jwt_claims(
+                payload)  # type: ignore
+        except auth_credential_service.MissingRequiredClaimsError as e:
+            return GetAuthReturn(exception=exceptions.missing_required_claims(set(e.claims)))
+        except Exception:
+            raise
+
+        JWT_PAYLOAD_CACHE.set(digest, payload, expires_at=datetime_module.datetime.fromtimestamp(
+            payload['exp'], tz=datetime_module.UTC))
 
     # 4. check if the auth_credential type is permitted
     auth_type = payload['type']
@@ -266,36 +367,36 @@ async def get_auth_from_auth_credential_jwt(**kwargs: typing.Unpack[GetAuthFromJ
     if not is_valid_time_bounds(dt_issued, dt_expiry, dt_now, override_lifetime):
         return GetAuthReturn(exception=exceptions.authorization_expired())
 
+    # a stateless access token carries the user and their scopes, no query needed
+    if AuthCredentialService is UserAccessTokenService and UserAccessTokenService.is_stateless_jwt_payload(payload):
+        if not permit_stateless:
+            return GetAuthReturn(exception=exceptions.refresh_token_required())
+        return await get_auth_from_stateless_jwt_payload(typing.cast(user_access_token_schema.StatelessJwtPayload, payload), session, required_scopes)
+
     # if the auth_credential is stored in a table, check its db entry
     if issubclass(AuthCredentialService, auth_credential_service.Table):
 
-        async with config.ASYNC_SESSIONMAKER() as session:
-
-            AuthCredentialService = typing.cast(
-                model_services.AuthCredentialJwtAndTableService, AuthCredentialService)
-
-            auth_credential_table_inst_from_db = await AuthCredentialService.read({
-                'session': session,
-                'id': payload['sub'],
-                'admin': True,
-                'authorized_user_id': None
-            })
-
-            if not auth_credential_table_inst_from_db:
-                return GetAuthReturn(exception=exceptions.authorization_expired())
-
-            return await get_auth_from_auth_credential_table_inst(
-                auth_credential_table_inst_from_db,
-                auth_credential_service=AuthCredentialService,
-                session=session,
-                dt_now=dt_now,
-                **{
-                    k: v for k, v in {
-                        'required_scopes': required_scopes,
-                        'override_lifetime': override_lifetime
-                    }.items() if v
-                }
-            )
+        AuthCredentialService = typing.cast(
+            model_services.AuthCredentialJwtAndTableService, AuthCredentialService)
+
+        # a deleted credential is an expired one, not a missing resource
+        auth_credential_table_inst_from_db = await AuthCredentialService.fetch_by_id(session, payload['sub'])
+
+        if not auth_credential_table_inst_from_db:
+            return GetAuthReturn(exception=exceptions.authorization_expired())
+
+        return await get_auth_from_auth_credential_table_inst(
+            auth_credential_table_inst_from_db,
+            auth_credential_service=AuthCredentialService,
+            session=session,
+            dt_now=dt_now,
+            **{
+                k: v for k, v in {
+                    'required_scopes': required_scopes,
+                    'override_lifetime': override_lifetime
+                }.items() if v
+            }
+        )
 
     else:
 
@@ -318,8 +419,8 @@ async def get_auth_from_auth_credential_jwt(**kwargs: typing.Unpack[GetAuthFromJ
 def make_get_auth_dependency(**kwargs: typing.Unpack[MakeGetAuthDepedencyKwargs]):
     raise_exceptions = kwargs.get('raise_exceptions', True)
 
-    async def get_authorization_dependency(response: Response, auth_token: typing.Annotated[types.JwtEncodedStr | None, Depends(oauth2_scheme)]) -> GetAuthReturn:
-        get_authorization_return = await get_auth_from_auth_credential_jwt(token=auth_token, **kwargs)
+    async def get_authorization_dependency(response: Response, session: dependencies.SessionDepends, auth_token: typing.Annotated[types.JwtEncodedStr | None, Depends(oauth2_scheme)]) -> GetAuthReturn:
+        get_authorization_return = await get_auth_from_auth_credential_jwt(token=auth_token, session=session, **kwargs)
         if get_authorization_return.exception:
             if raise_exceptions:
                 raise get_authorization_return.exception
@@ -340,7 +441,13 @@ class GetUserSessionInfoNestedReturn(BaseModel):
     auth: GetUserSessionInfoReturn
 
 
-def get_user_session_info(get_authorization_return: GetAuthReturn) -> GetUserSessionInfoNestedReturn:
+async def get_user_session_info(get_authorization_return: GetAuthReturn, session: AsyncSession) -> GetUserSessionInfoNestedReturn:
+
+    user = get_authorization_return.user
+    # a stateless access token carries no profile, it is read, served from the identity map when already loaded
+    if user is not None and not isinstance(user, user_schema.UserPrivate):
+        user_inst = await UserService.fetch_by_id(session, user.id)
+        user = None if user_inst is None else user_schema.UserPrivate.model_validate(user_inst)
 
     access_token: typing.Optional[user_access_token_schema.UserAccessTokenPublic] = None
     if get_authorization_return.auth_credential and isinstance(get_authorization_return.auth_credential, tables.UserAccessToken):
@@ -351,22 +458,21 @@ def get_user_session_info(get_authorization_return: GetAuthReturn) -> GetUserSes
         )
 
     return GetUserSessionInfoNestedReturn(auth=GetUserSessionInfoReturn(
-        user=get_authorization_return.user,
+        user=user,
         scope_ids=get_authorization_return.scope_ids,
         access_token=access_token
     ))
 
 
 def make_authenticate_user_with_username_and_password_dependency():
-    async def authenticate_user_with_username_and_password(form_data: Annotated[OAuth2PasswordRequestForm, Depends()]) -> tables.User:
+    async def authenticate_user_with_username_and_password(form_data: Annotated[OAuth2PasswordRequestForm, Depends()], session: dependencies.SessionDepends) -> tables.User:
 
-        async with config.ASYNC_SESSIONMAKER() as session:
-            user = await UserService.authenticate(
-                session, form_data.username, form_data.password)
+        user = await UserService.authenticate(
+            session, form_data.username, form_data.password)
 
-            if user is None:
-                raise exceptions.credentials()
-            return user
+        if user is None:
+            raise exceptions.credentials()
+        return user
 
     return authenticate_user_with_username_and_password
 
@@ -418,11 +524,10 @@ async def login_otp(session: AsyncSession, user: tables.User | None, response: R
     if user is None:
         raise exceptions.invalid_otp()
 
-    query = select(OTPService._MODEL).where(
-        OTPService._MODEL.user_id == user.id)
-    otp = await OTPService.fetch_one(session, query)
+    otp = await OTPService.fetch_one(
+        session, OTPService._build_select_by_user_id(user.id))
 
-    if otp is None or OTPService.verify_code(code, otp.hashed_code) is False:
+    if otp is None or await OTPService.verify_code(code, otp.hashed_code) is False:
         raise exceptions.invalid_otp()
 
     get_auth = await get_auth_from_auth_credential_table_inst(
@@ -435,30 +540,31 @@ async def login_otp(session: AsyncSession, user: tables.User | None, response: R
     if get_auth.exception:
         raise get_auth.exception
 
-    # if the code is active and correct, create a new access token
-    user_access_token = await UserAccessTokenService.create({
-        'authorized_user_id': user.id,
-        'session': session,
-        'create_model': user_access_token_schema.UserAccessTokenAdminCreate(
-            user_id=user.id,
-            expiry=auth_credential_service.lifespan_to_expiry(
-                config.AUTH['credential_lifespans']['access_token']),
-        ),
-        'admin': False
-    })
-
-    set_access_token_cookie(response, utils.jwt_encode(typing.cast(
-        dict, UserAccessTokenService.to_jwt_payload(user_access_token))), expiry=user_access_token.expiry)
-
-    # one time link, delete the otp
-    await OTPService.delete(
-        {
-            'session': session,
-            'id': otp.id,
+    # if the code is active and correct, swap it for a new access token in a single transaction
+    async with base_service.unit_of_work(session):
+        user_access_token = await UserAccessTokenService.create({
             'authorized_user_id': user.id,
+            'session': session,
+            'create_model': user_access_token_schema.UserAccessTokenAdminCreate(
+                user_id=user.id,
+                expiry=auth_credential_service.lifespan_to_expiry(
+                    config.AUTH['credential_lifespans']['access_token']),
+            ),
             'admin': False
-        }
-    )
+        })
+
+        # one time link, delete the otp
+        await OTPService.delete(
+            {
+                'session': session,
+                'id': otp.id,
+                'authorized_user_id': user.id,
+                'admin': False
+            }
+        )
+
+    issue_tokens(response, user_access_token, user,
+                 expiry=user_access_token.expiry)
 
     return LoginWithOTPResponse(
         auth=GetUserSessionInfoReturn(
@@ -502,29 +608,30 @@ async def create_otp(session: AsyncSession, user: tables.User, email: typing.Opt
 
     code = OTPService.generate_code()
 
-    # if there is an existing OTP, delete it
-    query = select(OTPService._MODEL).where(
-        OTPService._MODEL.user_id == user.id)
-    existing_otp = await OTPService.fetch_one(session, query)
+    async with base_service.unit_of_work(session):
 
-    if existing_otp is not None:
-        await OTPService.delete({
-            'id': existing_otp.id,
-            'session': session,
+        # if there is an existing OTP, delete it
+        existing_otp = await OTPService.fetch_one(
+            session, OTPService._build_select_by_user_id(user.id))
+
+        if existing_otp is not None:
+            await OTPService.delete({
+                'id': existing_otp.id,
+                'session': session,
+                'authorized_user_id': user.id,
+                'admin': False
+            })
+
+        # create a new OTP, return it
+        otp = await OTPService.create({
             'authorized_user_id': user.id,
-            'admin': False
+            'session': session,
+            'admin': False,
+            'create_model': otp_schema.OTPAdminCreate(
+                user_id=user.id, hashed_code=await OTPService.hash_code(code), expiry=auth_credential_service.lifespan_to_expiry(config.AUTH['credential_lifespans']['otp'])
+            )
         })
 
-    # create a new OTP, return it
-    otp = await OTPService.create({
-        'authorized_user_id': user.id,
-        'session': session,
-        'admin': False,
-        'create_model': otp_schema.OTPAdminCreate(
-            user_id=user.id, hashed_code=OTPService.hash_code(code), expiry=auth_credential_service.lifespan_to_expiry(config.AUTH['credential_lifespans']['otp'])
-        )
-    })
-
     return code
 
 
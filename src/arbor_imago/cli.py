@@ -1,22 +1,29 @@
-from arbor_imago import core, app
+from arbor_imago import core
 from arbor_imago.core import config
 
+# commands import the app, the services and the tables they need themselves,
+# so that the ones which need none of them start quickly
 import typer
 import asyncio
 import json
+import collections
 from sqlmodel import SQLModel
+from pathlib import Path
 
 cli = typer.Typer()
 
 
 @cli.command()
 def runserver():
+    from arbor_imago import app
     app.run()
 
 
 @cli.command()
 def create_tables():
     """Create all database tables."""
+    from arbor_imago.models import tables  # registers the tables on SQLModel.metadata
+
     async def _main():
         async with core.DB_ASYNC_ENGINE.begin() as conn:
             await conn.run_sync(SQLModel.metadata.create_all)
@@ -25,9 +32,65 @@ def create_tables():
     asyncio.run(_main())
 
 
+@cli.command()
+def purge():
+    """Remove soft deleted users and galleries, with their media."""
+
+    from arbor_imago.services import purge as purge_service
+
+    print('Purging soft deleted rows...')
+    print('Purged {} rows'.format(asyncio.run(purge_service.purge())))
+
+
+@cli.command()
+def build_tree_view(dest: Path):
+    """Link the id media layout's files into a readable gallery tree at DEST."""
+    from arbor_imago.services.models.gallery import Gallery as GalleryService
+
+    async def _main():
+        async with core.ASYNC_SESSIONMAKER() as session:
+            return await GalleryService.build_tree_view(session, config.GALLERIES_DIR, dest)
+
+    print('Building tree view...')
+    print('Linked {} files'.format(asyncio.run(_main())))
+
+
+@cli.command()
+def fsck(repair: bool = False, workers: int = 4):
+    """Check the media directory against the database, and with --repair make the rows match the disk."""
+    from arbor_imago.services import fsck as fsck_service
+
+    async def _main() -> collections.Counter[str]:
+        counts: collections.Counter[str] = collections.Counter()
+        async with core.ASYNC_SESSIONMAKER() as session:
+            async for problem in fsck_service.check(session, workers=workers, repair=repair):
+                counts[problem.kind] += 1
+                print(problem.kind, problem.path)
+        return counts
+
+    counts = asyncio.run(_main())
+    print(', '.join('{} {}'.format(count, kind) for kind, count in counts.items()) or 'No problems found')
+    if counts and not repair:
+        raise typer.Exit(code=1)
+
+
+@cli.command()
+def rebuild_counters():
+    """Recount the gallery and user counters from the files and credentials, for databases that predate them or drifted."""
+    from arbor_imago.services import counters as counters_service
+
+    async def _main() -> tuple[int, int]:
+        async with core.ASYNC_SESSIONMAKER() as session:
+            return await counters_service.rebuild(session)
+
+    n_galleries, n_users = asyncio.run(_main())
+    print('Counted {} galleries and {} users'.format(n_galleries, n_users))
+
+
 @cli.command()
 def export_api_schema():
     """Export OpenAPI schema to file."""
+    from arbor_imago import app
 
     print('Exporting OpenAPI schema...')
     config.OPENAPI_SCHEMA_PATHS['gallery'].write_text(
@@ -1,20 +1,50 @@
 import arbor_imago
-from arbor_imago.core import config
+from arbor_imago.core import config, metrics
 
 from sqlmodel.ext.asyncio.session import AsyncSession as SQLMAsyncSession
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncEngine, async_sessionmaker
+from sqlalchemy import event
 import logging
 
+
+def configure_sqlite_engine(engine: AsyncEngine) -> None:
+    """Make SQLite transactions begin explicitly and enforce foreign keys
+
+    pysqlite only emits BEGIN before DML, so a SAVEPOINT issued first opens its own transaction and releasing it
+    commits. Taking over BEGIN keeps savepoints nested inside the session's transaction.
+
+    SQLite ignores foreign keys unless asked per connection, and deletes rely on their ON DELETE actions.
+    """
+
+    @event.listens_for(engine.sync_engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+    @event.listens_for(engine.sync_engine, 'begin')
+    def begin(connection):
+        connection.exec_driver_sql('BEGIN')
+
+
 DB_ASYNC_ENGINE = create_async_engine(
-    config.DB['URL']
+    config.DB['URL'],
+    poolclass=metrics.pool_class(config.DB['URL'])
 )
 
+if DB_ASYNC_ENGINE.dialect.name == 'sqlite':
+    configure_sqlite_engine(DB_ASYNC_ENGINE)
+
+metrics.instrument_engine(DB_ASYNC_ENGINE)
+
 ASYNC_SESSIONMAKER = async_sessionmaker(
     bind=DB_ASYNC_ENGINE,
     class_=SQLMAsyncSession,
     expire_on_commit=False
 )
 
+
 LOGGER = logging.getLogger(arbor_imago.__name__)
 if 'level' in config.LOGGER:
     logging.basicConfig(level=config.LOGGER['level'])
@@ -0,0 +1,81 @@
+from collections import OrderedDict
+from typing import Generic, TypeVar, Hashable, Any
+import datetime as datetime_module
+import time
+
+K = TypeVar('K', bound=Hashable)
+V = TypeVar('V')
+
+MISSING: Any = object()
+
+# every cache created in the process, by name, so their hit rates can be reported
+REGISTRY: dict[str, 'Cache'] = {}
+
+
+class Cache(Generic[K, V]):
+    """Bounded LRU mapping whose entries expire after a TTL
+
+    Entries are kept for at most `ttl`, or until the deadline given to `set`, whichever comes first. `invalidate`
+    drops everything and bumps `generation`. Readers capture the generation before they load a value and pass it
+    to `set`, so a value loaded before an invalidation is never stored after it.
+
+    Not thread safe, it is meant to be used from the event loop.
+    """
+
+    def __init__(self, name: str, maxsize: int, ttl: datetime_module.timedelta | None = None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl.total_seconds() if ttl is not None else None
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[K, tuple[V, float | None]] = OrderedDict()
+        REGISTRY[name] = self
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: K, default: Any = MISSING) -> V | Any:
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            value, expires_at = entry
+            if expires_at is None or expires_at > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._entries[key]
+
+        self.misses += 1
+        return default
+
+    def set(self, key: K, value: V, expires_at: datetime_module.datetime | None = None, generation: int | None = None) -> None:
+
+        if generation is not None and generation != self.generation:
+            return
+
+        deadline = None if self.ttl is None else time.monotonic() + self.ttl
+        if expires_at is not None:
+            remaining = (expires_at - datetime_module.datetime.now(
+                datetime_module.timezone.utc)).total_seconds()
+            if remaining <= 0:
+                return
+            deadline = time.monotonic() + remaining if deadline is None else min(deadline,
+                                                                                 time.monotonic() + remaining)
+
+        self._entries[key] = (value, deadline)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def delete(self, key: K) -> None:
+        self._entries.pop(key, None)
+
+    def invalidate(self) -> None:
+        self.generation += 1
+        self._entries.clear()
+
+    @property
+    def hit_rate(self) -> float | None:
+        total = self.hits + self.misses
+        return self.hits / total if total else None
@@ -153,12 +153,20 @@ else:
 
 GALLERIES_DIR = MEDIA_DIR / 'galleries'
 
+# switching the layout of an existing library means moving its files
+MEDIA_LAYOUT: types.MediaLayout = _backend_config.get('MEDIA_LAYOUT', 'tree')
+
+# bytes a user's galleries may hold, None for no limit, enforced on upload from UserCounter.file_size
+USER_STORAGE_QUOTA: int | None = _backend_config.get('USER_STORAGE_QUOTA')
+
 # Auth
 _auth: types.AuthConfigFromFile = {}
 _auth.update(_backend_config.get('AUTH', {}))
 
 _auth_credential_lifespans: types.CredentialLifespans = {
     'access_token': datetime.timedelta(days=7),
+    # only used with stateless_access_tokens, bounds how long a revoked access token keeps working
+    'stateless_access_token': datetime.timedelta(minutes=5),
     'magic_link': datetime.timedelta(minutes=10),
     'request_sign_up': datetime.timedelta(hours=1),
     'otp': datetime.timedelta(minutes=10)
@@ -181,9 +189,46 @@ if _jwt_secret_key is None:
 AUTH: types.AuthConfig = {
     'credential_lifespans': _auth_credential_lifespans,
     'jwt_algorithm': _jwt_algorithm,
-    'jwt_secret_key': _jwt_secret_key
+    'jwt_secret_key': _jwt_secret_key,
+    # access tokens carry the user and their scopes and authenticate without a query, the user_access_token
+    # becomes the refresh token that mints them
+    'stateless_access_tokens': _auth.get('stateless_access_tokens', False),
+    # how stale a worker's copy of the revocation log may get, revoking on another worker takes up to this long
+    'revocation_sync_interval': isodate.parse_duration(_auth['revocation_sync_interval']) if 'revocation_sync_interval' in _auth else datetime.timedelta(seconds=1),
+}
+
+
+# Caches
+CACHES: types.CachesConfig = {
+    # entries also expire at their token's exp
+    'jwt_payloads': {
+        'maxsize': 10_000,
+        'ttl': datetime.timedelta(hours=1)
+    },
+    # dropped whenever another transaction changed permissions, the ttl only bounds memory
+    'gallery_permissions': {
+        'maxsize': 10_000,
+        'ttl': datetime.timedelta(minutes=5)
+    },
 }
 
+for _cache_name, _cache_config in _backend_config.get('CACHES', {}).items():
+    if _cache_name not in CACHES:
+        raise ValueError(
+            f'Unknown cache `{_cache_name}` in CACHES, expected one of {', '.join(CACHES)}')
+    if 'maxsize' in _cache_config:
+        CACHES[_cache_name]['maxsize'] = _cache_config['maxsize']
+    if 'ttl' in _cache_config:
+        CACHES[_cache_name]['ttl'] = isodate.parse_duration(
+            _cache_config['ttl'])
+
+
+# Purge of soft deleted users and galleries
+_purge = _backend_config.get('PURGE', {})
+PURGE: types.PurgeConfig = {
+    'batch_size': _purge.get('batch_size', 100),
+    'interval': isodate.parse_duration(_purge['interval']) if 'interval' in _purge else datetime.timedelta(minutes=1),
+}
 
 # OpenAPI Schema Paths
 OPENAPI_SCHEMA_PATHS: types.OpenAPISchemaPaths = {
@@ -208,6 +253,17 @@ ACCESS_TOKEN_COOKIE: types.AccessTokenCookieConfig = {
 _access_token_cookie = _backend_config.get('ACCESS_TOKEN_COOKIE', {})
 ACCESS_TOKEN_COOKIE.update(_access_token_cookie)
 
+# refresh_token_cookie, only set with stateless access tokens and only sent to the refresh route
+REFRESH_TOKEN_COOKIE: types.AccessTokenCookieConfig = {
+    'key': 'refresh_token',
+    'secure': True,
+    'httponly': True,
+    'samesite': 'strict',
+    'path': '/auth/refresh',
+}
+
+REFRESH_TOKEN_COOKIE.update(_backend_config.get('REFRESH_TOKEN_COOKIE', {}))
+
 LOGGER: types.LoggerConfig = {
     'level': 'DEBUG' if ENV == 'local' else 'INFO',
 }
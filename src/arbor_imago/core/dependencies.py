@@ -0,0 +1,22 @@
+"""FastAPI dependencies of the routers, apart from core so the CLI and the workers do not import fastapi"""
+
+from arbor_imago import core
+
+from fastapi import Depends
+from sqlmodel.ext.asyncio.session import AsyncSession as SQLMAsyncSession
+from collections.abc import AsyncIterator
+from typing import Annotated
+
+
+async def get_session() -> AsyncIterator[SQLMAsyncSession]:
+    """Request-scoped session dependency
+
+    FastAPI caches dependencies per request, so the auth dependency, the route handler and anything composed from
+    other handlers all receive the same session, closed once the request is done.
+    """
+
+    async with core.ASYNC_SESSIONMAKER() as session:
+        yield session
+
+
+SessionDepends = Annotated[SQLMAsyncSession, Depends(get_session)]
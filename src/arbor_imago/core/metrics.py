@@ -0,0 +1,263 @@
+"""Request, database, password hashing and cache metrics, rendered in the Prometheus text format
+
+The few metric types needed are kept in process, without a client library. Requests are labelled with their route
+template, never the raw path, so a label's values stay bounded. Database statements are labelled with the route
+that ran them, 'background' for the purge and the startup work, and timed with the cursor events of the engine.
+
+Each process counts on its own, with several uvicorn workers a scrape answers for the worker that served it.
+"""
+
+from arbor_imago.core import cache
+
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.pool import Pool, QueuePool, AsyncAdaptedQueuePool
+from collections.abc import Callable, Iterable, Sequence
+from contextvars import ContextVar
+from typing import Any, ClassVar
+import bisect
+import math
+import time
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# seconds
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+Labels = tuple[str, ...]
+
+# every metric created in the process, by name, in the order they are rendered
+REGISTRY: dict[str, '_Metric'] = {}
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"'))
+                          for name, value in zip(names, values)) + '}'
+
+
+class _Metric:
+    type: ClassVar[str]
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        REGISTRY[name] = self
+
+    def samples(self) -> Iterable[tuple[str, Sequence[str], Labels, float]]:
+        """(name, label names, label values, value) of each sample"""
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.type)]
+        lines.extend('{}{} {}'.format(name, _format_labels(names, values), _format_value(value))
+                     for name, names, values, value in self.samples())
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        # a metric without labels reports 0 before anything happened, instead of being missing
+        self._values: dict[Labels, float] = {} if self.labelnames else {(): 0.0}
+
+    def inc(self, *labelvalues: str, amount: float = 1.0) -> None:
+        self._values[labelvalues] = self._values.get(labelvalues, 0.0) + amount
+
+    def samples(self):
+        for labelvalues, value in self._values.items():
+            yield self.name, self.labelnames, labelvalues, value
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def dec(self, *labelvalues: str, amount: float = 1.0) -> None:
+        self.inc(*labelvalues, amount=-amount)
+
+    def set(self, value: float, *labelvalues: str) -> None:
+        self._values[labelvalues] = value
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = REQUEST_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # per label values, the count of each bucket on its own, then the sum and the count
+        self._values: dict[Labels, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, *labelvalues: str) -> None:
+        entry = self._values.get(labelvalues)
+        if entry is None:
+            entry = self._values[labelvalues] = (
+                [0] * (len(self.buckets) + 1), [0.0, 0.0])
+        counts, totals = entry
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        totals[0] += value
+        totals[1] += 1
+
+    def samples(self):
+        names = self.labelnames + ('le',)
+        for labelvalues, (counts, (total, count)) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                yield self.name + '_bucket', names, labelvalues + (_format_value(bound),), cumulative
+            yield self.name + '_sum', self.labelnames, labelvalues, total
+            yield self.name + '_count', self.labelnames, labelvalues, count
+
+
+class Collected(_Metric):
+    """A metric read from its source at every scrape, instead of being updated as things happen"""
+
+    def __init__(self, name: str, documentation: str, type: str, labelnames: Sequence[str], collect: Callable[[], Iterable[tuple[Labels, float]]]):
+        super().__init__(name, documentation, labelnames)
+        self.type = type
+        self.collect = collect
+
+    def samples(self):
+        for labelvalues, value in self.collect():
+            yield self.name, self.labelnames, labelvalues, value
+
+
+def render() -> str:
+    return ''.join(metric.render() for metric in REGISTRY.values())
+
+
+HTTP_REQUESTS = Counter('arbor_imago_http_requests_total',
+                        'Requests answered, by route template', ('method', 'route', 'status'))
+HTTP_REQUEST_DURATION = Histogram('arbor_imago_http_request_duration_seconds',
+                                  'Time to answer a request, by route template', ('method', 'route'))
+HTTP_REQUESTS_IN_PROGRESS = Gauge('arbor_imago_http_requests_in_progress',
+                                  'Requests being answered')
+
+DB_STATEMENT_DURATION = Histogram('arbor_imago_db_statement_duration_seconds', 'Time spent in the database per statement, by the route running it and the statement\'s verb',
+                                  ('route', 'verb'), STATEMENT_BUCKETS)
+DB_POOL_CHECKOUT_WAIT = Histogram('arbor_imago_db_pool_checkout_wait_seconds',
+                                  'Time waited for a connection from the pool', buckets=STATEMENT_BUCKETS)
+
+PASSWORD_CHECKS_IN_PROGRESS = Gauge('arbor_imago_password_checks_in_progress',
+                                    'Password and OTP hashes and checks handed to the bcrypt executor and not done yet, those beyond its worker count are queued')
+
+Collected('arbor_imago_cache_hits_total', 'Cache lookups that found an entry', 'counter', ('cache',),
+          lambda: (((name, ), c.hits) for name, c in cache.REGISTRY.items()))
+Collected('arbor_imago_cache_misses_total', 'Cache lookups that found nothing', 'counter', ('cache',),
+          lambda: (((name, ), c.misses) for name, c in cache.REGISTRY.items()))
+Collected('arbor_imago_cache_entries', 'Entries held by the cache', 'gauge', ('cache',),
+          lambda: (((name, ), len(c)) for name, c in cache.REGISTRY.items()))
+
+
+# the scope of the request being answered, the router sets its route once it matched one
+_SCOPE: ContextVar[dict[str, Any] | None] = ContextVar(
+    'metrics_scope', default=None)
+
+
+def _route(scope: dict[str, Any] | None) -> str:
+    if scope is None:
+        return 'background'
+    route = scope.get('route')
+    # unmatched paths share a label, a label per probed URL would grow without bound
+    return getattr(route, 'path', 'unmatched')
+
+
+class MetricsMiddleware:
+    """ASGI middleware counting and timing the HTTP requests"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        status = '500'
+
+        async def send_with_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = str(message['status'])
+            await send(message)
+
+        token = _SCOPE.set(scope)
+        HTTP_REQUESTS_IN_PROGRESS.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = _route(scope)
+            HTTP_REQUEST_DURATION.observe(
+                time.perf_counter() - start, scope['method'], route)
+            HTTP_REQUESTS.inc(scope['method'], route, status)
+            HTTP_REQUESTS_IN_PROGRESS.dec()
+            _SCOPE.reset(token)
+
+
+def _verb(statement: str) -> str:
+    words = statement.split(None, 1)
+    return words[0].upper() if words else ''
+
+
+class TimedAsyncAdaptedQueuePool(AsyncAdaptedQueuePool):
+    """The async engines' default pool, timing the waits for a connection, see pool_class
+
+    The pool events only fire once a connection was handed out, the wait happens in _do_get, where pools get theirs.
+    """
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_CHECKOUT_WAIT.observe(time.perf_counter() - start)
+
+
+def pool_class(url: str) -> type[Pool]:
+    """The pool class an engine picks for the url, timing its waits when it is the queue pool, the engine's poolclass"""
+
+    parsed = make_url(url)
+    poolclass = parsed.get_dialect().get_pool_class(parsed)
+    return TimedAsyncAdaptedQueuePool if poolclass is AsyncAdaptedQueuePool else poolclass
+
+
+def instrument_engine(engine: AsyncEngine) -> None:
+    """Time the statements the engine runs and report the state of its pool, created with pool_class"""
+
+    sync_engine = engine.sync_engine
+
+    # kept on the execution context, a statement that fails leaves nothing behind
+    @event.listens_for(sync_engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context.metrics_start = time.perf_counter()
+
+    @event.listens_for(sync_engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        DB_STATEMENT_DURATION.observe(time.perf_counter() - context.metrics_start,
+                                      _route(_SCOPE.get()), _verb(statement))
+
+    def pool_connections():
+        # dispose replaces the pool, it is looked up at every scrape
+        pool = sync_engine.pool
+        if isinstance(pool, QueuePool):
+            yield ('checked_out',), pool.checkedout()
+            yield ('checked_in',), pool.checkedin()
+            yield ('overflow',), max(pool.overflow(), 0)
+
+    Collected('arbor_imago_db_pool_connections', 'Connections of the pool, by state', 'gauge', ('state',),
+              pool_connections)
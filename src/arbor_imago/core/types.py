@@ -47,6 +47,10 @@ class User:
         min_length=3, max_length=20, pattern=re.compile(r'^[a-zA-Z0-9_.-]+$'), to_lower=True)]
     hashed_password = str
     user_role_id = UserRole.id
+    deleted_at = Annotated[datetime_module.datetime,
+                           'The datetime at which the user was deleted, the row is kept until it is purged']
+    updated_at = Annotated[datetime_module.datetime,
+                           'The datetime at which the user was last written']
 
 
 timestamp = float
@@ -62,6 +66,8 @@ class AuthCredential:
     expiry_timestamp = Annotated[timestamp,
                                  'The datetime at which the auth credential will expire']
     type = Literal['access_token', 'api_key', 'otp', 'sign_up']
+    updated_at = Annotated[datetime_module.datetime,
+                           'The datetime at which the auth credential was last written']
 
 
 OTPId = str
@@ -95,6 +101,14 @@ class SignUp(AuthCredential):
     email = User.email
 
 
+class UserCounter:
+    user_id = User.id
+    file_count = Annotated[int, 'Files in the galleries the user owns']
+    file_size = Annotated[int, 'Bytes of the files in the galleries the user owns, what the storage quota limits']
+    api_key_count = int
+    user_access_token_count = int
+
+
 GalleryId = str
 
 
@@ -111,6 +125,40 @@ class Gallery:
         min_length=0, max_length=20000)]
     date = datetime_module.date
     folder_name = str
+    deleted_at = Annotated[datetime_module.datetime,
+                           'The datetime at which the gallery was deleted, the row is kept until it is purged']
+    updated_at = Annotated[datetime_module.datetime,
+                           'The datetime at which the gallery was last written']
+
+
+class GalleryMove:
+    id = int
+    gallery_id = Gallery.id
+    src = Annotated[str, 'The gallery\'s directory before the move']
+    dst = Annotated[str, 'The gallery\'s directory after the move']
+
+
+class Revocation:
+    id = int
+    user_id = User.id
+    user_access_token_id = UserAccessToken.id
+    revoked_at = datetime_module.datetime
+
+
+class GalleryPermissionChange:
+    id = int
+    changed_at = datetime_module.datetime
+
+
+class GalleryCounter:
+    gallery_id = Gallery.id
+    file_count = Annotated[int, 'Files directly in the gallery']
+    file_size = Annotated[int, 'Bytes of the files directly in the gallery']
+    subtree_file_count = Annotated[int, 'Files in the gallery and all of its descendants']
+    subtree_file_size = Annotated[int, 'Bytes of the files in the gallery and all of its descendants']
+    child_count = Annotated[int, 'Galleries directly in the gallery']
+    updated_at = Annotated[datetime_module.datetime,
+                           'The datetime at which any of the counts last changed']
 
 
 class GalleryDateAndName(NamedTuple):
@@ -272,7 +320,7 @@ class DbConfig(TypedDict):
     URL: str
 
 
-CredentialNames = Literal['access_token',
+CredentialNames = Literal['access_token', 'stateless_access_token',
                           'magic_link', 'request_sign_up', 'otp']
 
 
@@ -283,12 +331,16 @@ class AuthConfig(TypedDict):
     credential_lifespans: CredentialLifespans
     jwt_algorithm: str
     jwt_secret_key: str
+    stateless_access_tokens: bool
+    revocation_sync_interval: datetime_module.timedelta
 
 
 class AuthConfigFromFile(TypedDict, total=False):
     credential_lifespans: dict[CredentialNames,
                                ISO8601DurationStr]
     jwt_algorithm: str
+    stateless_access_tokens: bool
+    revocation_sync_interval: ISO8601DurationStr
 
 
 class AccessTokenCookieConfig(TypedDict):
@@ -296,6 +348,7 @@ class AccessTokenCookieConfig(TypedDict):
     secure: NotRequired[bool]
     httponly: NotRequired[bool]
     samesite: NotRequired[Literal['lax', 'strict', 'none']]
+    path: NotRequired[str]
 
 
 class AccessTokenCookieConfigFromFile(TypedDict, total=False):
@@ -303,12 +356,43 @@ class AccessTokenCookieConfigFromFile(TypedDict, total=False):
     secure: bool
     httponly: bool
     samesite: Literal['lax', 'strict', 'none']
+    path: str
 
 
 class LoggerConfig(TypedDict, total=False):
     level: Literal['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']
 
 
+CacheNames = Literal['jwt_payloads', 'gallery_permissions']
+
+
+class CacheConfig(TypedDict):
+    maxsize: int
+    ttl: datetime_module.timedelta
+
+
+class CacheConfigFromFile(TypedDict, total=False):
+    maxsize: int
+    ttl: ISO8601DurationStr
+
+
+CachesConfig = dict[CacheNames, CacheConfig]
+
+
+class PurgeConfig(TypedDict):
+    batch_size: int
+    interval: datetime_module.timedelta
+
+
+class PurgeConfigFromFile(TypedDict, total=False):
+    batch_size: int
+    interval: ISO8601DurationStr
+
+
+# 'tree' names directories after galleries, 'id' shards them by gallery and file id
+MediaLayout = Literal['tree', 'id']
+
+
 OpenAPISchemaKeys = Literal['gallery']
 OpenAPISchemaPaths = dict[OpenAPISchemaKeys, Path]
 
@@ -317,10 +401,15 @@ class BackendConfigFromFile(TypedDict, total=False):
     UVICORN: UvicornConfigFromFile
     DB: DbConfigFromFile
     MEDIA_DIR: str
+    MEDIA_LAYOUT: MediaLayout
+    USER_STORAGE_QUOTA: int | None
     GOOGLE_CLIENT_PATH: str
     AUTH: AuthConfigFromFile
     OPENAPI_SCHEMA_PATHS: dict[OpenAPISchemaKeys, os.PathLike[str] | str]
     ACCESS_TOKEN_COOKIE: AccessTokenCookieConfigFromFile
+    REFRESH_TOKEN_COOKIE: AccessTokenCookieConfigFromFile
+    CACHES: dict[CacheNames, CacheConfigFromFile]
+    PURGE: PurgeConfigFromFile
 
 
 EnvVar = Literal[
@@ -1,15 +1,46 @@
 import typing
 import jwt
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from arbor_imago import utils
 from arbor_imago.core import types
-from arbor_imago.core import config
+from arbor_imago.core import config, metrics
+
+
+# a bcrypt check takes a quarter of a second on a Pi, bcrypt releases the GIL, so in threads the event loop keeps
+# serving other requests while logins wait for a worker
+PASSWORD_EXECUTOR = ThreadPoolExecutor(
+    max_workers=min(4, os.cpu_count() or 1), thread_name_prefix='bcrypt')
 
 
 def jwt_encode(payload: dict[str, typing.Any]) -> types.JwtEncodedStr:
-    return jwt.encode(payload, config.BACKEND_SECRETS['JWT_SECRET_KEY'], algorithm=config.BACKEND_SECRETS['JWT_ALGORITHM'])
+    return jwt.encode(payload, config.AUTH['jwt_secret_key'], algorithm=config.AUTH['jwt_algorithm'])
 
 
 def jwt_decode(token: types.JwtEncodedStr) -> dict:
-    return jwt.decode(token, config.BACKEND_SECRETS['JWT_SECRET_KEY'], algorithms=[config.BACKEND_SECRETS['JWT_ALGORITHM']])
+    return jwt.decode(token, config.AUTH['jwt_secret_key'], algorithms=[config.AUTH['jwt_algorithm']])
+
+
+async def _run_on_password_executor[T](function: typing.Callable[..., T], *args: str) -> T:
+
+    metrics.PASSWORD_CHECKS_IN_PROGRESS.inc()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(PASSWORD_EXECUTOR, function, *args)
+    finally:
+        metrics.PASSWORD_CHECKS_IN_PROGRESS.dec()
+
+
+async def check_password(plain_password: str, hashed_password: str) -> bool:
+    """utils.verify_password on the password executor"""
+
+    return await _run_on_password_executor(utils.verify_password, plain_password, hashed_password)
+
+
+async def hash_password(password: str) -> str:
+    """utils.hash_password on the password executor"""
+
+    return await _run_on_password_executor(utils.hash_password, password)
 
 
 def send_email(recipient: types.Email, subject: str, body: str):
@@ -1,4 +1,6 @@
-from sqlmodel import Field, Relationship, SQLModel, PrimaryKeyConstraint, Column
+from sqlmodel import Field, Relationship, SQLModel, PrimaryKeyConstraint, Column, Index, col, func
+from sqlalchemy import String, cast, event
+from sqlalchemy.orm import Mapper
 from pydantic import field_serializer, field_validator, ValidationInfo
 from typing import Optional, Protocol
 import datetime as datetime_module
@@ -8,37 +10,70 @@ from arbor_imago.models.custom_field_types import timestamp
 from arbor_imago.models.bases.auth_credential import AuthCredentialBase
 
 
+@event.listens_for(Mapper, 'mapper_configured')
+def _eager_defaults(mapper: Mapper, class_: type) -> None:
+    # server generated values come back through RETURNING on INSERT and UPDATE, instead of being expired for a later SELECT
+    if class_.__module__ == __name__:
+        mapper.eager_defaults = True
+
+
+def _utc_now() -> datetime_module.datetime:
+    return datetime_module.datetime.now(datetime_module.UTC)
+
+
+def _updated_at_field():
+    # set on every UPDATE, Core ones included, it is the version the read endpoints build their ETags from
+    return Field(default_factory=_utc_now, nullable=False,
+                 sa_type=timestamp.Timestamp, sa_column_kwargs={'onupdate': _utc_now})
+
+
+# Relationships are lazy='raise', load them explicitly, see Service.load_related. Deletes are cascaded by the
+# database through the ondelete foreign keys, passive_deletes keeps the ORM from loading children to delete them.
+# Users and galleries are soft deleted, a deleted_at column hides the row from reads until the purge removes it.
+
+
 class User(SQLModel, table=True):
 
     __tablename__ = 'user'  # type: ignore
 
     id: types.User.id = Field(
         primary_key=True, index=True, unique=True, const=True)
-    email: types.User.email = Field(index=True, unique=True, nullable=False)
+    email: types.User.email = Field(nullable=False)
     phone_number: Optional[types.User.phone_number] = Field(
-        index=True, unique=True, nullable=True, default=None)
+        nullable=True, default=None)
     username: Optional[types.User.username] = Field(
-        index=True, unique=True, nullable=True, default=None)
+        nullable=True, default=None)
     hashed_password: Optional[types.User.hashed_password] = Field(
         nullable=True, default=None)
     user_role_id: types.User.user_role_id = Field(nullable=False)
+    deleted_at: Optional[types.User.deleted_at] = Field(
+        default=None, sa_column=Column(timestamp.Timestamp, nullable=True))
+    updated_at: types.User.updated_at = _updated_at_field()
 
     api_keys: list['ApiKey'] = Relationship(
-        back_populates='user', cascade_delete=True)
+        back_populates='user', cascade_delete=True, passive_deletes=True, sa_relationship_kwargs={'lazy': 'raise'})
     user_access_tokens: list['UserAccessToken'] = Relationship(
-        back_populates='user', cascade_delete=True)
+        back_populates='user', cascade_delete=True, passive_deletes=True, sa_relationship_kwargs={'lazy': 'raise'})
     galleries: list['Gallery'] = Relationship(
-        back_populates='user', cascade_delete=True)
+        back_populates='user', cascade_delete=True, passive_deletes=True, sa_relationship_kwargs={'lazy': 'raise'})
     gallery_permissions: list['GalleryPermission'] = Relationship(
-        back_populates='user', cascade_delete=True)
+        back_populates='user', cascade_delete=True, passive_deletes=True, sa_relationship_kwargs={'lazy': 'raise'})
     otp: 'OTP' = Relationship(
-        back_populates='user', cascade_delete=True)
+        back_populates='user', cascade_delete=True, passive_deletes=True, sa_relationship_kwargs={'lazy': 'raise'})
+
+    __table_args__ = (
+        # named, so violations can be told apart, see User._unique_violation_error
+        Index('uq_user_email', 'email', unique=True),
+        Index('uq_user_phone_number', 'phone_number', unique=True),
+        Index('uq_user_username', 'username', unique=True),
+    )
 
 
 class _AuthCredentialTableBase(AuthCredentialBase):
 
     user_id: types.User.id = Field(
         index=True, foreign_key=str(User.__tablename__) + '.id', const=True, ondelete='CASCADE')
+    updated_at: types.AuthCredential.updated_at = _updated_at_field()
 
 
 class UserAccessToken(_AuthCredentialTableBase, table=True):
@@ -53,7 +88,13 @@ class UserAccessToken(_AuthCredentialTableBase, table=True):
     expiry: types.AuthCredential.expiry = Field(
         sa_column=Column(timestamp.Timestamp))
 
-    user: 'User' = Relationship(back_populates='user_access_tokens')
+    user: 'User' = Relationship(
+        back_populates='user_access_tokens', passive_deletes=True, sa_relationship_kwargs={'lazy': 'raise'})
+
+    __table_args__ = (
+        # list endpoints filter by user and sort/prune by expiry
+        Index('ix_user_access_token_user_id_expiry', 'user_id', 'expiry'),
+    )
 
 
 class OTP(_AuthCredentialTableBase, table=True):
@@ -63,6 +104,10 @@ class OTP(_AuthCredentialTableBase, table=True):
     id: types.OTP.id = Field(
         primary_key=True, index=False, unique=True, const=True)
 
+    # a user has at most one active OTP, looked up by user_id on login
+    user_id: types.User.id = Field(
+        index=True, unique=True, foreign_key=str(User.__tablename__) + '.id', const=True, ondelete='CASCADE')
+
     issued: types.AuthCredential.issued = Field(
         const=True, sa_column=Column(timestamp.Timestamp))
     expiry: types.AuthCredential.expiry = Field(
@@ -70,7 +115,7 @@ class OTP(_AuthCredentialTableBase, table=True):
 
     hashed_code: types.OTP.hashed_code = Field()
     user: 'User' = Relationship(
-        back_populates='otp')
+        back_populates='otp', passive_deletes=True, sa_relationship_kwargs={'lazy': 'raise'})
 
 
 class ApiKey(_AuthCredentialTableBase, table=True):
@@ -86,9 +131,18 @@ class ApiKey(_AuthCredentialTableBase, table=True):
         sa_column=Column(timestamp.Timestamp))
 
     name: types.ApiKey.name = Field()
-    user: 'User' = Relationship(back_populates='api_keys')
+    user: 'User' = Relationship(
+        back_populates='api_keys', passive_deletes=True, sa_relationship_kwargs={'lazy': 'raise'})
     api_key_scopes: list['ApiKeyScope'] = Relationship(
-        back_populates='api_key', cascade_delete=True)
+        back_populates='api_key', cascade_delete=True, passive_deletes=True, sa_relationship_kwargs={'lazy': 'raise'})
+
+    __table_args__ = (
+        # names are unique per user, see ApiKey.is_available and ApiKey._unique_violation_error
+        Index('uq_api_key_user_id_name', 'user_id', 'name', unique=True),
+        # list endpoints filter by user and order by issued/expiry/name
+        Index('ix_api_key_user_id_issued', 'user_id', 'issued'),
+        Index('ix_api_key_user_id_expiry', 'user_id', 'expiry'),
+    )
 
 
 class ApiKeyScope(SQLModel, table=True):
@@ -104,7 +158,8 @@ class ApiKeyScope(SQLModel, table=True):
         PrimaryKeyConstraint('api_key_id', 'scope_id'),
     )
 
-    api_key: 'ApiKey' = Relationship(back_populates='api_key_scopes')
+    api_key: 'ApiKey' = Relationship(
+        back_populates='api_key_scopes', passive_deletes=True, sa_relationship_kwargs={'lazy': 'raise'})
 
 
 class Gallery(SQLModel, table=True):
@@ -114,27 +169,129 @@ class Gallery(SQLModel, table=True):
     id: types.ApiKey.id = Field(
         primary_key=True, index=True, unique=True, const=True)
     name: types.Gallery.name = Field()
-    test: str = Field()
     user_id: types.Gallery.user_id = Field(
         index=True, foreign_key=str(User.__tablename__) + '.id', ondelete='CASCADE')
 
-    visibility_level: types.Gallery.visibility_level = Field()
-    parent_id: types.Gallery.parent_id = Field(nullable=True, index=True,
+    visibility_level: types.Gallery.visibility_level = Field(index=True)
+    parent_id: types.Gallery.parent_id = Field(default=None, nullable=True, index=True,
                                                foreign_key='gallery.id', ondelete='CASCADE')
-    description: types.Gallery.description = Field(nullable=True)
-    date: types.Gallery.date = Field(nullable=True)
+    description: types.Gallery.description = Field(default=None, nullable=True)
+    date: types.Gallery.date = Field(default=None, nullable=True)
+    deleted_at: Optional[types.Gallery.deleted_at] = Field(
+        default=None, sa_column=Column(timestamp.Timestamp, nullable=True))
+    updated_at: types.Gallery.updated_at = _updated_at_field()
 
-    user: 'User' = Relationship(back_populates='galleries')
+    user: 'User' = Relationship(
+        back_populates='galleries', passive_deletes=True, sa_relationship_kwargs={'lazy': 'raise'})
     parent: Optional['Gallery'] = Relationship(
-        back_populates='children', sa_relationship_kwargs={'remote_side': 'Gallery.id'})
+        back_populates='children', passive_deletes=True, sa_relationship_kwargs={'remote_side': 'Gallery.id', 'lazy': 'raise'})
     children: list['Gallery'] = Relationship(
-        back_populates='parent', cascade_delete=True)
+        back_populates='parent', cascade_delete=True, passive_deletes=True, sa_relationship_kwargs={'lazy': 'raise'})
     gallery_permissions: list['GalleryPermission'] = Relationship(
-        back_populates='gallery', cascade_delete=True)
+        back_populates='gallery', cascade_delete=True, passive_deletes=True, sa_relationship_kwargs={'lazy': 'raise'})
     files: list['File'] = Relationship(
-        back_populates='gallery', cascade_delete=True)
+        back_populates='gallery', cascade_delete=True, passive_deletes=True, sa_relationship_kwargs={'lazy': 'raise'})
     image_versions: list['ImageVersion'] = Relationship(
-        back_populates='gallery', cascade_delete=True)
+        back_populates='gallery', cascade_delete=True, passive_deletes=True, sa_relationship_kwargs={'lazy': 'raise'})
+
+    __table_args__ = (
+        # covers Gallery.is_available and, by prefix, Gallery.get_root_gallery
+        Index('ix_gallery_user_id_parent_id_name_date',
+              'user_id', 'parent_id', 'name', 'date'),
+    )
+
+
+# Gallery names are unique per (user_id, parent_id, date), but NULLs are distinct
+# in unique indexes, so coalesce to keep root and undated galleries unique too
+Index('uq_gallery_user_id_parent_id_name_date',
+      col(Gallery.user_id),
+      func.coalesce(col(Gallery.parent_id), ''),
+      col(Gallery.name),
+      func.coalesce(cast(col(Gallery.date), String), ''),
+      unique=True)
+
+
+# the purge looks for soft deleted rows, which are few, so only they are indexed
+Index('ix_user_deleted_at',
+      col(User.deleted_at),
+      sqlite_where=col(User.deleted_at).is_not(None),
+      postgresql_where=col(User.deleted_at).is_not(None))
+Index('ix_gallery_deleted_at',
+      col(Gallery.deleted_at),
+      sqlite_where=col(Gallery.deleted_at).is_not(None),
+      postgresql_where=col(Gallery.deleted_at).is_not(None))
+
+
+class GalleryMove(SQLModel, table=True):
+    """Journal of gallery directory renames, committed with the gallery rows they follow and replayed on startup"""
+
+    __tablename__ = 'gallery_move'  # type: ignore
+
+    # increasing ids keep the order the moves were made in
+    id: Optional[types.GalleryMove.id] = Field(default=None, primary_key=True)
+    gallery_id: types.GalleryMove.gallery_id = Field(
+        index=True, foreign_key=str(Gallery.__tablename__) + '.id', ondelete='CASCADE')
+    src: types.GalleryMove.src = Field()
+    dst: types.GalleryMove.dst = Field()
+
+
+class Revocation(SQLModel, table=True):
+    """Log of revoked user access tokens, shared by the workers, which keep it in memory, see services.revocations
+
+    A row without a user_access_token_id revokes every access token issued to the user before revoked_at.
+    """
+
+    __tablename__ = 'revocation'  # type: ignore
+
+    id: Optional[types.Revocation.id] = Field(default=None, primary_key=True)
+    # no foreign keys, the rows outlive the purge of what they revoke by a few minutes at most
+    user_id: types.Revocation.user_id = Field()
+    user_access_token_id: Optional[types.Revocation.user_access_token_id] = Field(
+        default=None)
+    revoked_at: types.Revocation.revoked_at = Field(
+        default_factory=_utc_now, index=True, sa_type=timestamp.Timestamp)
+
+
+class GalleryPermissionChange(SQLModel, table=True):
+    """Log of the transactions that changed effective gallery permissions, see services.models.gallery_permission
+
+    Its latest id is the version of the permissions, a worker drops its cached permission levels when it changes.
+    """
+
+    __tablename__ = 'gallery_permission_change'  # type: ignore
+
+    id: Optional[types.GalleryPermissionChange.id] = Field(
+        default=None, primary_key=True)
+    changed_at: types.GalleryPermissionChange.changed_at = Field(
+        default_factory=_utc_now, sa_type=timestamp.Timestamp)
+
+
+class GalleryCounter(SQLModel, table=True):
+    """Totals of a gallery kept up to date by the services in the same transaction as the writes, see services.counters"""
+
+    __tablename__ = 'gallery_counter'  # type: ignore
+
+    gallery_id: types.GalleryCounter.gallery_id = Field(
+        primary_key=True, foreign_key=str(Gallery.__tablename__) + '.id', ondelete='CASCADE')
+    file_count: types.GalleryCounter.file_count = Field(default=0)
+    file_size: types.GalleryCounter.file_size = Field(default=0)
+    subtree_file_count: types.GalleryCounter.subtree_file_count = Field(default=0)
+    subtree_file_size: types.GalleryCounter.subtree_file_size = Field(default=0)
+    child_count: types.GalleryCounter.child_count = Field(default=0)
+    updated_at: types.GalleryCounter.updated_at = _updated_at_field()
+
+
+class UserCounter(SQLModel, table=True):
+    """Totals of a user kept up to date by the services in the same transaction as the writes, see services.counters"""
+
+    __tablename__ = 'user_counter'  # type: ignore
+
+    user_id: types.UserCounter.user_id = Field(
+        primary_key=True, foreign_key=str(User.__tablename__) + '.id', ondelete='CASCADE')
+    file_count: types.UserCounter.file_count = Field(default=0)
+    file_size: types.UserCounter.file_size = Field(default=0)
+    api_key_count: types.UserCounter.api_key_count = Field(default=0)
+    user_access_token_count: types.UserCounter.user_access_token_count = Field(default=0)
 
 
 class GalleryPermission(SQLModel,  table=True):
@@ -153,9 +310,9 @@ class GalleryPermission(SQLModel,  table=True):
     permission_level: types.GalleryPermission.permission_level = Field()
 
     gallery: 'Gallery' = Relationship(
-        back_populates='gallery_permissions')
+        back_populates='gallery_permissions', passive_deletes=True, sa_relationship_kwargs={'lazy': 'raise'})
     user: 'User' = Relationship(
-        back_populates='gallery_permissions')
+        back_populates='gallery_permissions', passive_deletes=True, sa_relationship_kwargs={'lazy': 'raise'})
 
 
 class File(SQLModel, table=True):
@@ -165,14 +322,23 @@ class File(SQLModel, table=True):
     id: types.File.id = Field(
         primary_key=True, index=True, unique=True, const=True)
     stem: types.File.stem = Field()
-    suffix: types.File.suffix = Field(nullable=True)
+    suffix: types.File.suffix = Field(default=None, nullable=True)
     gallery_id: types.File.gallery_id = Field(
         index=True, foreign_key=str(Gallery.__tablename__) + '.id', ondelete='CASCADE')
-    size: types.File.size = Field(nullable=True)
+    size: types.File.size = Field(default=None, nullable=True)
 
-    gallery: 'Gallery' = Relationship(back_populates='files')
+    gallery: 'Gallery' = Relationship(
+        back_populates='files', passive_deletes=True, sa_relationship_kwargs={'lazy': 'raise'})
     image_file_metadata: Optional['ImageFileMetadata'] = Relationship(
-        back_populates='file', cascade_delete=True)
+        back_populates='file', cascade_delete=True, passive_deletes=True, sa_relationship_kwargs={'lazy': 'raise'})
+
+
+# a gallery holds one file per name, the tree layout stores the bytes under it, NULL suffixes coalesced as above
+Index('uq_file_gallery_id_stem_suffix',
+      col(File.gallery_id),
+      col(File.stem),
+      func.coalesce(col(File.suffix), ''),
+      unique=True)
 
 
 class ImageVersion(SQLModel, table=True):
@@ -182,29 +348,29 @@ class ImageVersion(SQLModel, table=True):
     id: types.ImageVersion.id = Field(
         primary_key=True, index=True, unique=True, const=True)
     base_name: types.ImageVersion.base_name = Field(
-        nullable=True, index=True)
+        default=None, nullable=True, index=True)
     parent_id: types.ImageVersion.parent_id = Field(
-        nullable=True, index=True, foreign_key='image_version.id', ondelete='SET NULL')
+        default=None, nullable=True, index=True, foreign_key='image_version.id', ondelete='SET NULL')
 
     # BW, Edit1, etc. Original version is null
-    version: types.ImageVersion.version = Field(nullable=True)
+    version: types.ImageVersion.version = Field(default=None, nullable=True)
     gallery_id: types.ImageVersion.gallery_id = Field(
         index=True, foreign_key=str(Gallery.__tablename__) + '.id', ondelete='CASCADE')
-    datetime: types.ImageVersion.datetime = Field(nullable=True)
-    description: types.ImageVersion.description = Field(nullable=True)
-    aspect_ratio: types.ImageVersion.aspect_ratio = Field(nullable=True)
+    datetime: types.ImageVersion.datetime = Field(default=None, nullable=True)
+    description: types.ImageVersion.description = Field(default=None, nullable=True)
+    aspect_ratio: types.ImageVersion.aspect_ratio = Field(default=None, nullable=True)
     average_color: types.ImageVersion.average_color = Field(
-        nullable=True)
+        default=None, nullable=True)
 
     parent: Optional['ImageVersion'] = Relationship(
-        back_populates='children', sa_relationship_kwargs={'remote_side': 'ImageVersion.id'})
+        back_populates='children', passive_deletes=True, sa_relationship_kwargs={'remote_side': 'ImageVersion.id', 'lazy': 'raise'})
     children: list['ImageVersion'] = Relationship(
-        back_populates='parent')
+        back_populates='parent', passive_deletes=True, sa_relationship_kwargs={'lazy': 'raise'})
 
     image_file_metadatas: list['ImageFileMetadata'] = Relationship(
-        back_populates='version')
+        back_populates='version', passive_deletes=True, sa_relationship_kwargs={'lazy': 'raise'})
     gallery: 'Gallery' = Relationship(
-        back_populates='image_versions')
+        back_populates='image_versions', passive_deletes=True, sa_relationship_kwargs={'lazy': 'raise'})
 
 
 class ImageFileMetadata(SQLModel, table=True):
@@ -216,9 +382,9 @@ class ImageFileMetadata(SQLModel, table=True):
     version_id: types.ImageFileMetadata.version_id = Field(
         index=True, foreign_key=str(ImageVersion.__tablename__) + '.id', ondelete='CASCADE')
     scale: Optional[types.ImageFileMetadata.scale] = Field(
-        nullable=True, ge=1, le=99)
+        default=None, nullable=True, ge=1, le=99)
 
     version: 'ImageVersion' = Relationship(
-        back_populates='image_file_metadatas')
+        back_populates='image_file_metadatas', passive_deletes=True, sa_relationship_kwargs={'lazy': 'raise'})
     file: 'File' = Relationship(
-        back_populates='image_file_metadata')
+        back_populates='image_file_metadata', passive_deletes=True, sa_relationship_kwargs={'lazy': 'raise'})
@@ -1,7 +1,7 @@
-from arbor_imago import core
-from arbor_imago.core import utils, config, types
+from arbor_imago.core import utils, config, types, dependencies
 from arbor_imago.models.tables import ApiKey as ApiKeyTable
 from arbor_imago.services.models.api_key import ApiKey as ApiKeyService
+from arbor_imago.services import counters
 from arbor_imago.schemas import api_key as api_key_schema, pagination as pagination_schema, api as api_schema, order_by as order_by_schema
 from arbor_imago.routers import user as user_router, base
 from arbor_imago.auth import utils as auth_utils
@@ -50,31 +50,39 @@ class ApiKeyRouter(_Base):
     @classmethod
     async def list(
         cls,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
             auth_utils.make_get_auth_dependency())],
         pagination: Annotated[pagination_schema.Pagination, Depends(PAGINATION)],
         order_bys: Annotated[list[order_by_schema.OrderBy[types.ApiKey.order_by]], Depends(
             _Base.order_by_depends)],
+        conditional: base.ConditionalDepends = None
     ) -> list[api_key_schema.ApiKeyPrivate]:
 
-        return [api_key_schema.ApiKeyPrivate.model_validate(api_key) for api_key in await cls._get_many({
+        # the service only lists the authorized user's own keys
+        return await cls._get_many_projected({
             'authorization': authorization,
+            'session': session,
+            'conditional': conditional,
             'order_bys': order_bys,
             'pagination': pagination,
-            'query': select(ApiKeyTable).where(ApiKeyTable.user_id == authorization._user_id)
-        })]
+        }, api_key_schema.ApiKeyPrivate)
 
     @classmethod
     async def by_id(
         cls,
         api_key_id: types.ApiKey.id,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
-            auth_utils.make_get_auth_dependency())]
+            auth_utils.make_get_auth_dependency())],
+        conditional: base.ConditionalDepends = None
     ) -> api_key_schema.ApiKeyPrivate:
 
         return api_key_schema.ApiKeyPrivate.model_validate(
             await cls._get({
                 'authorization': authorization,
+                'session': session,
+                'conditional': conditional,
                 'id': api_key_id,
             })
         )
@@ -83,6 +91,7 @@ class ApiKeyRouter(_Base):
     async def create(
         cls,
         api_key_create: api_key_schema.ApiKeyCreate,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
             auth_utils.make_get_auth_dependency())]
     ) -> api_key_schema.ApiKeyPrivate:
@@ -90,6 +99,7 @@ class ApiKeyRouter(_Base):
         return api_key_schema.ApiKeyPrivate.model_validate(
             await cls._post({
                 'authorization': authorization,
+                'session': session,
                 'create_model': api_key_schema.ApiKeyAdminCreate(
                     **api_key_create.model_dump(
                         exclude_unset=True),
@@ -103,6 +113,7 @@ class ApiKeyRouter(_Base):
         cls,
         api_key_id: types.ApiKey.id,
         api_key_update: api_key_schema.ApiKeyUpdate,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
             auth_utils.make_get_auth_dependency())]
     ) -> api_key_schema.ApiKeyPrivate:
@@ -110,6 +121,7 @@ class ApiKeyRouter(_Base):
         return api_key_schema.ApiKeyPrivate.model_validate(
             await cls._patch({
                 'authorization': authorization,
+                'session': session,
                 'id': api_key_id,
                 'update_model': api_key_schema.ApiKeyAdminUpdate(
                     **api_key_update.model_dump(exclude_unset=True))
@@ -120,12 +132,14 @@ class ApiKeyRouter(_Base):
     async def delete(
         cls,
         api_key_id: types.ApiKey.id,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
             auth_utils.make_get_auth_dependency())]
     ):
 
         return await cls._delete({
             'authorization': authorization,
+            'session': session,
             'id': api_key_id,
         })
 
@@ -133,12 +147,14 @@ class ApiKeyRouter(_Base):
     async def jwt(
         cls,
         api_key_id: types.ApiKey.id,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
             auth_utils.make_get_auth_dependency())]
     ) -> ApiKeyJWTResponse:
 
         api_key = await cls._get({
             'authorization': authorization,
+            'session': session,
             'id': api_key_id,
         })
 
@@ -148,35 +164,40 @@ class ApiKeyRouter(_Base):
     @classmethod
     async def check_availability(
         cls,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
             auth_utils.make_get_auth_dependency())],
         api_key_available: api_key_schema.ApiKeyAvailable = Depends(),
     ) -> api_schema.IsAvailableResponse:
-        async with core.ASYNC_SESSIONMAKER() as session:
-            return api_schema.IsAvailableResponse(
-                available=await ApiKeyService.is_available(
-                    session, api_key_schema.ApiKeyAdminAvailable(
-                        **api_key_available.model_dump(exclude_unset=True),
-                        user_id=cast(types.User.id,
-                                     authorization._user_id)
-                    )
+        return api_schema.IsAvailableResponse(
+            available=await ApiKeyService.is_available(
+                session, api_key_schema.ApiKeyAdminAvailable(
+                    **api_key_available.model_dump(exclude_unset=True),
+                    user_id=cast(types.User.id,
+                                 authorization._user_id)
                 )
             )
+        )
 
     @classmethod
     async def count(
         cls,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
             auth_utils.make_get_auth_dependency())],
     ) -> int:
-        async with core.ASYNC_SESSIONMAKER() as session:
-            query = select(func.count()).select_from(ApiKeyTable).where(
-                ApiKeyTable.user_id == authorization._user_id)
-            return (await session.exec(query)).one()
+        counter = await counters.fetch_user(session, cast(types.User.id, authorization._user_id))
+        if counter is not None:
+            return counter.api_key_count
+
+        # not counted yet, see counters.rebuild
+        query = select(func.count()).select_from(ApiKeyTable).where(
+            ApiKeyTable.user_id == authorization._user_id)
+        return (await session.exec(query)).one()
 
     def _set_routes(self):
 
-        self.router.get('/')(self.list)
+        self.router.get('/')(base.json_route(self.list))
         self.router.get('/{api_key_id}')(self.by_id)
         self.router.post('/')(self.create)
         self.router.patch('/{api_key_id}')(self.update)
@@ -195,32 +216,39 @@ class ApiKeyAdminRouter(_Base):
     async def list_by_user(
         cls,
         user_id: types.User.id,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
             auth_utils.make_get_auth_dependency(required_scopes={'admin'}))],
         pagination: Annotated[pagination_schema.Pagination, Depends(PAGINATION)],
         order_bys: Annotated[list[order_by_schema.OrderBy[types.ApiKey.order_by]], Depends(
-            _Base.order_by_depends)]
-
+            _Base.order_by_depends)],
+        conditional: base.ConditionalDepends = None
     ) -> list[api_key_schema.ApiKeyPrivate]:
 
-        return [api_key_schema.ApiKeyPrivate.model_validate(api_key) for api_key in await cls._get_many(
+        return await cls._get_many_projected(
             {
                 'authorization': authorization,
+                'session': session,
+                'conditional': conditional,
                 'order_bys': order_bys,
                 'pagination': pagination,
-                'query': select(ApiKeyTable).where(ApiKeyTable.user_id == authorization._user_id)})]
+                'query': select(ApiKeyTable).where(ApiKeyTable.user_id == user_id)}, api_key_schema.ApiKeyPrivate)
 
     @classmethod
     async def by_id(
         cls,
         api_key_id: types.ApiKey.id,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
-            auth_utils.make_get_auth_dependency(required_scopes={'admin'}))]
+            auth_utils.make_get_auth_dependency(required_scopes={'admin'}))],
+        conditional: base.ConditionalDepends = None
     ) -> api_key_schema.ApiKeyPrivate:
 
         return api_key_schema.ApiKeyPrivate.model_validate(
             await cls._get({
                 'authorization': authorization,
+                'session': session,
+                'conditional': conditional,
                 'id': api_key_id,
             })
         )
@@ -229,6 +257,7 @@ class ApiKeyAdminRouter(_Base):
     async def create(
         cls,
         api_key_create_admin: api_key_schema.ApiKeyAdminCreate,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
             auth_utils.make_get_auth_dependency(required_scopes={'admin'}))]
     ) -> api_key_schema.ApiKeyPrivate:
@@ -236,6 +265,7 @@ class ApiKeyAdminRouter(_Base):
         return api_key_schema.ApiKeyPrivate.model_validate(
             await cls._post({
                 'authorization': authorization,
+                'session': session,
                 'create_model': api_key_create_admin
             })
         )
@@ -245,6 +275,7 @@ class ApiKeyAdminRouter(_Base):
         cls,
         api_key_id: types.ApiKey.id,
         api_key_update_admin: api_key_schema.ApiKeyAdminUpdate,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
             auth_utils.make_get_auth_dependency(required_scopes={'admin'}))]
     ) -> api_key_schema.ApiKeyPrivate:
@@ -253,6 +284,7 @@ class ApiKeyAdminRouter(_Base):
             await
             cls._patch({
                 'authorization': authorization,
+                'session': session,
                 'id': api_key_id,
                 'update_model': api_key_update_admin
             })
@@ -262,34 +294,36 @@ class ApiKeyAdminRouter(_Base):
     async def delete(
         cls,
         api_key_id: types.ApiKey.id,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
             auth_utils.make_get_auth_dependency(required_scopes={'admin'}))]
     ):
 
         return await cls._delete({
             'authorization': authorization,
+            'session': session,
             'id': api_key_id,
         })
 
     @classmethod
     async def check_availability(
         cls,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
             auth_utils.make_get_auth_dependency(required_scopes={'admin'}))],
         api_key_available_admin: api_key_schema.ApiKeyAdminAvailable = Depends(),
     ):
 
-        async with core.ASYNC_SESSIONMAKER() as session:
-            return api_schema.IsAvailableResponse(
-                available=await ApiKeyService.is_available(
-                    session, api_key_available_admin
-                )
+        return api_schema.IsAvailableResponse(
+            available=await ApiKeyService.is_available(
+                session, api_key_available_admin
             )
+        )
 
     def _set_routes(self):
 
         self.router.get(
-            '/users/{user_id}/', tags=[user_router._Base._TAG])(self.list_by_user)
+            '/users/{user_id}/', tags=[user_router._Base._TAG])(base.json_route(self.list_by_user))
         self.router.get('/{api_key_id}')(self.by_id)
         self.router.post('/')(self.create)
         self.router.patch('/{api_key_id}')(self.update)
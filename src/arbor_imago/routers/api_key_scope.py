@@ -1,7 +1,7 @@
-from fastapi import Depends, status, HTTPException
+from fastapi import Depends, status, HTTPException, Body, Query
 from typing import Annotated
 
-from arbor_imago.core import types
+from arbor_imago.core import types, dependencies
 from arbor_imago.routers import base
 from arbor_imago.models.tables import ApiKeyScope as ApiKeyScopeTable
 from arbor_imago.services.models.api_key_scope import ApiKeyScope as ApiKeyScopeService
@@ -33,12 +33,14 @@ class ApiKeyScopeRouter(_Base):
         cls,
         api_key_id: types.ApiKey.id,
         scope_id: types.Scope.id,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
             auth_utils.make_get_auth_dependency())]
     ) -> None:
         try:
             await cls._post({
                 'authorization': authorization,
+                'session': session,
                 'create_model': api_key_scope_schema.ApiKeyScopeAdminCreate(
                     api_key_id=api_key_id, scope_id=scope_id),
             })
@@ -53,12 +55,14 @@ class ApiKeyScopeRouter(_Base):
         cls,
         api_key_id: types.ApiKey.id,
         scope_id: types.Scope.id,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
             auth_utils.make_get_auth_dependency())]
     ) -> None:
         try:
             await cls._delete({
                 'authorization': authorization,
+                'session': session,
                 'id': types.ApiKeyScope.id(
                     api_key_id=api_key_id, scope_id=scope_id),
             })
@@ -68,12 +72,48 @@ class ApiKeyScopeRouter(_Base):
                 detail=e.error_message
             ) from e
 
+    @classmethod
+    async def add_scopes_to_api_key(
+        cls,
+        api_key_id: types.ApiKey.id,
+        scope_ids: Annotated[list[types.Scope.id], Body(max_length=base.BATCH_MAX_LENGTH)],
+        session: dependencies.SessionDepends,
+        authorization: Annotated[auth_utils.GetAuthReturn, Depends(
+            auth_utils.make_get_auth_dependency())]
+    ) -> None:
+        await cls._post_many({
+            'authorization': authorization,
+            'session': session,
+            'create_models': [api_key_scope_schema.ApiKeyScopeAdminCreate(
+                api_key_id=api_key_id, scope_id=scope_id) for scope_id in scope_ids],
+        })
+
+    @classmethod
+    async def remove_scopes_from_api_key(
+        cls,
+        api_key_id: types.ApiKey.id,
+        scope_ids: Annotated[list[types.Scope.id], Query(max_length=base.BATCH_MAX_LENGTH)],
+        session: dependencies.SessionDepends,
+        authorization: Annotated[auth_utils.GetAuthReturn, Depends(
+            auth_utils.make_get_auth_dependency())]
+    ) -> None:
+        await cls._delete_many({
+            'authorization': authorization,
+            'session': session,
+            'ids': [types.ApiKeyScope.id(
+                api_key_id=api_key_id, scope_id=scope_id) for scope_id in scope_ids],
+        })
+
     def _set_routes(self):
 
         self.router.post(
             '/api-keys/{api_key_id}/scopes/{scope_id}')(self.add_scope_to_api_key)
         self.router.delete('/api-keys/{api_key_id}/scopes/{scope_id}',
                            status_code=status.HTTP_204_NO_CONTENT)(self.remove_scope_from_api_key)
+        self.router.post(
+            '/api-keys/{api_key_id}/scopes/')(self.add_scopes_to_api_key)
+        self.router.delete('/api-keys/{api_key_id}/scopes/',
+                           status_code=status.HTTP_204_NO_CONTENT)(self.remove_scopes_from_api_key)
 
 
 class ApiKeyScopeAdminRouter(_Base):
@@ -85,11 +125,13 @@ class ApiKeyScopeAdminRouter(_Base):
         cls,
         api_key_id: types.ApiKey.id,
         scope_id: types.Scope.id,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
             auth_utils.make_get_auth_dependency(required_scopes={'admin'}))]
     ) -> None:
         api_key_scope = await cls._post({
             'authorization': authorization,
+            'session': session,
             'create_model': api_key_scope_schema.ApiKeyScopeAdminCreate(
                 api_key_id=api_key_id, scope_id=scope_id),
         })
@@ -99,18 +141,56 @@ class ApiKeyScopeAdminRouter(_Base):
         cls,
         api_key_id: types.ApiKey.id,
         scope_id: types.Scope.id,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
             auth_utils.make_get_auth_dependency(required_scopes={'admin'}))]
     ) -> None:
         await cls._delete({
             'authorization': authorization,
+            'session': session,
             'id': types.ApiKeyScope.id(
                 api_key_id=api_key_id, scope_id=scope_id),
         })
 
+    @classmethod
+    async def add_scopes_to_api_key(
+        cls,
+        api_key_id: types.ApiKey.id,
+        scope_ids: Annotated[list[types.Scope.id], Body(max_length=base.BATCH_MAX_LENGTH)],
+        session: dependencies.SessionDepends,
+        authorization: Annotated[auth_utils.GetAuthReturn, Depends(
+            auth_utils.make_get_auth_dependency(required_scopes={'admin'}))]
+    ) -> None:
+        await cls._post_many({
+            'authorization': authorization,
+            'session': session,
+            'create_models': [api_key_scope_schema.ApiKeyScopeAdminCreate(
+                api_key_id=api_key_id, scope_id=scope_id) for scope_id in scope_ids],
+        })
+
+    @classmethod
+    async def remove_scopes_from_api_key(
+        cls,
+        api_key_id: types.ApiKey.id,
+        scope_ids: Annotated[list[types.Scope.id], Query(max_length=base.BATCH_MAX_LENGTH)],
+        session: dependencies.SessionDepends,
+        authorization: Annotated[auth_utils.GetAuthReturn, Depends(
+            auth_utils.make_get_auth_dependency(required_scopes={'admin'}))]
+    ) -> None:
+        await cls._delete_many({
+            'authorization': authorization,
+            'session': session,
+            'ids': [types.ApiKeyScope.id(
+                api_key_id=api_key_id, scope_id=scope_id) for scope_id in scope_ids],
+        })
+
     def _set_routes(self):
 
         self.router.post(
             '/api-keys/{api_key_id}/scopes/{scope_id}')(self.add_scope_to_api_key)
         self.router.delete('/api-keys/{api_key_id}/scopes/{scope_id}',
                            status_code=status.HTTP_204_NO_CONTENT)(self.remove_scope_from_api_key)
+        self.router.post(
+            '/api-keys/{api_key_id}/scopes/')(self.add_scopes_to_api_key)
+        self.router.delete('/api-keys/{api_key_id}/scopes/',
+                           status_code=status.HTTP_204_NO_CONTENT)(self.remove_scopes_from_api_key)
@@ -1,28 +1,29 @@
-from arbor_imago import core
-from arbor_imago.core import utils
+from arbor_imago.core import utils, dependencies
 from arbor_imago.auth import utils as auth_utils, exceptions as auth_exceptions
 from arbor_imago.core import config, types
 from arbor_imago.schemas import user_access_token as user_access_token_schema, user as user_schema, api as api_schema, sign_up as sign_up_schema
 from arbor_imago.models.tables import User, UserAccessToken
 from arbor_imago.models.models import SignUp
-from arbor_imago.services.models import auth_credential as auth_credential_service
+from arbor_imago.services.models import auth_credential as auth_credential_service, base as base_service
 from arbor_imago.services.models.user import User as UserService
 from arbor_imago.services.models.user_access_token import UserAccessToken as UserAccessTokenService
 from arbor_imago.routers import base
 
-import httpx
 from fastapi import Depends, Request, Response, Form, status, BackgroundTasks, HTTPException
 from sqlmodel import select
 from pydantic import BaseModel
 from typing import Annotated, cast
 
-from google.oauth2 import id_token
-from google.auth.transport import requests as google_requests
-
 
 class TokenResponse(BaseModel):
     access_token: types.JwtEncodedStr
     token_type: str
+    refresh_token: types.JwtEncodedStr | None = None
+
+
+class RefreshRequest(BaseModel):
+    # clients without cookies send the refresh token in the body
+    refresh_token: types.JwtEncodedStr | None = None
 
 
 class LoginWithPasswordResponse(auth_utils.GetUserSessionInfoNestedReturn):
@@ -96,91 +97,87 @@ class AuthRouter(base.Router):
     @classmethod
     async def auth_root(
         cls,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
             auth_utils.make_get_auth_dependency(raise_exceptions=False))]
     ) -> auth_utils.GetUserSessionInfoNestedReturn:
-        return auth_utils.get_user_session_info(authorization)
+        return await auth_utils.get_user_session_info(authorization, session)
 
     @classmethod
     async def token(
         cls,
         user: Annotated[User, Depends(auth_utils.make_authenticate_user_with_username_and_password_dependency())],
+        session: dependencies.SessionDepends,
         response: Response,
         stay_signed_in: bool = Form(False)
     ) -> TokenResponse:
-        async with core.ASYNC_SESSIONMAKER() as session:
-
-            user_access_token = await UserAccessTokenService.create({
-                'session': session,
-                'admin': False,
-                'create_model': user_access_token_schema.UserAccessTokenAdminCreate(
-                    user_id=user.id,
-                    expiry=auth_credential_service.lifespan_to_expiry(config.AUTH[
-                        'credential_lifespans']['access_token']),
-                ),
-                'authorized_user_id': user.id,
-            })
-
-            encoded_jwt = utils.jwt_encode(
-                cast(dict, UserAccessTokenService.to_jwt_payload(user_access_token)))
+        user_access_token = await UserAccessTokenService.create({
+            'session': session,
+            'admin': False,
+            'create_model': user_access_token_schema.UserAccessTokenAdminCreate(
+                user_id=user.id,
+                expiry=auth_credential_service.lifespan_to_expiry(config.AUTH[
+                    'credential_lifespans']['access_token']),
+            ),
+            'authorized_user_id': user.id,
+        })
 
-            auth_utils.set_access_token_cookie(response, encoded_jwt, None if not stay_signed_in else auth_credential_service.lifespan_to_expiry(
-                config.AUTH['credential_lifespans']['access_token']))
-            return TokenResponse(access_token=encoded_jwt, token_type='bearer')
+        issued_tokens = auth_utils.issue_tokens(response, user_access_token, user, None if not stay_signed_in else auth_credential_service.lifespan_to_expiry(
+            config.AUTH['credential_lifespans']['access_token']))
+        return TokenResponse(access_token=issued_tokens.access_token, token_type='bearer', refresh_token=issued_tokens.refresh_token)
 
     @classmethod
     async def login_password(
         cls,
         user: Annotated[User, Depends(auth_utils.make_authenticate_user_with_username_and_password_dependency())],
+        session: dependencies.SessionDepends,
         response: Response,
         request: Request,
         stay_signed_in: bool = Form(False)
     ) -> LoginWithPasswordResponse:
 
-        async with core.ASYNC_SESSIONMAKER() as session:
-
-            tokken_lifespan = config.AUTH['credential_lifespans']['access_token']
-
-            user_access_token = await UserAccessTokenService.create({
-                'session': session,
-                'admin': False,
-                'authorized_user_id': user.id,
-                'create_model': user_access_token_schema.UserAccessTokenAdminCreate(
-                    user_id=user.id,
-                    expiry=auth_credential_service.lifespan_to_expiry(config.AUTH[
-                        'credential_lifespans']['access_token']),
-                ),
-            })
+        tokken_lifespan = config.AUTH['credential_lifespans']['access_token']
 
-            encoded_jwt = utils.jwt_encode(
-                cast(dict, UserAccessTokenService.to_jwt_payload(user_access_token)))
+        user_access_token = await UserAccessTokenService.create({
+            'session': session,
+            'admin': False,
+            'authorized_user_id': user.id,
+            'create_model': user_access_token_schema.UserAccessTokenAdminCreate(
+                user_id=user.id,
+                expiry=auth_credential_service.lifespan_to_expiry(config.AUTH[
+                    'credential_lifespans']['access_token']),
+            ),
+        })
 
-            auth_utils.set_access_token_cookie(response, encoded_jwt, None if not stay_signed_in else auth_credential_service.lifespan_to_expiry(
-                config.AUTH['credential_lifespans']['access_token']))
+        auth_utils.issue_tokens(response, user_access_token, user, None if not stay_signed_in else auth_credential_service.lifespan_to_expiry(
+            config.AUTH['credential_lifespans']['access_token']))
 
-            user_private = user_schema.UserPrivate.model_validate(user)
+        user_private = user_schema.UserPrivate.model_validate(user)
 
-            return LoginWithPasswordResponse(
-                auth=auth_utils.GetUserSessionInfoReturn(
-                    user=user_schema.UserPrivate.model_validate(
-                        user),
-                    scope_ids=set(
-                        config.USER_ROLE_ID_SCOPE_IDS[user.user_role_id]),
-                    access_token=user_access_token_schema.UserAccessTokenPublic.model_validate(
-                        user_access_token),
-                ))
+        return LoginWithPasswordResponse(
+            auth=auth_utils.GetUserSessionInfoReturn(
+                user=user_schema.UserPrivate.model_validate(
+                    user),
+                scope_ids=set(
+                    config.USER_ROLE_ID_SCOPE_IDS[user.user_role_id]),
+                access_token=user_access_token_schema.UserAccessTokenPublic.model_validate(
+                    user_access_token),
+            ))
 
     @classmethod
     async def login_magic_link(
         cls,
+        session: dependencies.SessionDepends,
         response: Response,
         model: LoginWithMagicLinkRequest
     ) -> LoginWithMagicLinkResponse:
 
         authorization = await auth_utils.get_auth_from_auth_credential_jwt(
             token=model.token,
+            session=session,
             permitted_types={'access_token'},
-            override_lifetime=config.AUTH['credential_lifespans']['magic_link']
+            override_lifetime=config.AUTH['credential_lifespans']['magic_link'],
+            permit_stateless=False
         )
 
         if authorization.exception:
@@ -189,7 +186,7 @@ class AuthRouter(base.Router):
         auth_credential = cast(
             UserAccessToken, authorization.auth_credential)
 
-        async with core.ASYNC_SESSIONMAKER() as session:
+        async with base_service.unit_of_work(session):
             token_lifespan = config.AUTH['credential_lifespans']['access_token']
             user_access_token = await UserAccessTokenService.create(
                 {
@@ -204,12 +201,16 @@ class AuthRouter(base.Router):
                 }
             )
 
-            auth_utils.set_access_token_cookie(response, utils.jwt_encode(
-                dict(UserAccessTokenService.to_jwt_payload(user_access_token))), expiry=auth_credential_service.lifespan_to_expiry(token_lifespan))
-
             # one time link, delete the auth_credential
-            await session.delete(auth_credential)
-            await session.commit()
+            await UserAccessTokenService.delete({
+                'session': session,
+                'admin': True,
+                'authorized_user_id': auth_credential.user_id,
+                'id': auth_credential.id,
+            })
+
+        auth_utils.issue_tokens(response, user_access_token, cast(user_schema.UserPrivate, authorization.user),
+                                expiry=auth_credential_service.lifespan_to_expiry(token_lifespan))
 
         return LoginWithMagicLinkResponse(
             auth=auth_utils.GetUserSessionInfoReturn(
@@ -226,47 +227,50 @@ class AuthRouter(base.Router):
     @classmethod
     async def login_otp_email(
         cls,
+        session: dependencies.SessionDepends,
         model: LoginWithOTPEmailRequest,
         response: Response
     ) -> auth_utils.LoginWithOTPResponse:
 
-        async with core.ASYNC_SESSIONMAKER() as session:
-            user = (await session.exec(select(User).where(
-                User.email == model.email))).one_or_none()
-            return await auth_utils.login_otp(session, user, response, model.code)
+        user = (await session.exec(select(User).where(
+            User.email == model.email))).one_or_none()
+        return await auth_utils.login_otp(session, user, response, model.code)
 
     @classmethod
     async def login_otp_phone_number(
         cls,
+        session: dependencies.SessionDepends,
         model: LoginWithOTPPhoneNumberRequest,
         response: Response
     ) -> auth_utils.LoginWithOTPResponse:
 
-        async with core.ASYNC_SESSIONMAKER() as session:
-            user = (await session.exec(select(User).where(
-                User.phone_number == model.phone_number))).one_or_none()
-            return await auth_utils.login_otp(session, user, response, model.code)
+        user = (await session.exec(select(User).where(
+            User.phone_number == model.phone_number))).one_or_none()
+        return await auth_utils.login_otp(session, user, response, model.code)
 
     @classmethod
-    async def signup(cls, response: Response, model: SignUpRequest) -> SignUpResponse:
+    async def signup(cls, session: dependencies.SessionDepends, response: Response, model: SignUpRequest) -> SignUpResponse:
 
         authorization = await auth_utils.get_auth_from_auth_credential_jwt(
             token=model.token,
+            session=session,
             permitted_types={'sign_up'},
             override_lifetime=config.AUTH['credential_lifespans']['request_sign_up'])
 
         # double check the user doesn't already exist
-        async with core.ASYNC_SESSIONMAKER() as session:
-
-            if (await session.exec(select(User).where(
-                    User.email == cast(SignUp, authorization.auth_credential).email))).one_or_none() is not None:
-                raise auth_exceptions.Base(
-                    status.HTTP_409_CONFLICT,
-                    'User already exists',
-                    logout=False
-                )
+        if (await session.exec(select(User).where(
+                User.email == cast(SignUp, authorization.auth_credential).email))).one_or_none() is not None:
+            raise auth_exceptions.Base(
+                status.HTTP_409_CONFLICT,
+                'User already exists',
+                logout=False
+            )
 
-        async with core.ASYNC_SESSIONMAKER() as session:
+        token_expiry = auth_credential_service.lifespan_to_expiry(
+            config.AUTH['credential_lifespans']['access_token'])
+
+        # the user and their first access token are committed together
+        async with base_service.unit_of_work(session):
             sign_up = cast(SignUp,
                            authorization.auth_credential)
 
@@ -277,24 +281,18 @@ class AuthRouter(base.Router):
                 'authorized_user_id': authorization._user_id,
             })
 
-        token_expiry = auth_credential_service.lifespan_to_expiry(
-            config.AUTH['credential_lifespans']['access_token'])
-
-        user_access_token = await UserAccessTokenService.create({
-            'session': session,
-            'admin': False,
-            'authorized_user_id': user.id,
-            'create_model': user_access_token_schema.UserAccessTokenAdminCreate(
-                user_id=user.id,
-                expiry=token_expiry
-            )
-        })
+            user_access_token = await UserAccessTokenService.create({
+                'session': session,
+                'admin': False,
+                'authorized_user_id': user.id,
+                'create_model': user_access_token_schema.UserAccessTokenAdminCreate(
+                    user_id=user.id,
+                    expiry=token_expiry
+                )
+            })
 
-        auth_utils.set_access_token_cookie(
-            response,
-            utils.jwt_encode(
-                cast(dict, UserAccessTokenService.to_jwt_payload(user_access_token))),
-            expiry=token_expiry)
+        auth_utils.issue_tokens(
+            response, user_access_token, user, expiry=token_expiry)
 
         return SignUpResponse(
             auth=auth_utils.GetUserSessionInfoReturn(
@@ -307,15 +305,22 @@ class AuthRouter(base.Router):
         )
 
     @classmethod
-    async def login_google(cls, request_token: LoginWithGoogleRequest, response: Response) -> LoginWithGoogleResponse:
+    async def login_google(cls, session: dependencies.SessionDepends, request_token: LoginWithGoogleRequest, response: Response) -> LoginWithGoogleResponse:
 
-        # Verify the ID token
+        # google-auth is slow to import and only needed here
+        from arbor_imago.auth import google as google_auth
+
+        # Verify the ID token, against certificates cached in memory
         try:
-            idinfo = id_token.verify_oauth2_token(
+            idinfo = await google_auth.verify_id_token(
                 request_token.id_token,  # <-- Make sure your frontend sends the ID token!
-                google_requests.Request(),
                 config.GOOGLE_CLIENT_ID
             )
+        except google_auth.CertificatesUnavailableError:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Google ID tokens cannot be verified right now"
+            )
         except ValueError:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
@@ -331,8 +336,7 @@ class AuthRouter(base.Router):
                 logout=False
             )
 
-        async with core.ASYNC_SESSIONMAKER() as session:
-
+        async with base_service.unit_of_work(session):
             user = await UserService.fetch_by_email(session=session, email=email)
 
             if user is None:
@@ -354,106 +358,121 @@ class AuthRouter(base.Router):
                 'session': session
             })
 
-            auth_utils.set_access_token_cookie(
-                response,
-                utils.jwt_encode(
-                    cast(dict, UserAccessTokenService.to_jwt_payload(user_access_token))),
-            )
+        auth_utils.issue_tokens(response, user_access_token, user)
 
-            return LoginWithGoogleResponse(
-                auth=auth_utils.GetUserSessionInfoReturn(
-                    user=user_schema.UserPrivate.model_validate(
-                        user),
-                    scope_ids=config.USER_ROLE_ID_SCOPE_IDS[user.user_role_id],
-                    access_token=user_access_token_schema.UserAccessTokenPublic.model_validate(
-                        user_access_token
-                    )
+        return LoginWithGoogleResponse(
+            auth=auth_utils.GetUserSessionInfoReturn(
+                user=user_schema.UserPrivate.model_validate(
+                    user),
+                scope_ids=config.USER_ROLE_ID_SCOPE_IDS[user.user_role_id],
+                access_token=user_access_token_schema.UserAccessTokenPublic.model_validate(
+                    user_access_token
                 )
             )
+        )
 
     @classmethod
     async def request_sign_up_email(
         cls,
+        session: dependencies.SessionDepends,
         model: RequestSignUpEmailRequest,
         background_tasks: BackgroundTasks
     ):
 
-        async with core.ASYNC_SESSIONMAKER() as session:
-            user = (await session.exec(select(User).where(
-                User.email == model.email))).one_or_none()
-            background_tasks.add_task(
-                auth_utils.send_signup_link, session, user, email=model.email)
-            return Response()
+        user = (await session.exec(select(User).where(
+            User.email == model.email))).one_or_none()
+        background_tasks.add_task(
+            auth_utils.send_signup_link, session, user, email=model.email)
+        return Response()
 
     @classmethod
-    async def request_magic_link_email(cls, model: RequestMagicLinkEmailRequest, background_tasks: BackgroundTasks):
-
-        async with core.ASYNC_SESSIONMAKER() as session:
-            user = (await session.exec(select(User).where(
-                User.email == model.email))).one_or_none()
-            if user:
-                magic_link = await auth_utils.create_magic_link(
-                    session, user, email=model.email)
-                background_tasks.add_task(
-                    auth_utils.send_magic_link, magic_link, user, email=model.email)
+    async def request_magic_link_email(cls, session: dependencies.SessionDepends, model: RequestMagicLinkEmailRequest, background_tasks: BackgroundTasks):
+
+        user = (await session.exec(select(User).where(
+            User.email == model.email))).one_or_none()
+        if user:
+            magic_link = await auth_utils.create_magic_link(
+                session, user, email=model.email)
+            background_tasks.add_task(
+                auth_utils.send_magic_link, magic_link, user, email=model.email)
         return Response()
 
     @classmethod
-    async def request_magic_link_sms(cls, model: RequestMagicLinkSMSRequest, background_tasks: BackgroundTasks):
-        async with core.ASYNC_SESSIONMAKER() as session:
-            user = (await session.exec(select(User).where(
-                User.phone_number == model.phone_number))).one_or_none()
-
-            if user is not None:
-                magic_link = await auth_utils.create_magic_link(
-                    session, user, phone_number=model.phone_number)
-                background_tasks.add_task(
-                    auth_utils.send_magic_link, magic_link, user, phone_number=model.phone_number)
+    async def request_magic_link_sms(cls, session: dependencies.SessionDepends, model: RequestMagicLinkSMSRequest, background_tasks: BackgroundTasks):
+        user = (await session.exec(select(User).where(
+            User.phone_number == model.phone_number))).one_or_none()
+
+        if user is not None:
+            magic_link = await auth_utils.create_magic_link(
+                session, user, phone_number=model.phone_number)
+            background_tasks.add_task(
+                auth_utils.send_magic_link, magic_link, user, phone_number=model.phone_number)
         return Response()
 
     @classmethod
-    async def request_otp_email(cls, model: RequestOTPEmailRequest, background_tasks: BackgroundTasks):
+    async def request_otp_email(cls, session: dependencies.SessionDepends, model: RequestOTPEmailRequest, background_tasks: BackgroundTasks):
 
-        async with core.ASYNC_SESSIONMAKER() as session:
-            user = (await session.exec(select(User).where(
-                User.email == model.email))).one_or_none()
+        user = (await session.exec(select(User).where(
+            User.email == model.email))).one_or_none()
 
-            if user:
-                code = await auth_utils.create_otp(
-                    session, user, email=model.email)
-                background_tasks.add_task(
-                    auth_utils.send_otp, code, user, email=model.email)
+        if user:
+            code = await auth_utils.create_otp(
+                session, user, email=model.email)
+            background_tasks.add_task(
+                auth_utils.send_otp, code, user, email=model.email)
         return Response()
 
     @classmethod
-    async def request_otp_sms(cls, model: RequestOTPSMSRequest, background_tasks: BackgroundTasks):
-
-        async with core.ASYNC_SESSIONMAKER() as session:
-            user = (await session.exec(select(User).where(
-                User.phone_number == model.phone_number))).one_or_none()
-            if user:
-                code = await auth_utils.create_otp(
-                    session, user, phone_number=model.phone_number)
-                background_tasks.add_task(
-                    auth_utils.send_otp, code, user, phone_number=model.phone_number)
+    async def request_otp_sms(cls, session: dependencies.SessionDepends, model: RequestOTPSMSRequest, background_tasks: BackgroundTasks):
+
+        user = (await session.exec(select(User).where(
+            User.phone_number == model.phone_number))).one_or_none()
+        if user:
+            code = await auth_utils.create_otp(
+                session, user, phone_number=model.phone_number)
+            background_tasks.add_task(
+                auth_utils.send_otp, code, user, phone_number=model.phone_number)
         return Response()
 
     @classmethod
-    async def logout(cls, response: Response, authorization: Annotated[auth_utils.GetAuthReturn[UserAccessToken], Depends(
+    async def logout(cls, response: Response, session: dependencies.SessionDepends, authorization: Annotated[auth_utils.GetAuthReturn[UserAccessToken], Depends(
             auth_utils.make_get_auth_dependency(raise_exceptions=False, permitted_types={'access_token'}))]) -> api_schema.DetailOnlyResponse:
 
         if authorization.isAuthorized:
-            async with core.ASYNC_SESSIONMAKER() as session:
-                await UserAccessTokenService.delete({
-                    'session': session,
-                    'admin': False,
-                    'authorized_user_id': cast(types.User.id, authorization._user_id),
-                    'id': UserAccessTokenService.model_id(cast(UserAccessToken, authorization.auth_credential))
-                })
+            await UserAccessTokenService.delete({
+                'session': session,
+                'admin': False,
+                'authorized_user_id': cast(types.User.id, authorization._user_id),
+                'id': UserAccessTokenService.model_id(cast(UserAccessToken, authorization.auth_credential))
+            })
 
         auth_utils.delete_access_token_cookie(response)
         return api_schema.DetailOnlyResponse(detail='Logged out')
 
+    @classmethod
+    async def refresh(cls, request: Request, response: Response, session: dependencies.SessionDepends, model: RefreshRequest | None = None) -> TokenResponse:
+        """Mint a new stateless access token from the user access token, which is where revocation takes effect"""
+
+        refresh_token = model.refresh_token if model is not None and model.refresh_token else request.cookies.get(
+            config.REFRESH_TOKEN_COOKIE['key'])
+
+        authorization = await auth_utils.get_auth_from_auth_credential_jwt(
+            token=cast(types.JwtEncodedStr | None, refresh_token),
+            session=session,
+            permitted_types={'access_token'},
+            permit_stateless=False
+        )
+
+        if authorization.exception:
+            raise authorization.exception
+
+        access_token = utils.jwt_encode(cast(dict, UserAccessTokenService.to_stateless_jwt_payload(
+            cast(UserAccessToken, authorization.auth_credential), cast(user_schema.UserPrivate, authorization.user))))
+
+        # a session cookie, the refresh token cookie keeps its own expiry
+        auth_utils.set_access_token_cookie(response, access_token)
+        return TokenResponse(access_token=access_token, token_type='bearer')
+
     def _set_routes(self):
 
         self.router.get('')(self.auth_root)
@@ -466,6 +485,9 @@ class AuthRouter(base.Router):
         self.router.post(
             '/login/otp/phone_number')(self.login_otp_phone_number)
         self.router.post('/signup')(self.signup)
+        if config.AUTH['stateless_access_tokens']:
+            self.router.post('/refresh', responses={status.HTTP_401_UNAUTHORIZED: {
+                             'description': 'Refresh token expired or revoked', 'model': api_schema.DetailOnlyResponse}})(self.refresh)
         self.router.post("/login/google", responses={status.HTTP_400_BAD_REQUEST: {
                          'description': 'Invalid token', 'model': api_schema.DetailOnlyResponse}})(self.login_google)
         self.router.post('/request/signup')(self.request_sign_up_email)
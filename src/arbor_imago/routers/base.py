@@ -4,13 +4,18 @@ from arbor_imago.services.models import base as base_service
 from arbor_imago.schemas import pagination as pagination_schema, order_by as order_by_schema
 from arbor_imago.auth import utils as auth_utils
 
-from pydantic import BaseModel
+from pydantic import BaseModel, TypeAdapter
+from sqlmodel.ext.asyncio.session import AsyncSession
 from typing import Protocol, Unpack, TypeVar, TypedDict, Generic, NotRequired, Literal, Self, ClassVar, Type, Optional
 from typing import TypeVar, Type, List, Callable, ClassVar, TYPE_CHECKING, Generic, Protocol, Any, Annotated, cast
-from fastapi import APIRouter, Depends, HTTPException, status, Query
+from fastapi import APIRouter, Depends, HTTPException, status, Query, Request, Response
 from functools import wraps, lru_cache
 from enum import Enum
-from collections.abc import Sequence
+from collections.abc import Sequence, Mapping, Iterable
+import datetime as datetime_module
+import email.utils
+import hashlib
+import inspect
 
 
 def get_pagination(max_limit: int = 100, default_limit: int = 10):
@@ -54,7 +59,103 @@ class NotFoundError(HTTPException, base_service.NotFoundError):
             self, status_code=self.status_code, detail=self.detail)
 
 
+def make_etag(*parts: Any) -> str:
+    """Strong ETag of a representation, from whatever determines it"""
+
+    return '"{}"'.format(hashlib.blake2b(repr(parts).encode(), digest_size=16).hexdigest())
+
+
+class NotModifiedException(HTTPException):
+
+    def __init__(self, headers: dict[str, str]):
+        super().__init__(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+
+class ConditionalRequest:
+    """A GET's If-None-Match and If-Modified-Since, checked once the validators of the representation are known
+
+    Endpoints take it through ConditionalDepends, which defaults to None so they can still be called directly.
+    """
+
+    def __init__(self, request: Request, response: Response):
+        self.request = request
+        self.response = response
+        self.headers: dict[str, str] = {}
+
+    def check(self, etag: str, last_modified: datetime_module.datetime | None = None) -> None:
+        """Put the validators on the response, raise NotModifiedException if the client's copy is still current"""
+
+        # the representation depends on who asks, caches may keep it but must revalidate it every time
+        headers = {'ETag': etag, 'Cache-Control': 'private, no-cache', 'Vary': 'Authorization, Cookie'}
+        if last_modified is not None:
+            headers['Last-Modified'] = email.utils.format_datetime(
+                last_modified.astimezone(datetime_module.UTC), usegmt=True)
+        self.headers = headers
+        self.response.headers.update(headers)
+
+        # If-None-Match takes precedence, If-Modified-Since is only looked at without it
+        if_none_match = self.request.headers.get('If-None-Match')
+        if if_none_match is not None:
+            etags = {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')}
+            if etag in etags or '*' in etags:
+                raise NotModifiedException(headers)
+            return
+
+        if_modified_since = self.request.headers.get('If-Modified-Since')
+        if if_modified_since is not None and last_modified is not None:
+            try:
+                since = email.utils.parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                return
+            # HTTP dates are to the second
+            if since.tzinfo is not None and last_modified.replace(microsecond=0) <= since:
+                raise NotModifiedException(headers)
+
+
+ConditionalDepends = Annotated[ConditionalRequest | None, Depends(ConditionalRequest)]
+
+
+TSchema = TypeVar('TSchema', bound=BaseModel)
+
+
+@lru_cache(maxsize=None)
+def type_adapter(type_: Any) -> TypeAdapter:
+    """One TypeAdapter per type, building one compiles its validator and serializer"""
+
+    return TypeAdapter(type_)
+
+
+def validate_many(schema: Type[TSchema], objs: Iterable[Any]) -> list[TSchema]:
+    """Validate a page of rows against a schema in one call, rather than one model_validate per row"""
+
+    return type_adapter(list[schema]).validate_python(objs, from_attributes=True)
+
+
+def json_route(endpoint: Callable[..., Any]) -> Callable[..., Any]:
+    """Opt a route into serializing its already validated return value straight to JSON bytes
+
+    Otherwise FastAPI validates the return value against the annotation a second time, then encodes it
+    with jsonable_encoder and json.dumps. The annotation still documents the route. The endpoint itself is
+    left as is, so other routers can keep calling it for models.
+    """
+
+    adapter = type_adapter(inspect.signature(endpoint).return_annotation)
+
+    @wraps(endpoint)
+    async def wrapper(*args, **kwargs):
+        response = Response(adapter.dump_json(await endpoint(*args, **kwargs)), media_type='application/json')
+
+        # a returned Response does not pick up headers set on the injected one
+        for value in kwargs.values():
+            if isinstance(value, ConditionalRequest):
+                response.headers.update(value.headers)
+        return response
+
+    return wrapper
+
+
 class RouterVerbParams(TypedDict):
+    session: AsyncSession
     authorization: auth_utils.GetAuthReturn
 
 
@@ -62,11 +163,16 @@ class WithId(Generic[types.TId], TypedDict):
     id: types.TId
 
 
-class GetParams(Generic[types.TId], RouterVerbParams, WithId[types.TId]):
+class WithConditional(TypedDict):
+    # answered with 304 when the client already has the representation, see ConditionalRequest
+    conditional: NotRequired[ConditionalRequest | None]
+
+
+class GetParams(Generic[types.TId], RouterVerbParams, WithId[types.TId], WithConditional):
     pass
 
 
-class GetManyParams(Generic[models.TModel, base_service.TOrderBy_co], RouterVerbParams, base_service.ReadManyBase[models.TModel, base_service.TOrderBy_co]):
+class GetManyParams(Generic[models.TModel, base_service.TOrderBy_co], RouterVerbParams, base_service.ReadManyBase[models.TModel, base_service.TOrderBy_co], WithConditional):
     pass
 
 
@@ -82,6 +188,21 @@ class DeleteParams(Generic[types.TId], RouterVerbParams, WithId[types.TId]):
     pass
 
 
+class PostManyParams(Generic[base_service.TCreateModel], RouterVerbParams):
+    create_models: Sequence[base_service.TCreateModel]
+
+
+class PatchManyParams(Generic[types.TId, base_service.TUpdateModel], RouterVerbParams):
+    update_models: Mapping[types.TId, base_service.TUpdateModel]
+
+
+class DeleteManyParams(Generic[types.TId], RouterVerbParams):
+    ids: Sequence[types.TId]
+
+
+BATCH_MAX_LENGTH = 100
+
+
 class HasPrefix(Protocol):
     _PREFIX: ClassVar[str]
 
@@ -120,6 +241,14 @@ class NotFoundException(HTTPException):
         super().__init__(status_code=self.status_code, detail=self.detail)
 
 
+class ConflictException(HTTPException):
+
+    def __init__(self, error: base_service.AlreadyExistsError | base_service.NotAvailableError):
+        self.status_code = status.HTTP_409_CONFLICT
+        self.detail = error.error_message
+        super().__init__(status_code=self.status_code, detail=self.detail)
+
+
 class HasService(
         Generic[models.TModel,
                 types.TId,
@@ -258,102 +387,191 @@ class ServiceRouter(Generic[
     @classmethod
     async def _get(cls, params: GetParams[types.TId]) -> models.TModel:
 
-        async with core.ASYNC_SESSIONMAKER() as session:
-            try:
-                model_inst = await cls._SERVICE.read({
-                    'admin': cls._ADMIN,
-                    'session': session,
-                    'id': params['id'],
-                    'authorized_user_id': params['authorization']._user_id,
-                })
-            except base_service.NotFoundError as e:
-                raise NotFoundException(
-                    model=cls._SERVICE._MODEL, id=params['id']
-                )
-            except Exception as e:
-                print(f"Exception type: {type(e)}")
-                print(e)
-                print('raising exception')
-                raise
-
-            return model_inst
+        try:
+            model_inst = await cls._SERVICE.read({
+                'admin': cls._ADMIN,
+                'session': params['session'],
+                'id': params['id'],
+                'authorized_user_id': params['authorization']._user_id,
+            })
+        except base_service.NotFoundError as e:
+            raise NotFoundException(
+                model=cls._SERVICE._MODEL, id=params['id']
+            )
+        except Exception as e:
+            print(f"Exception type: {type(e)}")
+            print(e)
+            print('raising exception')
+            raise
+
+        # only once the read was authorized, a 304 must not tell anything a 404 would hide
+        conditional = params.get('conditional')
+        if conditional is not None:
+            updated_at = getattr(model_inst, 'updated_at')
+            conditional.check(make_etag(cls._SERVICE._MODEL.__tablename__, cls._SERVICE.model_id(model_inst),
+                              updated_at), updated_at)
+
+        return model_inst
+
+    @classmethod
+    def _read_many_params(cls, params: GetManyParams[models.TModel, base_service.TOrderBy_co]) -> base_service.ReadManyParams[models.TModel, base_service.TOrderBy_co]:
+        d: base_service.ReadManyParams[models.TModel, base_service.TOrderBy_co] = {
+            'admin': cls._ADMIN,
+            'session': params['session'],
+            'authorized_user_id': params['authorization']._user_id,
+            'pagination': params['pagination']}
+
+        if 'order_bys' in params:
+            d['order_bys'] = params['order_bys']
+        if 'query' in params:
+            d['query'] = params['query']
+        return d
+
+    @classmethod
+    async def _get_many_etag(cls, params: GetManyParams[models.TModel, base_service.TOrderBy_co]) -> str:
+        """ETag of a page, from the ids and versions of its rows, so edits, deletes and rows shifting in all change it"""
+
+        versions = await cls._SERVICE.read_many_versions(cls._read_many_params(params))
+        return make_etag(cls._SERVICE._MODEL.__tablename__, params['authorization']._user_id,
+                         [tuple(version) for version in versions])
+
+    @classmethod
+    async def _check_get_many_conditional(cls, params: GetManyParams[models.TModel, base_service.TOrderBy_co]) -> None:
+
+        conditional = params.get('conditional')
+        if conditional is not None:
+            conditional.check(await cls._get_many_etag(params))
 
     @classmethod
     async def _get_many(cls, params: GetManyParams[models.TModel, base_service.TOrderBy_co]) -> Sequence[models.TModel]:
-        async with core.ASYNC_SESSIONMAKER() as session:
-            try:
-                d: base_service.ReadManyParams[models.TModel, base_service.TOrderBy_co] = {
-                    'admin': cls._ADMIN,
-                    'session': session,
-                    'authorized_user_id': params['authorization']._user_id,
-                    'pagination': params['pagination']}
 
-                if 'order_bys' in params:
-                    d['order_bys'] = params['order_bys']
-                if 'query' in params:
-                    d['query'] = params['query']
+        await cls._check_get_many_conditional(params)
+        return await cls._SERVICE.read_many(cls._read_many_params(params))
 
-                model_insts = await cls._SERVICE.read_many(d)
-            except Exception as e:
-                raise
+    @classmethod
+    async def _get_many_projected(cls, params: GetManyParams[models.TModel, base_service.TOrderBy_co], schema: Type[TSchema]) -> list[TSchema]:
+        """Like _get_many, but reads only the columns of the response schema and validates the rows straight into it"""
 
-            return model_insts
+        await cls._check_get_many_conditional(params)
+        return validate_many(schema, await cls._SERVICE.read_many_columns(cls._read_many_params(params), list(schema.model_fields)))
 
     @classmethod
     async def _post(cls, params: PostParams[base_service.TCreateModel]) -> models.TModel:
-        async with core.ASYNC_SESSIONMAKER() as session:
-
-            try:
-                model_inst = await cls._SERVICE.create({
-                    'admin': cls._ADMIN,
-                    'session': session,
-                    'authorized_user_id': params['authorization']._user_id,
-                    'create_model': params['create_model'],
-                })
-            except base_service.AlreadyExistsError as e:
-                raise
+        try:
+            model_inst = await cls._SERVICE.create({
+                'admin': cls._ADMIN,
+                'session': params['session'],
+                'authorized_user_id': params['authorization']._user_id,
+                'create_model': params['create_model'],
+            })
+        except (base_service.AlreadyExistsError, base_service.NotAvailableError) as e:
+            raise ConflictException(e)
 
-            except Exception as e:
-                raise
+        except Exception as e:
+            raise
 
-            return model_inst
+        return model_inst
 
     @classmethod
     async def _patch(cls, params: PatchParams[types.TId, base_service.TUpdateModel]) -> models.TModel:
-        async with core.ASYNC_SESSIONMAKER() as session:
-            try:
-                model_inst = await cls._SERVICE.update({
-                    'admin': cls._ADMIN,
-                    'session': session,
-                    'id': params['id'],
-                    'authorized_user_id': params['authorization']._user_id,
-                    'update_model': params['update_model'],
-                })
-            except base_service.NotFoundError as e:
-                raise NotFoundException(
-                    model=cls._SERVICE._MODEL, id=params['id']
-                )
-            except Exception as e:
-                raise
-
-            return model_inst
+        try:
+            model_inst = await cls._SERVICE.update({
+                'admin': cls._ADMIN,
+                'session': params['session'],
+                'id': params['id'],
+                'authorized_user_id': params['authorization']._user_id,
+                'update_model': params['update_model'],
+            })
+        except base_service.NotFoundError as e:
+            raise NotFoundException(
+                model=cls._SERVICE._MODEL, id=params['id']
+            )
+        except (base_service.AlreadyExistsError, base_service.NotAvailableError) as e:
+            raise ConflictException(e)
+        except Exception as e:
+            raise
+
+        return model_inst
 
     @classmethod
     async def _delete(cls, params: DeleteParams[types.TId]) -> None:
-        async with core.ASYNC_SESSIONMAKER() as session:
-            try:
-                await cls._SERVICE.delete({
-                    'admin': cls._ADMIN,
-                    'session': session,
-                    'id': params['id'],
-                    'authorized_user_id': params['authorization']._user_id,
-                })
-            except base_service.NotFoundError as e:
-                raise NotFoundException(
-                    model=cls._SERVICE._MODEL, id=params['id']
-                )
-            except Exception as e:
-                raise
+        try:
+            await cls._SERVICE.delete({
+                'admin': cls._ADMIN,
+                'session': params['session'],
+                'id': params['id'],
+                'authorized_user_id': params['authorization']._user_id,
+            })
+        except base_service.NotFoundError as e:
+            raise NotFoundException(
+                model=cls._SERVICE._MODEL, id=params['id']
+            )
+        except Exception as e:
+            raise
+
+    @classmethod
+    async def _post_many(cls, params: PostManyParams[base_service.TCreateModel]) -> list[models.TModel]:
+        try:
+            model_insts = await cls._SERVICE.create_many({
+                'admin': cls._ADMIN,
+                'session': params['session'],
+                'authorized_user_id': params['authorization']._user_id,
+                'create_models': params['create_models'],
+            })
+        except base_service.UnauthorizedError as e:
+            # one item the user may not touch refuses the whole batch
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN, detail=e.error_message)
+        except base_service.NotFoundError as e:
+            # a row an item refers to, its parent say, does not exist or is not visible
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail=e.error_message)
+        except (base_service.AlreadyExistsError, base_service.NotAvailableError) as e:
+            raise ConflictException(e)
+        except Exception as e:
+            raise
+
+        return model_insts
+
+    @classmethod
+    async def _patch_many(cls, params: PatchManyParams[types.TId, base_service.TUpdateModel]) -> list[models.TModel]:
+        try:
+            model_insts = await cls._SERVICE.update_many({
+                'admin': cls._ADMIN,
+                'session': params['session'],
+                'authorized_user_id': params['authorization']._user_id,
+                'update_models': params['update_models'],
+            })
+        except base_service.UnauthorizedError as e:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN, detail=e.error_message)
+        except base_service.NotFoundError as e:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail=e.error_message)
+        except (base_service.AlreadyExistsError, base_service.NotAvailableError) as e:
+            raise ConflictException(e)
+        except Exception as e:
+            raise
+
+        return model_insts
+
+    @classmethod
+    async def _delete_many(cls, params: DeleteManyParams[types.TId]) -> None:
+        try:
+            await cls._SERVICE.delete_many({
+                'admin': cls._ADMIN,
+                'session': params['session'],
+                'authorized_user_id': params['authorization']._user_id,
+                'ids': params['ids'],
+            })
+        except base_service.UnauthorizedError as e:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN, detail=e.error_message)
+        except base_service.NotFoundError as e:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail=e.error_message)
+        except Exception as e:
+            raise
 
     @classmethod
     @lru_cache(maxsize=None)
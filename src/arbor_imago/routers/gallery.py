@@ -1,17 +1,21 @@
-from arbor_imago import core
-from arbor_imago.core import types
+from arbor_imago.core import types, dependencies
 from arbor_imago.auth import utils as auth_utils
 from arbor_imago.core import config
 from arbor_imago.routers import base, user as user_router
+from arbor_imago.services.models import base as base_service
 from arbor_imago.models.tables import Gallery as GalleryTable, GalleryPermission as GalleryPermissionTable
 from arbor_imago.services.models.gallery import Gallery as GalleryService
 from arbor_imago.services.models.gallery_permission import GalleryPermission as GalleryPermissionService
-from arbor_imago.schemas import gallery as gallery_schema, pagination as pagination_schema, api as api_schema, gallery_permission as gallery_permission_schema
+from arbor_imago.services.models.file import File as FileService
+from arbor_imago.services import counters
+from arbor_imago.schemas import gallery as gallery_schema, pagination as pagination_schema, api as api_schema, gallery_permission as gallery_permission_schema, file as file_schema
 
-from fastapi import Depends, status, UploadFile, HTTPException
+from fastapi import Depends, status, UploadFile, HTTPException, Body, Query
 from sqlmodel import select
-from typing import Annotated, cast
+from typing import Annotated, cast, List
 import shutil
+import pathlib
+import os
 
 
 class _Base(
@@ -41,30 +45,54 @@ class GalleryRouter(_Base):
     @classmethod
     async def list(
         cls,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
             auth_utils.make_get_auth_dependency())],
         pagination: pagination_schema.Pagination = Depends(
-            galleries_pagination)
-
+            galleries_pagination),
+        conditional: base.ConditionalDepends = None
     ) -> list[gallery_schema.GalleryPrivate]:
-        return [gallery_schema.GalleryPrivate.model_validate(gallery) for gallery in
-                await cls._get_many({
-                    'authorization': authorization,
-                    'pagination': pagination,
-                    'query': select(GalleryTable).where(GalleryTable.user_id == authorization._user_id)
-                })
-                ]
+        return await cls._get_many_projected({
+            'authorization': authorization,
+            'session': session,
+            'conditional': conditional,
+            'pagination': pagination,
+            'query': select(GalleryTable).where(GalleryTable.user_id == authorization._user_id)
+        }, gallery_schema.GalleryPrivate)
+
+    @classmethod
+    async def list_visible(
+        cls,
+        session: dependencies.SessionDepends,
+        authorization: Annotated[auth_utils.GetAuthReturn, Depends(
+            auth_utils.make_get_auth_dependency(raise_exceptions=False))],
+        pagination: pagination_schema.Pagination = Depends(
+            galleries_pagination),
+        conditional: base.ConditionalDepends = None
+    ) -> List[gallery_schema.GalleryPublic]:
+
+        # own, public and shared galleries, filtered by the service's visibility predicate
+        return await cls._get_many_projected({
+            'authorization': authorization,
+            'session': session,
+            'conditional': conditional,
+            'pagination': pagination,
+        }, gallery_schema.GalleryPublic)
 
     @classmethod
     async def by_id(
         cls,
         gallery_id: types.Gallery.id,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
-            auth_utils.make_get_auth_dependency(raise_exceptions=False))]
+            auth_utils.make_get_auth_dependency(raise_exceptions=False))],
+        conditional: base.ConditionalDepends = None
     ) -> gallery_schema.GalleryPublic:
 
         return gallery_schema.GalleryPublic.model_validate(await cls._get({
             'authorization': authorization,
+            'session': session,
+            'conditional': conditional,
             'id': gallery_id,
         }))
 
@@ -72,12 +100,14 @@ class GalleryRouter(_Base):
     async def create(
         cls,
         gallery_create: gallery_schema.GalleryCreate,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
             auth_utils.make_get_auth_dependency())]
     ) -> gallery_schema.GalleryPrivate:
 
         return gallery_schema.GalleryPrivate.model_validate(await cls._post({
             'authorization': authorization,
+            'session': session,
             'create_model': gallery_schema.GalleryAdminCreate(
                 **gallery_create.model_dump(exclude_unset=True), user_id=cast(types.User.id, authorization._user_id)),
         }))
@@ -87,12 +117,14 @@ class GalleryRouter(_Base):
         cls,
         gallery_id: types.Gallery.id,
         gallery_update: gallery_schema.GalleryUpdate,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
             auth_utils.make_get_auth_dependency())]
     ) -> gallery_schema.GalleryPrivate:
 
         return gallery_schema.GalleryPrivate.model_validate(await cls._patch({
             'authorization': authorization,
+            'session': session,
             'id': gallery_id,
             'update_model': gallery_schema.GalleryAdminUpdate(
                 **gallery_update.model_dump(exclude_unset=True)),
@@ -102,36 +134,84 @@ class GalleryRouter(_Base):
     async def delete(
         cls,
         gallery_id: types.Gallery.id,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
             auth_utils.make_get_auth_dependency())]
     ):
 
         return await cls._delete({
             'authorization': authorization,
+            'session': session,
             'id': gallery_id,
         })
 
+    @classmethod
+    async def create_many(
+        cls,
+        gallery_creates: Annotated[List[gallery_schema.GalleryCreate], Body(max_length=base.BATCH_MAX_LENGTH)],
+        session: dependencies.SessionDepends,
+        authorization: Annotated[auth_utils.GetAuthReturn, Depends(
+            auth_utils.make_get_auth_dependency())]
+    ) -> List[gallery_schema.GalleryPrivate]:
+
+        return base.validate_many(gallery_schema.GalleryPrivate, await cls._post_many({
+            'authorization': authorization,
+            'session': session,
+            'create_models': [gallery_schema.GalleryAdminCreate(
+                **gallery_create.model_dump(exclude_unset=True), user_id=cast(types.User.id, authorization._user_id)) for gallery_create in gallery_creates],
+        }))
+
+    @classmethod
+    async def update_many(
+        cls,
+        gallery_updates: Annotated[dict[types.Gallery.id, gallery_schema.GalleryUpdate], Body(max_length=base.BATCH_MAX_LENGTH)],
+        session: dependencies.SessionDepends,
+        authorization: Annotated[auth_utils.GetAuthReturn, Depends(
+            auth_utils.make_get_auth_dependency())]
+    ) -> List[gallery_schema.GalleryPrivate]:
+
+        return base.validate_many(gallery_schema.GalleryPrivate, await cls._patch_many({
+            'authorization': authorization,
+            'session': session,
+            'update_models': {gallery_id: gallery_schema.GalleryAdminUpdate(
+                **gallery_update.model_dump(exclude_unset=True)) for gallery_id, gallery_update in gallery_updates.items()},
+        }))
+
+    @classmethod
+    async def delete_many(
+        cls,
+        gallery_ids: Annotated[List[types.Gallery.id], Query(max_length=base.BATCH_MAX_LENGTH)],
+        session: dependencies.SessionDepends,
+        authorization: Annotated[auth_utils.GetAuthReturn, Depends(
+            auth_utils.make_get_auth_dependency())]
+    ):
+
+        return await cls._delete_many({
+            'authorization': authorization,
+            'session': session,
+            'ids': gallery_ids,
+        })
+
     @classmethod
     async def check_availability(
         cls,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
             auth_utils.make_get_auth_dependency())],
         gallery_available: gallery_schema.GalleryAvailable = Depends(),
     ):
 
-        async with core.ASYNC_SESSIONMAKER() as session:
-
-            return api_schema.IsAvailableResponse(
-                available=await GalleryService.is_available(
-                    session=session,
-                    gallery_available_admin=gallery_schema.GalleryAdminAvailable(
-                        **gallery_available.model_dump(exclude_unset=True),
-                        user_id=cast(types.User.id,
-                                     authorization._user_id)
-                    )
-
+        return api_schema.IsAvailableResponse(
+            available=await GalleryService.is_available(
+                session=session,
+                gallery_available_admin=gallery_schema.GalleryAdminAvailable(
+                    **gallery_available.model_dump(exclude_unset=True),
+                    user_id=cast(types.User.id,
+                                 authorization._user_id)
                 )
+
             )
+        )
 
     # @classmethod
     # async def get_galleries_by_user(
@@ -151,61 +231,112 @@ class GalleryRouter(_Base):
     async def upload_file(
         cls,
         gallery_id: types.Gallery.id,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
             auth_utils.make_get_auth_dependency())],
         file: UploadFile
     ):
 
-        async with core.ASYNC_SESSIONMAKER() as session:
-
-            gallery = await GalleryService.fetch_by_id(session, gallery_id)
-            if not gallery:
-                raise base.NotFoundError(GalleryTable, gallery_id)
+        gallery = await GalleryService.fetch_by_id(session, gallery_id)
+        if not gallery:
+            raise base.NotFoundError(GalleryTable, gallery_id)
 
-            if gallery.user.id != authorization._user_id:
-                gallery_permission = await GalleryPermissionService.fetch_by_id(
-                    session, types.GalleryPermission.id(
-                        gallery_id, cast(types.User.id, authorization._user_id))
-                )
-
-                if gallery_permission is None:
-                    if gallery.visibility_level == config.VISIBILITY_LEVEL_NAME_MAPPING['private']:
-                        raise base.NotFoundError(GalleryTable, gallery_id)
+        if gallery.user_id != authorization._user_id:
+            permission_level = await GalleryPermissionService.get_effective_permission_level(
+                session, cast(types.User.id, authorization._user_id), gallery_id
+            )
 
-                    if gallery.visibility_level == config.VISIBILITY_LEVEL_NAME_MAPPING['public']:
-                        raise HTTPException(
-                            status.HTTP_403_FORBIDDEN, detail='User lacks edit permission for this gallery')
-                else:
-                    if gallery_permission.permission_level < config.PERMISSION_LEVEL_NAME_MAPPING['editor']:
-                        raise HTTPException(
-                            status.HTTP_403_FORBIDDEN, detail='User does not have permission to add files to this gallery')
+            if permission_level is None:
+                if gallery.visibility_level == config.VISIBILITY_LEVEL_NAME_MAPPING['private']:
+                    raise base.NotFoundError(GalleryTable, gallery_id)
+
+                if gallery.visibility_level == config.VISIBILITY_LEVEL_NAME_MAPPING['public']:
+                    raise HTTPException(
+                        status.HTTP_403_FORBIDDEN, detail='User lacks edit permission for this gallery')
+            else:
+                if permission_level < config.PERMISSION_LEVEL_NAME_MAPPING['editor']:
+                    raise HTTPException(
+                        status.HTTP_403_FORBIDDEN, detail='User does not have permission to add files to this gallery')
+
+        # multipart parts usually carry no length of their own, the spooled upload knows it
+        size = file.size
+        if size is None:
+            size = file.file.seek(0, os.SEEK_END)
+            file.file.seek(0)
+
+        file_name = pathlib.PurePath(file.filename or 'test.jpg')
+        async with base_service.unit_of_work(session):
+            # the row gives the file an id, which the id media layout names it by, and is counted on insert, so an
+            # upload over the owner's storage quota is refused before any bytes are written
+            try:
+                file_inst = await FileService.create({
+                    'session': session,
+                    'admin': False,
+                    'authorized_user_id': authorization._user_id,
+                    'create_model': file_schema.FileAdminCreate(
+                        stem=file_name.stem, suffix=file_name.suffix or None, gallery_id=gallery_id, size=size),
+                })
+            except counters.QuotaExceededError as e:
+                raise HTTPException(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail=e.error_message)
+            except base_service.NotAvailableError as e:
+                # the tree layout would overwrite the bytes of the file already there
+                raise base.ConflictException(e)
+
+            file_path = await GalleryService.get_file_path(session, file_inst, config.GALLERIES_DIR)
+            file_path.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                with open(file_path, "wb") as buffer:
+                    shutil.copyfileobj(file.file, buffer)
+            except OSError:
+                # the row is rolled back with the unit of work, a partial file must not stay behind as an orphan
+                file_path.unlink(missing_ok=True)
+                raise
 
-            file_path = (await GalleryService.get_dir(session, gallery, config.GALLERIES_DIR)).joinpath(file.filename or 'test.jpg')
-            with open(file_path, "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
+    @classmethod
+    async def get_counters(
+        cls,
+        gallery_id: types.Gallery.id,
+        session: dependencies.SessionDepends,
+        authorization: Annotated[auth_utils.GetAuthReturn, Depends(
+            auth_utils.make_get_auth_dependency(raise_exceptions=False))]
+    ) -> gallery_schema.GalleryCounters:
+        await cls._get({
+            'authorization': authorization,
+            'session': session,
+            'id': gallery_id,
+        })
+        counter = await counters.fetch_gallery(session, gallery_id)
+        if counter is None:
+            return gallery_schema.GalleryCounters()
+        return gallery_schema.GalleryCounters.model_validate(counter)
 
     @classmethod
     async def sync(
         cls,
         gallery_id: types.Gallery.id,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
             auth_utils.make_get_auth_dependency())]
     ) -> api_schema.DetailOnlyResponse:
-        async with core.ASYNC_SESSIONMAKER() as session:
-
-            gallery = await cls._get({
-                'authorization': authorization,
-                'id': gallery_id,
-            })
-            dir = await GalleryService.get_dir(session, gallery, config.GALLERIES_DIR)
+        gallery = await cls._get({
+            'authorization': authorization,
+            'session': session,
+            'id': gallery_id,
+        })
+        dir = await GalleryService.get_dir(session, gallery, config.GALLERIES_DIR)
 
-            # await gallery.sync_with_local(session, c, dir)
-            return api_schema.DetailOnlyResponse(detail='Synced gallery')
+        # await gallery.sync_with_local(session, c, dir)
+        return api_schema.DetailOnlyResponse(detail='Synced gallery')
 
     def _set_routes(self):
 
-        self.router.get('/', tags=[user_router._Base._TAG])(self.list)
-        self.router.get('/{gallery_id}')(self.by_id)
+        self.router.get('/', tags=[user_router._Base._TAG])(base.json_route(self.list))
+        self.router.get('/visible/')(base.json_route(self.list_visible))
+        self.router.post('/batch/')(self.create_many)
+        self.router.patch('/batch/')(self.update_many)
+        self.router.delete(
+            '/batch/', status_code=status.HTTP_204_NO_CONTENT)(self.delete_many)
+        self.router.get('/{gallery_id}')(base.json_route(self.by_id))
         self.router.post('/')(self.create)
         self.router.patch('/{gallery_id}')(self.update)
         self.router.delete(
@@ -218,6 +349,7 @@ class GalleryRouter(_Base):
         self.router.post("/{gallery_id}/upload",
                          status_code=status.HTTP_201_CREATED)(self.upload_file)
         self.router.post('/{gallery_id}/sync')(self.sync)
+        self.router.get('/{gallery_id}/counters')(self.get_counters)
 
 
 class GalleryAdminRouter(_Base):
@@ -227,12 +359,16 @@ class GalleryAdminRouter(_Base):
     async def by_id(
         cls,
         gallery_id: types.Gallery.id,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
-            auth_utils.make_get_auth_dependency(required_scopes={'admin'}))]
+            auth_utils.make_get_auth_dependency(required_scopes={'admin'}))],
+        conditional: base.ConditionalDepends = None
     ) -> gallery_schema.GalleryPrivate:
         return gallery_schema.GalleryPrivate.model_validate(
             await cls._get({
                 'authorization': authorization,
+                'session': session,
+                'conditional': conditional,
                 'id': gallery_id,
             })
         )
@@ -241,12 +377,14 @@ class GalleryAdminRouter(_Base):
     async def create(
         cls,
         gallery_create_admin: gallery_schema.GalleryAdminCreate,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
             auth_utils.make_get_auth_dependency(required_scopes={'admin'}))]
     ) -> gallery_schema.GalleryPrivate:
         return gallery_schema.GalleryPrivate.model_validate(
             await cls._post({
                 'authorization': authorization,
+                'session': session,
                 'create_model': gallery_create_admin
             })
         )
@@ -256,6 +394,7 @@ class GalleryAdminRouter(_Base):
         cls,
         gallery_id: types.Gallery.id,
         gallery_update_admin: gallery_schema.GalleryAdminUpdate,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
             auth_utils.make_get_auth_dependency(required_scopes={'admin'}))]
     ) -> gallery_schema.GalleryPrivate:
@@ -263,6 +402,7 @@ class GalleryAdminRouter(_Base):
         return gallery_schema.GalleryPrivate.model_validate(
             await cls._patch({
                 'authorization': authorization,
+                'session': session,
                 'id': gallery_id,
                 'update_model': gallery_update_admin
             })
@@ -272,58 +412,109 @@ class GalleryAdminRouter(_Base):
     async def delete(
         cls,
         gallery_id: types.Gallery.id,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
             auth_utils.make_get_auth_dependency(required_scopes={'admin'}))]
     ):
         return await cls._delete({
             'authorization': authorization,
+            'session': session,
             'id': gallery_id,
         })
 
+    @classmethod
+    async def create_many(
+        cls,
+        gallery_creates_admin: Annotated[list[gallery_schema.GalleryAdminCreate], Body(max_length=base.BATCH_MAX_LENGTH)],
+        session: dependencies.SessionDepends,
+        authorization: Annotated[auth_utils.GetAuthReturn, Depends(
+            auth_utils.make_get_auth_dependency(required_scopes={'admin'}))]
+    ) -> list[gallery_schema.GalleryPrivate]:
+        return base.validate_many(gallery_schema.GalleryPrivate, await cls._post_many({
+            'authorization': authorization,
+            'session': session,
+            'create_models': gallery_creates_admin
+        }))
+
+    @classmethod
+    async def update_many(
+        cls,
+        gallery_updates_admin: Annotated[dict[types.Gallery.id, gallery_schema.GalleryAdminUpdate], Body(max_length=base.BATCH_MAX_LENGTH)],
+        session: dependencies.SessionDepends,
+        authorization: Annotated[auth_utils.GetAuthReturn, Depends(
+            auth_utils.make_get_auth_dependency(required_scopes={'admin'}))]
+    ) -> list[gallery_schema.GalleryPrivate]:
+        return base.validate_many(gallery_schema.GalleryPrivate, await cls._patch_many({
+            'authorization': authorization,
+            'session': session,
+            'update_models': gallery_updates_admin
+        }))
+
+    @classmethod
+    async def delete_many(
+        cls,
+        gallery_ids: Annotated[list[types.Gallery.id], Query(max_length=base.BATCH_MAX_LENGTH)],
+        session: dependencies.SessionDepends,
+        authorization: Annotated[auth_utils.GetAuthReturn, Depends(
+            auth_utils.make_get_auth_dependency(required_scopes={'admin'}))]
+    ):
+        return await cls._delete_many({
+            'authorization': authorization,
+            'session': session,
+            'ids': gallery_ids,
+        })
+
     @classmethod
     async def check_availability(
         cls,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
             auth_utils.make_get_auth_dependency(required_scopes={'admin'}))],
         gallery_available_admin: gallery_schema.GalleryAdminAvailable = Depends(),
     ):
 
-        async with core.ASYNC_SESSIONMAKER() as session:
-            return api_schema.IsAvailableResponse(
-                available=await GalleryService.is_available(
-                    session=session,
-                    gallery_available_admin=gallery_schema.GalleryAdminAvailable(
-                        **gallery_available_admin.model_dump(exclude_unset=True),
-                        user_id=cast(types.User.id,
-                                     authorization._user_id)
-                    )
+        return api_schema.IsAvailableResponse(
+            available=await GalleryService.is_available(
+                session=session,
+                gallery_available_admin=gallery_schema.GalleryAdminAvailable(
+                    **gallery_available_admin.model_dump(exclude_unset=True),
+                    user_id=cast(types.User.id,
+                                 authorization._user_id)
                 )
             )
+        )
 
     @classmethod
     async def list_by_user(
         cls,
         user_id: types.User.id,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
             auth_utils.make_get_auth_dependency(required_scopes={'admin'}))],
         pagination: pagination_schema.Pagination = Depends(
-            galleries_pagination)
+            galleries_pagination),
+        conditional: base.ConditionalDepends = None
     ) -> list[gallery_schema.GalleryPrivate]:
 
-        return [gallery_schema.GalleryPrivate.model_validate(gallery) for gallery in
-                await cls._get_many({
-                    'authorization': authorization,
-                    'query': select(GalleryTable).where(
-                        GalleryTable.user_id == user_id),
-                    'pagination': pagination
-                })]
+        return await cls._get_many_projected({
+            'authorization': authorization,
+            'session': session,
+            'conditional': conditional,
+            'query': select(GalleryTable).where(
+                GalleryTable.user_id == user_id),
+            'pagination': pagination
+        }, gallery_schema.GalleryPrivate)
 
     def _set_routes(self):
 
+        self.router.post('/batch/')(self.create_many)
+        self.router.patch('/batch/')(self.update_many)
+        self.router.delete(
+            '/batch/', status_code=status.HTTP_204_NO_CONTENT)(self.delete_many)
         self.router.get('/{gallery_id}')(self.by_id)
         self.router.post('/')(self.create)
         self.router.patch('/{gallery_id}')(self.update)
         self.router.delete(
             '/{gallery_id}', status_code=status.HTTP_204_NO_CONTENT)(self.delete)
         self.router.get('/details/available')(self.check_availability)
-        self.router.get('/users/{user_id}')(self.list_by_user)
+        self.router.get('/users/{user_id}')(base.json_route(self.list_by_user))
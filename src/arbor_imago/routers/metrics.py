@@ -0,0 +1,23 @@
+from arbor_imago.core import metrics
+from arbor_imago.auth import utils as auth_utils
+from arbor_imago.routers import base
+
+from fastapi import Depends, Response
+from typing import Annotated
+
+
+class MetricsAdminRouter(base.Router):
+    _PREFIX = '/metrics'
+    _TAG = 'Metrics'
+    _ADMIN = True
+
+    @classmethod
+    async def metrics(
+        cls,
+        authorization: Annotated[auth_utils.GetAuthReturn, Depends(
+            auth_utils.make_get_auth_dependency(required_scopes={'admin'}))],
+    ) -> Response:
+        return Response(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+    def _set_routes(self):
+        self.router.get('', response_class=Response)(self.metrics)
@@ -1,14 +1,15 @@
-from arbor_imago import core
-from arbor_imago.core import types
+from arbor_imago.core import types, dependencies
 from arbor_imago.core import config
 from arbor_imago.routers import user as user_router, api_key as api_key_router, gallery as gallery_router, base, user_access_token as user_access_token_router
 from arbor_imago.schemas import api_key as api_key_schema, pagination as pagination_schema, api as api_schema, order_by as order_by_schema, user as user_schema, user_access_token as user_access_token_schema, gallery as gallery_schema, api_key_scope as api_key_scope_schema
 from arbor_imago.models.tables import ApiKey as ApiKeyTable, UserAccessToken as UserAccessTokenTable, Gallery as GalleryTable
 from arbor_imago.services.models import api_key as api_key_service, user_access_token as user_access_token_service, gallery as gallery_service
+from arbor_imago.services import counters
 from arbor_imago.auth import utils as auth_utils
 
 from fastapi import Depends, status, Query, HTTPException
 from sqlmodel import select, func
+from sqlmodel.ext.asyncio.session import AsyncSession
 from pydantic import BaseModel
 from collections.abc import Sequence
 from typing import Annotated, cast, Optional
@@ -44,6 +45,7 @@ class StylesPageResponse(auth_utils.GetUserSessionInfoNestedReturn):
 
 class GalleryPageResponse(auth_utils.GetUserSessionInfoNestedReturn):
     gallery: gallery_schema.GalleryPublic
+    counters: gallery_schema.GalleryCounters
     parents: list[gallery_schema.GalleryPublic]
     children: list[gallery_schema.GalleryPublic]
 
@@ -53,116 +55,166 @@ class _Base(base.Router):
     _TAG = 'Page'
 
 
+async def _session_info(session: AsyncSession, authorization: auth_utils.GetAuthReturn, conditional: base.ConditionalRequest | None, *parts) -> dict:
+    """The session info every page carries, 304 if the page built from it and parts did not change"""
+
+    session_info = (await auth_utils.get_user_session_info(authorization, session)).model_dump()
+    if conditional is not None:
+        conditional.check(base.make_etag(session_info, *parts))
+    return session_info
+
+
 class PagesRouter(_Base):
     _ADMIN = False
 
     @classmethod
     async def profile(
         cls,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
-            auth_utils.make_get_auth_dependency())]
+            auth_utils.make_get_auth_dependency())],
+        conditional: base.ConditionalDepends = None
     ) -> ProfilePageResponse:
         return ProfilePageResponse(
-            **auth_utils.get_user_session_info(authorization).model_dump()
+            **await _session_info(session, authorization, conditional, 'profile')
         )
 
     @classmethod
     async def home(
         cls,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
-            auth_utils.make_get_auth_dependency(raise_exceptions=False))]
+            auth_utils.make_get_auth_dependency(raise_exceptions=False))],
+        conditional: base.ConditionalDepends = None
     ) -> HomePageResponse:
         return HomePageResponse(
-            **auth_utils.get_user_session_info(authorization).model_dump()
+            **await _session_info(session, authorization, conditional, 'home')
         )
 
     @classmethod
     async def settings(
         cls,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
-            auth_utils.make_get_auth_dependency(raise_exceptions=False))]
+            auth_utils.make_get_auth_dependency(raise_exceptions=False))],
+        conditional: base.ConditionalDepends = None
     ) -> SettingsPageResponse:
         return SettingsPageResponse(
-            **auth_utils.get_user_session_info(authorization).model_dump()
+            **await _session_info(session, authorization, conditional, 'settings')
         )
 
     @classmethod
     async def settings_api_keys(
         cls,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(auth_utils.make_get_auth_dependency())],
         pagination: pagination_schema.Pagination = Depends(
             api_key_router.PAGINATION),
         order_by: list[order_by_schema.OrderBy[types.ApiKey.order_by]] = Depends(
             api_key_router._Base.order_by_depends
-        )
+        ),
+        conditional: base.ConditionalDepends = None
     ) -> SettingsApiKeysPageResponse:
-        api_keys = await api_key_router.ApiKeyRouter.list(authorization, pagination, order_by)
 
-        async with core.ASYNC_SESSIONMAKER() as session:
-            api_key_scopes = await api_key_service.ApiKey.get_scope_ids_by_api_key_ids(
-                session=session,
-                api_key_ids=[api_key.id for api_key in api_keys]
-            )
+        # the page's versions are the keys' versions and their scopes, read before the keys themselves
+        api_key_count = await api_key_router.ApiKeyRouter.count(session, authorization)
+        api_key_versions = await api_key_service.ApiKey.read_many_versions({
+            'admin': False,
+            'session': session,
+            'authorized_user_id': authorization._user_id,
+            'pagination': pagination,
+            'order_bys': order_by,
+        })
+        api_key_scopes = await api_key_service.ApiKey.get_scope_ids_by_api_key_ids(
+            session=session,
+            api_key_ids=[api_key_version[0] for api_key_version in api_key_versions]
+        )
+        session_info = await _session_info(session, authorization, conditional, 'settings_api_keys', api_key_count,
+                                     [tuple(api_key_version) for api_key_version in api_key_versions], api_key_scopes)
 
         return SettingsApiKeysPageResponse(
-            **auth_utils.get_user_session_info(authorization).model_dump(),
-            api_key_count=await api_key_router.ApiKeyRouter.count(authorization),
-            api_keys=api_keys,
+            **session_info,
+            api_key_count=api_key_count,
+            api_keys=await api_key_router.ApiKeyRouter.list(session, authorization, pagination, order_by),
             api_key_scopes=api_key_scopes
         )
 
     @classmethod
     async def settings_user_access_tokens(
         cls,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(auth_utils.make_get_auth_dependency())],
         pagination: pagination_schema.Pagination = Depends(
-            user_access_token_router.user_access_token_pagination)
+            user_access_token_router.user_access_token_pagination),
+        conditional: base.ConditionalDepends = None
     ) -> SettingsUserAccessTokensPageResponse:
+
+        user_access_token_count = await user_access_token_router.UserAccessTokenRouter.count(session, authorization)
+        user_access_token_versions = await user_access_token_service.UserAccessToken.read_many_versions({
+            'admin': False,
+            'session': session,
+            'authorized_user_id': authorization._user_id,
+            'pagination': pagination,
+        })
+        session_info = await _session_info(session, authorization, conditional, 'settings_user_access_tokens', user_access_token_count,
+                                     [tuple(version) for version in user_access_token_versions])
+
         return SettingsUserAccessTokensPageResponse(
-            **auth_utils.get_user_session_info(authorization).model_dump(),
-            user_access_token_count=await user_access_token_router.UserAccessTokenRouter.count(authorization),
+            **session_info,
+            user_access_token_count=user_access_token_count,
             user_access_tokens=await user_access_token_router.UserAccessTokenRouter.list(
-                authorization, pagination)
+                session, authorization, pagination)
         )
 
     @classmethod
     async def styles(
         cls,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
-            auth_utils.make_get_auth_dependency(raise_exceptions=False))]
+            auth_utils.make_get_auth_dependency(raise_exceptions=False))],
+        conditional: base.ConditionalDepends = None
     ) -> StylesPageResponse:
         return StylesPageResponse(
-            **auth_utils.get_user_session_info(authorization).model_dump()
+            **await _session_info(session, authorization, conditional, 'styles')
         )
 
     @classmethod
     async def gallery(
         cls,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
             auth_utils.make_get_auth_dependency())],
         gallery_id: types.Gallery.id | None = Query(None),
+        conditional: base.ConditionalDepends = None
     ) -> GalleryPageResponse:
 
         # if gallery_id is None, get the root gallery for the user, then find that gallery
         if gallery_id is None:
-            async with core.ASYNC_SESSIONMAKER() as session:
-                root_gallery = await gallery_service.Gallery.get_root_gallery(session, cast(types.User.id, authorization._user_id))
-                if root_gallery is None:
-                    raise HTTPException(
-                        status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                        detail='Root gallery could not be found. This is a server error.'
-                    )
-                gallery_id = gallery_service.Gallery.model_id(root_gallery)
+            root_gallery = await gallery_service.Gallery.get_root_gallery(session, cast(types.User.id, authorization._user_id))
+            if root_gallery is None:
+                raise HTTPException(
+                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                    detail='Root gallery could not be found. This is a server error.'
+                )
+            gallery_id = gallery_service.Gallery.model_id(root_gallery)
 
         # refetch the root gallery to utilize the Router handlings of authorization and exceptions
-        gallery = gallery_router.GalleryRouter.by_id(
-            gallery_id=gallery_id,
-            authorization=authorization,
-        )
+        gallery = await gallery_router.GalleryRouter._get({
+            'authorization': authorization,
+            'session': session,
+            'id': gallery_id,
+        })
+        counter = await counters.fetch_gallery(session, gallery_id)
+
+        # the page is re-polled constantly, the gallery row and its counter row say whether it changed
+        session_info = await _session_info(session, authorization, conditional, 'gallery', gallery_id, gallery.updated_at,
+                                     None if counter is None else counter.updated_at)
 
         return GalleryPageResponse(
-            **auth_utils.get_user_session_info(authorization).model_dump(),
+            **session_info,
             gallery=gallery_schema.GalleryPublic.model_validate(gallery),
+            counters=gallery_schema.GalleryCounters() if counter is None else gallery_schema.GalleryCounters.model_validate(
+                counter),
             parents=[],
             children=[]
             # parents=[gallery_schema.GalleryPublic.model_validate(
@@ -1,5 +1,4 @@
-from arbor_imago import core
-from arbor_imago.core import types, config
+from arbor_imago.core import types, config, dependencies
 from arbor_imago.auth import utils as auth_utils
 from arbor_imago.routers import base
 from arbor_imago.models.tables import User as UserTable
@@ -39,23 +38,29 @@ class UserRouter(_Base):
         cls,
         pagination: Annotated[pagination_schema.Pagination, Depends(
             base.get_pagination())],
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
-            auth_utils.make_get_auth_dependency(raise_exceptions=False))]
+            auth_utils.make_get_auth_dependency(raise_exceptions=False))],
+        conditional: base.ConditionalDepends = None
     ) -> Sequence[user_schema.UserPublic]:
-        return [user_schema.UserPublic.model_validate(user) for user in await cls._get_many({
+        return await cls._get_many_projected({
             'authorization': authorization,
+            'session': session,
+            'conditional': conditional,
             'pagination': pagination,
             # these are public users
             'query': select(UserTable).where(UserTable.username != None)
-        })]
+        }, user_schema.UserPublic)
 
     @classmethod
     async def get_me(
         cls,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
-            auth_utils.make_get_auth_dependency(raise_exceptions=True))]
+            auth_utils.make_get_auth_dependency(raise_exceptions=True))],
+        conditional: base.ConditionalDepends = None
     ) -> user_schema.UserPrivate:
-        user = await cls._get({'authorization': authorization, 'id': cast(
+        user = await cls._get({'authorization': authorization, 'session': session, 'conditional': conditional, 'id': cast(
             types.User.id, authorization._user_id)})
         return user_schema.UserPrivate.model_validate(user)
 
@@ -63,11 +68,13 @@ class UserRouter(_Base):
     async def update_me(
         cls,
         user_update: user_schema.UserUpdate,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
             auth_utils.make_get_auth_dependency(raise_exceptions=True))]
     ) -> user_schema.UserPrivate:
         user = await cls._patch({
             'authorization': authorization,
+            'session': session,
             'id': cast(types.User.id, authorization._user_id),
             'update_model': user_schema.UserAdminUpdate(**user_update.model_dump(exclude_unset=True)),
         })
@@ -77,11 +84,15 @@ class UserRouter(_Base):
     async def by_id(
         cls,
         user_id: types.User.id,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
-            auth_utils.make_get_auth_dependency(raise_exceptions=False))]
+            auth_utils.make_get_auth_dependency(raise_exceptions=False))],
+        conditional: base.ConditionalDepends = None
     ) -> user_schema.UserPublic:
         user = await cls._get({
             'authorization': authorization,
+            'session': session,
+            'conditional': conditional,
             'id': user_id,
         })
         return user_schema.UserPublic.model_validate(user)
@@ -89,23 +100,24 @@ class UserRouter(_Base):
     @classmethod
     async def delete_me(
         cls,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
             auth_utils.make_get_auth_dependency(raise_exceptions=True))]
     ):
         await cls._delete({
             'authorization': authorization,
+            'session': session,
             'id': cast(types.User.id, authorization._user_id),
         })
 
     @classmethod
-    async def check_username_availability(cls, username: types.User.username) -> api_schema.IsAvailableResponse:
-        async with core.ASYNC_SESSIONMAKER() as session:
-            return api_schema.IsAvailableResponse(
-                available=not await UserService.is_username_available(session, username))
+    async def check_username_availability(cls, session: dependencies.SessionDepends, username: types.User.username) -> api_schema.IsAvailableResponse:
+        return api_schema.IsAvailableResponse(
+            available=not await UserService.is_username_available(session, username))
 
     def _set_routes(self):
 
-        self.router.get('/')(self.list)
+        self.router.get('/')(base.json_route(self.list))
         self.router.get('/me')(self.get_me)
         self.router.get('/{user_id}')(self.by_id)
         self.router.patch('/me')(self.update_me)
@@ -122,28 +134,35 @@ class UserAdminRouter(_Base):
     @classmethod
     async def list(
         cls,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
             auth_utils.make_get_auth_dependency(required_scopes={'admin'}))],
         pagination: Annotated[pagination_schema.Pagination, Depends(
-            base.get_pagination())]
+            base.get_pagination())],
+        conditional: base.ConditionalDepends = None
     ) -> list[user_schema.UserPrivate]:
 
-        return [
-            user_schema.UserPrivate.model_validate(user) for user in await cls._get_many({
-                'authorization': authorization,
-                'pagination': pagination,
-            })]
+        return await cls._get_many_projected({
+            'authorization': authorization,
+            'session': session,
+            'conditional': conditional,
+            'pagination': pagination,
+        }, user_schema.UserPrivate)
 
     @classmethod
     async def by_id(
         cls,
         user_id: types.User.id,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
-            auth_utils.make_get_auth_dependency(required_scopes={'admin'}))]
+            auth_utils.make_get_auth_dependency(required_scopes={'admin'}))],
+        conditional: base.ConditionalDepends = None
     ) -> user_schema.UserPrivate:
         return user_schema.UserPrivate.model_validate(
             await cls._get({
                 'authorization': authorization,
+                'session': session,
+                'conditional': conditional,
                 'id': user_id,
             })
         )
@@ -152,12 +171,14 @@ class UserAdminRouter(_Base):
     async def create(
         cls,
         user_create_admin: user_schema.UserAdminCreate,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
             auth_utils.make_get_auth_dependency(required_scopes={'admin'}))]
     ) -> user_schema.UserPrivate:
 
         return user_schema.UserPrivate.model_validate(await cls._post({
             'authorization': authorization,
+            'session': session,
             'create_model': user_create_admin,
         })
         )
@@ -167,11 +188,13 @@ class UserAdminRouter(_Base):
         cls,
         user_id: types.User.id,
         user_update_admin: user_schema.UserAdminUpdate,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
             auth_utils.make_get_auth_dependency(required_scopes={'admin'}))]
     ) -> user_schema.UserPrivate:
         return user_schema.UserPrivate.model_validate(await cls._patch({
             'authorization': authorization,
+            'session': session,
             'id': user_id,
             'update_model': user_update_admin,
         }))
@@ -180,16 +203,18 @@ class UserAdminRouter(_Base):
     async def delete(
         cls,
         user_id: types.User.id,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
             auth_utils.make_get_auth_dependency(required_scopes={'admin'}))]
     ):
         return await cls._delete({
             'authorization': authorization,
+            'session': session,
             'id': user_id,
         })
 
     def _set_routes(self):
-        self.router.get('/')(self.list)
+        self.router.get('/')(base.json_route(self.list))
         self.router.get('/{user_id}')(self.by_id)
         self.router.post('/')(self.create)
         self.router.patch('/{user_id}')(self.update)
@@ -1,7 +1,7 @@
-from arbor_imago import core
-from arbor_imago.core import types, config
+from arbor_imago.core import types, config, dependencies
 from arbor_imago.models.tables import UserAccessToken as UserAccessTokenTable
 from arbor_imago.services.models.user_access_token import UserAccessToken as UserAccessTokenService
+from arbor_imago.services import counters
 from arbor_imago.schemas import user_access_token as user_access_token_schema, pagination as pagination_schema, api as api_schema
 from arbor_imago.routers import user as user_router, base
 from arbor_imago.auth import utils as auth_utils
@@ -40,30 +40,36 @@ class UserAccessTokenRouter(_Base):
     @classmethod
     async def list(
         cls,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
             auth_utils.make_get_auth_dependency())],
         pagination: pagination_schema.Pagination = Depends(
-            user_access_token_pagination)
-
+            user_access_token_pagination),
+        conditional: base.ConditionalDepends = None
     ) -> list[UserAccessTokenTable]:
 
+        # the service only lists the authorized user's own tokens
         return list(await cls._get_many({
             'authorization': authorization,
+            'session': session,
+            'conditional': conditional,
             'pagination': pagination,
-            'query': select(UserAccessTokenTable).where(
-                UserAccessTokenTable.user_id == authorization._user_id)
         }))
 
     @classmethod
     async def by_id(
         cls,
         user_access_token_id: types.UserAccessToken.id,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
-            auth_utils.make_get_auth_dependency())]
+            auth_utils.make_get_auth_dependency())],
+        conditional: base.ConditionalDepends = None
     ) -> UserAccessTokenTable:
 
         return await cls._get({
             'authorization': authorization,
+            'session': session,
+            'conditional': conditional,
             'id': user_access_token_id,
         })
 
@@ -72,6 +78,7 @@ class UserAccessTokenRouter(_Base):
         cls,
         response: Response,
         user_access_token_id: types.UserAccessToken.id,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
             auth_utils.make_get_auth_dependency())]
     ):
@@ -83,23 +90,29 @@ class UserAccessTokenRouter(_Base):
 
         return await cls._delete({
             'authorization': authorization,
+            'session': session,
             'id': user_access_token_id,
         })
 
     @classmethod
     async def count(
         cls,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
             auth_utils.make_get_auth_dependency())],
     ) -> int:
-        async with core.ASYNC_SESSIONMAKER() as session:
-            query = select(func.count()).select_from(UserAccessTokenTable).where(
-                UserAccessTokenTable.user_id == authorization._user_id)
-            return (await session.exec(query)).one()
+        counter = await counters.fetch_user(session, cast(types.User.id, authorization._user_id))
+        if counter is not None:
+            return counter.user_access_token_count
+
+        # not counted yet, see counters.rebuild
+        query = select(func.count()).select_from(UserAccessTokenTable).where(
+            UserAccessTokenTable.user_id == authorization._user_id)
+        return (await session.exec(query)).one()
 
     def _set_routes(self):
 
-        self.router.get('/', tags=[user_router._Base._TAG])(self.list)
+        self.router.get('/', tags=[user_router._Base._TAG])(base.json_route(self.list))
         self.router.get('/{user_access_token_id}')(self.by_id)
         self.router.delete('/{user_access_token_id}',
                            status_code=status.HTTP_204_NO_CONTENT)(self.delete)
@@ -114,14 +127,18 @@ class UserAccessTokenAdminRouter(_Base):
     async def list_by_user(
         cls,
         user_id: types.User.id,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
             auth_utils.make_get_auth_dependency(required_scopes={'admin'}))],
         pagination: pagination_schema.Pagination = Depends(
-            user_access_token_pagination)
+            user_access_token_pagination),
+        conditional: base.ConditionalDepends = None
     ) -> list[UserAccessTokenTable]:
 
         return list(await cls._get_many({
             'authorization': authorization,
+            'session': session,
+            'conditional': conditional,
             'pagination': pagination,
             'query': select(UserAccessTokenTable).where(
                 UserAccessTokenTable.user_id == user_id)
@@ -132,12 +149,16 @@ class UserAccessTokenAdminRouter(_Base):
     async def by_id(
         cls,
         user_access_token_id: types.UserAccessToken.id,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
-            auth_utils.make_get_auth_dependency(required_scopes={'admin'}))]
+            auth_utils.make_get_auth_dependency(required_scopes={'admin'}))],
+        conditional: base.ConditionalDepends = None
     ) -> UserAccessTokenTable:
 
         return await cls._get({
             'authorization': authorization,
+            'session': session,
+            'conditional': conditional,
             'id': user_access_token_id,
         })
 
@@ -145,12 +166,14 @@ class UserAccessTokenAdminRouter(_Base):
     async def create(
         cls,
         user_access_token_create_admin: user_access_token_schema.UserAccessTokenAdminCreate,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
             auth_utils.make_get_auth_dependency(required_scopes={'admin'}))]
     ) -> UserAccessTokenTable:
 
         return await cls._post({
             'authorization': authorization,
+            'session': session,
             'create_model': user_access_token_create_admin,
         })
 
@@ -159,6 +182,7 @@ class UserAccessTokenAdminRouter(_Base):
         cls,
         response: Response,
         user_access_token_id: types.UserAccessToken.id,
+        session: dependencies.SessionDepends,
         authorization: Annotated[auth_utils.GetAuthReturn, Depends(
             auth_utils.make_get_auth_dependency(required_scopes={'admin'}))]
     ):
@@ -170,13 +194,14 @@ class UserAccessTokenAdminRouter(_Base):
 
         return await cls._delete({
             'authorization': authorization,
+            'session': session,
             'id': user_access_token_id,
         })
 
     def _set_routes(self):
 
         self.router.get(
-            '/users/{user_id}/', tags=[user_router._Base._TAG])(self.list_by_user)
+            '/users/{user_id}/', tags=[user_router._Base._TAG])(base.json_route(self.list_by_user))
         self.router.get('/{user_access_token_id}')(self.by_id)
         self.router.post('/')(self.create)
         self.router.delete('/{user_access_token_id}',
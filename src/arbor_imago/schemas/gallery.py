@@ -1,10 +1,11 @@
 from arbor_imago.core import types
+from arbor_imago.schemas import FromAttributes
 
 from pydantic import BaseModel
 from typing import Optional
 
 
-class GalleryExport(BaseModel):
+class GalleryExport(FromAttributes):
     id: types.Gallery.id
     user_id: types.Gallery.user_id
     name: types.Gallery.name
@@ -54,6 +55,14 @@ class GalleryAdminCreate(_CreateBase):
     parent_id: Optional[types.Gallery.parent_id] = None
 
 
+class GalleryCounters(FromAttributes):
+    file_count: types.GalleryCounter.file_count = 0
+    file_size: types.GalleryCounter.file_size = 0
+    subtree_file_count: types.GalleryCounter.subtree_file_count = 0
+    subtree_file_size: types.GalleryCounter.subtree_file_size = 0
+    child_count: types.GalleryCounter.child_count = 0
+
+
 class GalleryAvailable(BaseModel):
     name: types.Gallery.name
     parent_id: Optional[types.Gallery.parent_id] = None
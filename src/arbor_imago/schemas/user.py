@@ -36,6 +36,11 @@ class UserPublic(UserExport):
     pass
 
 
-class UserPrivate(UserExport):
-    email: types.User.email
+class UserClaims(FromAttributes):
+    """The user as a stateless access token knows them, endpoints needing the profile read it"""
+    id: types.User.id
     user_role_id: types.User.user_role_id
+
+
+class UserPrivate(UserExport, UserClaims):
+    email: types.User.email
@@ -1,6 +1,7 @@
 from pydantic import BaseModel
 from arbor_imago.core import types
 from arbor_imago.schemas import FromAttributes
+from arbor_imago.schemas.auth_credential import JwtPayload
 
 
 class UserAccessTokenAdminUpdate(BaseModel):
@@ -25,3 +26,12 @@ class UserAccessTokenPrivate(UserAccessTokenExport):
     id: types.UserAccessToken.id
     expiry: types.AuthCredential.expiry
     user_id: types.User.id
+
+
+class StatelessJwtPayload(JwtPayload[types.UserAccessToken.id]):
+    """An access token that authenticates on its own claims, sub is the user access token that refreshes it"""
+
+    user_id: types.User.id
+    user_role_id: types.User.user_role_id
+    # bit n set for scope id n
+    scopes: int
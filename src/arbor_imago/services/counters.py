@@ -0,0 +1,244 @@
+"""Denormalized totals of galleries and users, kept by the services in the same transaction as the writes they count
+
+Reading a count is a primary key lookup instead of a COUNT or SUM over the files and credentials. Every change is an
+UPDATE adding a delta, so concurrent writers never overwrite each other's counts. Soft deleted galleries stop counting
+when they are marked, the purge removing them later changes nothing. Writes that bypass the services, and databases
+that predate the counters, are set right by `rebuild`.
+"""
+
+from arbor_imago.core import types
+from arbor_imago.models.tables import Gallery as GalleryTable, GalleryCounter as GalleryCounterTable, \
+    User as UserTable, UserCounter as UserCounterTable, File as FileTable, ApiKey as ApiKeyTable, \
+    UserAccessToken as UserAccessTokenTable
+from arbor_imago.services.models import base
+
+from sqlmodel import SQLModel, select, col, func, delete, update
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy import ColumnElement, Select, exists
+from collections import Counter, defaultdict
+from collections.abc import Iterable, Sequence
+from typing import Type
+
+
+class QuotaExceededError(base.NotAvailableError):
+    pass
+
+
+def _build_increment(table: Type[SQLModel], *whereclause: ColumnElement[bool], **deltas: int):
+    return update(table).where(*whereclause).values(
+        {field: getattr(table, field) + delta for field, delta in deltas.items()}
+    ).execution_options(synchronize_session=False)
+
+
+def _build_select_ancestor_ids(gallery_id: types.Gallery.id) -> Select[tuple[types.Gallery.id]]:
+    """The gallery and all of its ancestors"""
+
+    ancestors = select(col(GalleryTable.id), col(GalleryTable.parent_id)).where(
+        col(GalleryTable.id) == gallery_id).cte('ancestors', recursive=True)
+    ancestors = ancestors.union_all(
+        select(col(GalleryTable.id), col(GalleryTable.parent_id)).join(
+            ancestors, col(GalleryTable.id) == ancestors.c.parent_id)
+    )
+    return select(ancestors.c.id)
+
+
+async def add_to_subtrees(session: AsyncSession, gallery_id: types.Gallery.id, file_count: int, file_size: int) -> None:
+    """Add to the subtree totals of the gallery and all of its ancestors"""
+
+    if file_count or file_size:
+        await session.exec(_build_increment(
+            GalleryCounterTable, col(GalleryCounterTable.gallery_id).in_(_build_select_ancestor_ids(gallery_id)),
+            subtree_file_count=file_count, subtree_file_size=file_size))
+
+
+async def add_to_user(session: AsyncSession, user_id: types.User.id | ColumnElement[types.User.id], **deltas: int) -> None:
+    if any(deltas.values()):
+        await session.exec(_build_increment(UserCounterTable, col(UserCounterTable.user_id) == user_id, **deltas))
+
+
+async def add_files(session: AsyncSession, gallery_id: types.Gallery.id, file_count: int, file_size: int, quota: int | None = None) -> None:
+    """Count files added to, or with negative counts removed from, a gallery
+
+    With a `quota`, raises QuotaExceededError instead when the gallery's owner would hold more than `quota` bytes.
+    The check and the increment are one UPDATE, so concurrent uploads cannot both slip under the quota.
+    """
+
+    owner_id = select(col(GalleryTable.user_id)).where(col(GalleryTable.id) == gallery_id).scalar_subquery()
+
+    if quota is not None and file_size > 0:
+        result = await session.exec(_build_increment(
+            UserCounterTable, col(UserCounterTable.user_id) == owner_id,
+            col(UserCounterTable.file_size) + file_size <= quota,
+            file_count=file_count, file_size=file_size))
+        # a user without counters has never been counted, rebuild counts them, until then there is nothing to limit
+        if result.rowcount == 0 and (await session.exec(select(exists().where(col(UserCounterTable.user_id) == owner_id)))).one():
+            raise QuotaExceededError('Storage quota of {} bytes exceeded'.format(quota))
+    else:
+        await add_to_user(session, owner_id, file_count=file_count, file_size=file_size)
+
+    if file_count or file_size:
+        await session.exec(_build_increment(
+            GalleryCounterTable, col(GalleryCounterTable.gallery_id) == gallery_id,
+            file_count=file_count, file_size=file_size))
+    await add_to_subtrees(session, gallery_id, file_count, file_size)
+
+
+async def add_galleries(session: AsyncSession, galleries: Sequence[GalleryTable]) -> None:
+    """Start the counters of new galleries, and count them as their parents' children"""
+
+    session.add_all([GalleryCounterTable(gallery_id=gallery.id) for gallery in galleries])
+    for parent_id, child_count in Counter(gallery.parent_id for gallery in galleries if gallery.parent_id is not None).items():
+        await session.exec(_build_increment(
+            GalleryCounterTable, col(GalleryCounterTable.gallery_id) == parent_id, child_count=child_count))
+
+
+async def add_users(session: AsyncSession, user_ids: Iterable[types.User.id]) -> None:
+    """Start the counters of new users"""
+
+    session.add_all([UserCounterTable(user_id=user_id) for user_id in user_ids])
+
+
+async def move_galleries(session: AsyncSession, moves: Sequence[tuple[types.Gallery.id, types.Gallery.parent_id | None, types.Gallery.parent_id | None]]) -> None:
+    """Carry the subtree totals of galleries whose (gallery_id, old parent_id, new parent_id) changed
+
+    Called once the new parents are flushed. The totals are all read before any is changed, which makes the result
+    independent of the order of the moves, even when one moved gallery is below another.
+    """
+
+    if not moves:
+        return
+    counters = {counter.gallery_id: counter for counter in (await session.exec(
+        select(GalleryCounterTable).where(col(GalleryCounterTable.gallery_id).in_([move[0] for move in moves]))
+        .execution_options(populate_existing=True))).all()}
+    totals = {gallery_id: (counter.subtree_file_count, counter.subtree_file_size)
+              for gallery_id, counter in counters.items()}
+
+    for gallery_id, old_parent_id, new_parent_id in moves:
+        file_count, file_size = totals.get(gallery_id, (0, 0))
+        if old_parent_id is not None:
+            await add_to_subtrees(session, old_parent_id, -file_count, -file_size)
+            await session.exec(_build_increment(
+                GalleryCounterTable, col(GalleryCounterTable.gallery_id) == old_parent_id, child_count=-1))
+        if new_parent_id is not None:
+            await add_to_subtrees(session, new_parent_id, file_count, file_size)
+            await session.exec(_build_increment(
+                GalleryCounterTable, col(GalleryCounterTable.gallery_id) == new_parent_id, child_count=1))
+
+
+async def change_gallery_owners(session: AsyncSession, changes: Sequence[tuple[types.Gallery.id, types.User.id, types.User.id]]) -> None:
+    """Carry the files directly in galleries whose (gallery_id, old user_id, new user_id) changed to the new owner"""
+
+    if not changes:
+        return
+    counters = {counter.gallery_id: counter for counter in (await session.exec(
+        select(GalleryCounterTable).where(col(GalleryCounterTable.gallery_id).in_([change[0] for change in changes]))
+        .execution_options(populate_existing=True))).all()}
+
+    for gallery_id, old_user_id, new_user_id in changes:
+        if gallery_id not in counters:
+            continue
+        counter = counters[gallery_id]
+        await add_to_user(session, old_user_id, file_count=-counter.file_count, file_size=-counter.file_size)
+        await add_to_user(session, new_user_id, file_count=counter.file_count, file_size=counter.file_size)
+
+
+async def remove_galleries(session: AsyncSession, subtree_ids: Select[tuple[types.Gallery.id]]) -> None:
+    """Stop counting the galleries about to be soft deleted, `subtree_ids` selects them and all of their descendants
+
+    Called before the galleries are marked. Each removed subtree is subtracted once, at its top, from the galleries
+    above it, and the files directly in each removed gallery from the gallery's owner.
+    """
+
+    rows = (await session.exec(
+        select(col(GalleryTable.id), col(GalleryTable.parent_id), col(GalleryTable.user_id),
+               func.coalesce(col(GalleryCounterTable.file_count), 0),
+               func.coalesce(col(GalleryCounterTable.file_size), 0),
+               func.coalesce(col(GalleryCounterTable.subtree_file_count), 0),
+               func.coalesce(col(GalleryCounterTable.subtree_file_size), 0))
+        .outerjoin(GalleryCounterTable, col(GalleryCounterTable.gallery_id) == col(GalleryTable.id))
+        .where(col(GalleryTable.id).in_(subtree_ids))
+    )).all()
+    removed = {row[0] for row in rows}
+
+    by_user: defaultdict[types.User.id, list[int]] = defaultdict(lambda: [0, 0])
+    for gallery_id, parent_id, user_id, file_count, file_size, subtree_file_count, subtree_file_size in rows:
+        by_user[user_id][0] += file_count
+        by_user[user_id][1] += file_size
+        if parent_id is not None and parent_id not in removed:
+            await add_to_subtrees(session, parent_id, -subtree_file_count, -subtree_file_size)
+            await session.exec(_build_increment(
+                GalleryCounterTable, col(GalleryCounterTable.gallery_id) == parent_id, child_count=-1))
+
+    for user_id, (file_count, file_size) in by_user.items():
+        await add_to_user(session, user_id, file_count=-file_count, file_size=-file_size)
+
+
+async def fetch_gallery(session: AsyncSession, gallery_id: types.Gallery.id) -> GalleryCounterTable | None:
+    return (await session.exec(select(GalleryCounterTable).where(col(GalleryCounterTable.gallery_id) == gallery_id)
+                               .execution_options(populate_existing=True))).one_or_none()
+
+
+async def fetch_user(session: AsyncSession, user_id: types.User.id) -> UserCounterTable | None:
+    return (await session.exec(select(UserCounterTable).where(col(UserCounterTable.user_id) == user_id)
+                               .execution_options(populate_existing=True))).one_or_none()
+
+
+async def rebuild(session: AsyncSession) -> tuple[int, int]:
+    """Recount every gallery and user from the files and credentials, returns how many of each were counted
+
+    The counts are grouped in the database, the subtree totals summed over the gallery tree in memory, galleries
+    being few enough to hold at once. Soft deleted galleries and users are left uncounted, as the services leave them.
+    """
+
+    galleries = (await session.exec(select(col(GalleryTable.id), col(GalleryTable.parent_id), col(GalleryTable.user_id)))).all()
+    users = (await session.exec(select(col(UserTable.id)))).all()
+
+    files: dict[types.Gallery.id, tuple[int, int]] = {
+        gallery_id: (file_count, file_size) for gallery_id, file_count, file_size in (await session.exec(
+            select(col(FileTable.gallery_id), func.count(), func.coalesce(func.sum(col(FileTable.size)), 0))
+            .group_by(col(FileTable.gallery_id))
+        )).all()
+    }
+
+    gallery_counters: dict[types.Gallery.id, dict[str, int]] = {}
+    children: defaultdict[types.Gallery.id | None, list[types.Gallery.id]] = defaultdict(list)
+    for gallery_id, parent_id, _ in galleries:
+        file_count, file_size = files.get(gallery_id, (0, 0))
+        gallery_counters[gallery_id] = {'file_count': file_count, 'file_size': file_size,
+                                        'subtree_file_count': file_count, 'subtree_file_size': file_size,
+                                        'child_count': 0}
+        children[parent_id].append(gallery_id)
+
+    # children before their parents, each subtree total is then its own files plus its children's totals
+    order: list[types.Gallery.id] = []
+    stack = [gallery_id for parent_id, ids in children.items() if parent_id not in gallery_counters for gallery_id in ids]
+    while stack:
+        gallery_id = stack.pop()
+        order.append(gallery_id)
+        stack.extend(children.get(gallery_id, ()))
+    for gallery_id in reversed(order):
+        counter = gallery_counters[gallery_id]
+        counter['child_count'] = len(children.get(gallery_id, ()))
+        for child_id in children.get(gallery_id, ()):
+            counter['subtree_file_count'] += gallery_counters[child_id]['subtree_file_count']
+            counter['subtree_file_size'] += gallery_counters[child_id]['subtree_file_size']
+
+    user_counters: dict[types.User.id, dict[str, int]] = {user_id: {
+        'file_count': 0, 'file_size': 0, 'api_key_count': 0, 'user_access_token_count': 0} for user_id in users}
+    for gallery_id, _, user_id in galleries:
+        if user_id in user_counters:
+            user_counters[user_id]['file_count'] += gallery_counters[gallery_id]['file_count']
+            user_counters[user_id]['file_size'] += gallery_counters[gallery_id]['file_size']
+    for table, field in ((ApiKeyTable, 'api_key_count'), (UserAccessTokenTable, 'user_access_token_count')):
+        for user_id, count in (await session.exec(select(col(table.user_id), func.count()).group_by(col(table.user_id)))).all():
+            if user_id in user_counters:
+                user_counters[user_id][field] = count
+
+    await session.exec(delete(GalleryCounterTable))
+    await session.exec(delete(UserCounterTable))
+    # flushed as one executemany per table
+    session.add_all([GalleryCounterTable(gallery_id=gallery_id, **counter)
+                    for gallery_id, counter in gallery_counters.items()])
+    session.add_all([UserCounterTable(user_id=user_id, **counter) for user_id, counter in user_counters.items()])
+    await session.commit()
+    return len(gallery_counters), len(user_counters)
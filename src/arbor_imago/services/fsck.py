@@ -0,0 +1,205 @@
+"""Consistency check between GALLERIES_DIR and the gallery, file and image file metadata tables
+
+Each gallery's directory listing and its File rows are both taken in name order and merge-joined. Rows are read in
+keyset pages, so no cursor stays open and repairs can be committed as the check goes. Memory is bounded by the
+gallery directory map and the largest single directory, not by the size of the library.
+"""
+
+from arbor_imago import utils
+from arbor_imago.core import config, types
+from arbor_imago.models.tables import File as FileTable, ImageFileMetadata as ImageFileMetadataTable, Gallery as GalleryTable
+from arbor_imago.services import counters
+from arbor_imago.services.models import base
+from arbor_imago.services.models.gallery import Gallery as GalleryService
+
+from sqlmodel import select, col, func, delete, update
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy import ColumnElement
+from collections.abc import AsyncIterator, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple, Literal
+import asyncio
+import os
+import pathlib
+
+PAGE_SIZE = 1000
+
+ProblemKind = Literal['missing', 'orphan', 'size_mismatch', 'orphan_dir']
+
+
+class Problem(NamedTuple):
+    kind: ProblemKind
+    path: pathlib.Path
+    file_id: types.File.id | None = None
+    image_version_id: types.ImageVersion.id | None = None
+    db_size: types.File.size | None = None
+    disk_size: types.File.size | None = None
+
+
+class _FileRow(NamedTuple):
+    name: str
+    id: types.File.id
+    size: types.File.size | None
+    image_version_id: types.ImageVersion.id | None
+
+
+def _build_file_name(session: AsyncSession, layout: types.MediaLayout) -> ColumnElement[str]:
+    """The on-disk name of a file, ordered the way Python orders strings"""
+
+    name = (col(FileTable.id) if layout == 'id' else col(FileTable.stem)) + \
+        func.coalesce(col(FileTable.suffix), '')
+    # SQLite compares bytes, which for UTF-8 is code point order, other databases need to be told
+    if session.get_bind().dialect.name != 'sqlite':
+        name = name.collate('C')
+    return name
+
+
+async def _fetch_file_page(session: AsyncSession, name: ColumnElement[str], gallery_id: types.Gallery.id, after: str | None) -> list[_FileRow]:
+
+    query = select(name, col(FileTable.id), col(FileTable.size), col(ImageFileMetadataTable.version_id)).outerjoin(
+        ImageFileMetadataTable, col(ImageFileMetadataTable.file_id) == col(FileTable.id)
+    ).where(col(FileTable.gallery_id) == gallery_id)
+    if after is not None:
+        query = query.where(name > after)
+    rows = (await session.exec(query.order_by(name).limit(PAGE_SIZE))).all()
+    return [_FileRow(*row) for row in rows]
+
+
+def _list_dir(dir: pathlib.Path) -> list[os.DirEntry]:
+    try:
+        with os.scandir(dir) as entries:
+            return sorted(entries, key=lambda entry: entry.name)
+    except FileNotFoundError:
+        return []
+
+
+def _size(entry: os.DirEntry) -> int:
+    return entry.stat(follow_symlinks=False).st_size
+
+
+async def _check_gallery(session: AsyncSession, executor: ThreadPoolExecutor, layout: types.MediaLayout, gallery_id: types.Gallery.id, dir: pathlib.Path, gallery_dirs: set[pathlib.Path], repair: bool, counted: bool) -> AsyncIterator[Problem]:
+
+    loop = asyncio.get_running_loop()
+    entries = await loop.run_in_executor(executor, _list_dir, dir)
+
+    disk: list[os.DirEntry] = []
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            # in the tree layout child galleries live inside their parent's directory
+            if pathlib.Path(entry.path) not in gallery_dirs:
+                yield Problem('orphan_dir', pathlib.Path(entry.path))
+        else:
+            disk.append(entry)
+
+    name = _build_file_name(session, layout)
+    i = 0
+    after: str | None = None
+    while True:
+        page = await _fetch_file_page(session, name, gallery_id, after)
+
+        orphans: list[os.DirEntry] = []
+        missing: list[_FileRow] = []
+        matched: list[tuple[_FileRow, os.DirEntry]] = []
+        for row in page:
+            while i < len(disk) and disk[i].name < row.name:
+                orphans.append(disk[i])
+                i += 1
+            if i < len(disk) and disk[i].name == row.name:
+                matched.append((row, disk[i]))
+                i += 1
+            else:
+                missing.append(row)
+        if len(page) < PAGE_SIZE:
+            orphans.extend(disk[i:])
+
+        # stat calls block, on slow storage running them side by side is what keeps the check fast
+        sizes = await asyncio.gather(*(loop.run_in_executor(executor, _size, entry) for _, entry in matched))
+        mismatched = [(row, entry, size) for (row, entry), size in zip(matched, sizes)
+                      if row.size != size]
+
+        for row in missing:
+            yield Problem('missing', dir / row.name, file_id=row.id, image_version_id=row.image_version_id, db_size=row.size)
+        for row, entry, size in mismatched:
+            if row.size is not None:
+                yield Problem('size_mismatch', pathlib.Path(entry.path), file_id=row.id, db_size=row.size, disk_size=size)
+        for entry in orphans:
+            yield Problem('orphan', pathlib.Path(entry.path))
+
+        if repair:
+            await _repair(session, executor, layout, gallery_id, missing, mismatched, orphans, counted)
+
+        if len(page) < PAGE_SIZE:
+            return
+        after = page[-1].name
+
+
+async def _repair(session: AsyncSession, executor: ThreadPoolExecutor, layout: types.MediaLayout, gallery_id: types.Gallery.id, missing: Sequence[_FileRow], mismatched: Sequence[tuple[_FileRow, os.DirEntry, int]], orphans: Sequence[os.DirEntry], counted: bool) -> None:
+    """Make the rows match the disk, bytes are never deleted
+
+    The counters follow, unless the gallery is soft deleted, its files stopped counting when it was marked.
+    """
+
+    if missing:
+        # image file metadata goes with the rows through its foreign key
+        await session.exec(delete(FileTable).where(col(FileTable.id).in_([row.id for row in missing])))
+        if counted:
+            await counters.add_files(session, gallery_id, -len(missing), -sum(row.size or 0 for row in missing))
+    for row, _, size in mismatched:
+        await session.exec(update(FileTable).where(col(FileTable.id) == row.id).values(size=size))
+    if counted:
+        await counters.add_files(session, gallery_id, 0, sum(size - (row.size or 0) for row, _, size in mismatched))
+
+    # files named by id have no row to go back to, only named ones can be adopted
+    if layout == 'tree' and orphans:
+        loop = asyncio.get_running_loop()
+        sizes = await asyncio.gather(*(loop.run_in_executor(executor, _size, entry) for entry in orphans))
+        for entry, size in zip(orphans, sizes):
+            name = pathlib.PurePath(entry.name)
+            # the suffix keeps its case, so the adopted row names the file exactly
+            session.add(FileTable(id=types.File.id(utils.generate_uuid()), stem=name.stem,
+                                  suffix=name.suffix or None, gallery_id=gallery_id, size=size))
+        if counted:
+            await counters.add_files(session, gallery_id, len(orphans), sum(sizes))
+
+    await session.commit()
+
+
+async def _check_containers(executor: ThreadPoolExecutor, dir: pathlib.Path, gallery_dirs: set[pathlib.Path], containers: set[pathlib.Path]) -> AsyncIterator[Problem]:
+    """Walk the directories above the galleries, the root and the id layout's shards, for anything else there"""
+
+    for entry in await asyncio.get_running_loop().run_in_executor(executor, _list_dir, dir):
+        path = pathlib.Path(entry.path)
+        if path in gallery_dirs:
+            continue
+        if path in containers:
+            async for problem in _check_containers(executor, path, gallery_dirs, containers):
+                yield problem
+        elif entry.is_dir(follow_symlinks=False):
+            yield Problem('orphan_dir', path)
+        else:
+            yield Problem('orphan', path)
+
+
+async def check(session: AsyncSession, root: pathlib.Path | None = None, layout: types.MediaLayout | None = None, workers: int = 4, repair: bool = False) -> AsyncIterator[Problem]:
+    """Yield every File row whose bytes are missing or of another size, and every file or directory without a row
+
+    With `repair`, rows of missing files are deleted, sizes are corrected and, in the tree layout, orphan files are
+    adopted as new rows. Orphans in the id layout and orphan directories are only reported.
+    """
+
+    root = config.GALLERIES_DIR if root is None else root
+    layout = config.MEDIA_LAYOUT if layout is None else layout
+
+    # soft deleted galleries keep their files until the purge, they are not orphans
+    with base.soft_deleted_visible(session):
+        dirs = await GalleryService.get_all_dirs(session, root, layout)
+        deleted = set((await session.exec(select(col(GalleryTable.id)).where(col(GalleryTable.deleted_at).is_not(None)))).all())
+        gallery_dirs = set(dirs.values())
+        containers = {parent for dir in gallery_dirs for parent in dir.parents if parent.is_relative_to(root)}
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            async for problem in _check_containers(executor, root, gallery_dirs, containers):
+                yield problem
+            for gallery_id, dir in sorted(dirs.items()):
+                async for problem in _check_gallery(session, executor, layout, gallery_id, dir, gallery_dirs, repair, gallery_id not in deleted):
+                    yield problem
@@ -0,0 +1,35 @@
+"""Where gallery media lives on disk
+
+In the 'tree' layout directories are named after galleries and nested like them. It is readable, but a rename or a
+move renames directories, and every path needs the gallery's ancestors from the database.
+
+In the 'id' layout a gallery's directory is keyed by its id and a file by its own id, fanned out over SHARD_LEVELS
+levels of SHARD_WIDTH characters so no directory grows too large. A path is a pure function of the ids, renames and
+moves never touch the disk. Gallery.build_tree_view produces a readable tree of symlinks on demand.
+"""
+
+from arbor_imago.core import types
+from arbor_imago.models.tables import File as FileTable
+
+import pathlib
+
+SHARD_LEVELS = 2
+SHARD_WIDTH = 2
+
+
+def sharded(root: pathlib.Path, id: str) -> pathlib.Path:
+    """root/ab/cd/abcd..., the id's leading characters spread entries over SHARD_LEVELS levels of directories"""
+
+    return root.joinpath(*(id[level * SHARD_WIDTH:(level + 1) * SHARD_WIDTH] for level in range(SHARD_LEVELS)), id)
+
+
+def gallery_dir(root: pathlib.Path, gallery_id: types.Gallery.id) -> pathlib.Path:
+    return sharded(root, gallery_id)
+
+
+def file_name(file: FileTable) -> str:
+    return file.id + ('' if file.suffix is None else file.suffix)
+
+
+def file_path(root: pathlib.Path, file: FileTable) -> pathlib.Path:
+    return gallery_dir(root, file.gallery_id) / file_name(file)
@@ -2,11 +2,14 @@ from arbor_imago import utils
 from arbor_imago.core import types
 from arbor_imago.models.tables import ApiKey as ApiKeyTable, ApiKeyScope as ApiKeyScopeTable
 from arbor_imago.schemas import api_key as api_key_schema, auth_credential as auth_credential_schema
+from arbor_imago.services import counters
 from arbor_imago.services.models import auth_credential as auth_credential_service, base
 
 from sqlmodel import select, col
+from sqlmodel.sql.expression import SelectOfScalar
 from sqlmodel.ext.asyncio.session import AsyncSession
 import datetime as datetime_module
+from collections import Counter
 from typing import cast
 from collections.abc import Sequence
 
@@ -51,14 +54,36 @@ class ApiKey(
 
     @classmethod
     async def get_scope_ids(cls, session, inst):
+        await cls.load_related(session, [inst], ApiKeyTable.api_key_scopes)
         return [api_key_scope.scope_id for api_key_scope in inst.api_key_scopes]
 
     @classmethod
-    async def is_available(cls, session: AsyncSession, api_key_available_admin: api_key_schema.ApiKeyAdminAvailable) -> bool:
-        return (await session.exec(select(cls._MODEL).where(
+    def _build_select_available(cls, api_key_available_admin: api_key_schema.ApiKeyAdminAvailable) -> SelectOfScalar[ApiKeyTable]:
+        return select(cls._MODEL).where(
+            cls._MODEL.user_id == cast(
+                types.User.id, api_key_available_admin.user_id),
             cls._MODEL.name == api_key_available_admin.name,
-            cls._MODEL.user_id == cast(types.User.id, api_key_available_admin.user_id
-                                       )))).one_or_none() is None
+        )
+
+    @classmethod
+    async def is_available(cls, session: AsyncSession, api_key_available_admin: api_key_schema.ApiKeyAdminAvailable) -> bool:
+        return (await session.exec(cls._build_select_available(api_key_available_admin))).one_or_none() is None
+
+    @classmethod
+    async def _after_create(cls, session, model_insts):
+        for user_id, count in Counter(inst.user_id for inst in model_insts).items():
+            await counters.add_to_user(session, user_id, api_key_count=count)
+
+    @classmethod
+    async def _after_delete(cls, session, model_insts):
+        for user_id, count in Counter(inst.user_id for inst in model_insts).items():
+            await counters.add_to_user(session, user_id, api_key_count=-count)
+
+    @classmethod
+    def _build_visibility_predicate(cls, authorized_user_id, admin):
+        if admin:
+            return None
+        return col(cls._MODEL.user_id) == authorized_user_id
 
     @classmethod
     async def _check_authorization_new(cls, params):
@@ -78,24 +103,11 @@ class ApiKey(
                 )
 
     @classmethod
-    async def _check_validation_post(cls, params):
-        if not await cls.is_available(params['session'], api_key_schema.ApiKeyAdminAvailable(
-            **params['create_model'].model_dump(exclude_unset=True),
-        )):
-            raise base.NotAvailableError(
-                'Cannot create API Key {} for user {}, not available'.format(
-                    str(params['create_model']), params['authorized_user_id']
+    def _unique_violation_error(cls, model_inst, error):
+        if base.violated_constraint(error) == 'uq_api_key_user_id_name':
+            return base.NotAvailableError(
+                'API Key name `{}` is not available for user {}'.format(
+                    model_inst.name, model_inst.user_id
                 )
             )
-
-    @classmethod
-    async def _check_validation_patch(cls, params):
-        if 'name' in params['update_model'].model_fields_set:
-            if not await cls.is_available(params['session'], api_key_schema.ApiKeyAdminAvailable(
-                    name=cast(types.ApiKey.name, params['update_model'].name), user_id=cast(types.User.id, params['authorized_user_id']))):
-                raise base.NotAvailableError(
-                    'Cannot update API Key {} for user {}, not available'.format(
-                        str(params['update_model']
-                            ), params['authorized_user_id']
-                    )
-                )
+        return super()._unique_violation_error(model_inst, error)
@@ -1,4 +1,5 @@
-from sqlmodel import Field, Relationship, select, SQLModel
+from sqlmodel import col, Field, Relationship, select, SQLModel
+from sqlalchemy import tuple_
 from typing import TYPE_CHECKING, TypedDict, Optional, ClassVar, Annotated, Type
 
 from arbor_imago.core import types
@@ -28,6 +29,17 @@ class ApiKeyScope(base.Service[
     def _build_select_by_id(cls, id):
         return select(cls._MODEL).where(cls._MODEL.api_key_id == id.api_key_id, cls._MODEL.scope_id == id.scope_id)
 
+    @classmethod
+    def _build_where_by_ids(cls, ids):
+        return tuple_(col(cls._MODEL.api_key_id), col(cls._MODEL.scope_id)).in_(ids)
+
+    @classmethod
+    def _build_visibility_predicate(cls, authorized_user_id, admin):
+        if admin:
+            return None
+        return col(cls._MODEL.api_key_id).in_(
+            select(col(ApiKeyTable.id)).where(col(ApiKeyTable.user_id) == authorized_user_id))
+
     @classmethod
     async def _check_authorization_new(cls, params):
 
@@ -55,15 +67,3 @@ class ApiKeyScope(base.Service[
             if api_key.user_id != params['authorized_user_id']:
                 raise base.NotFoundError(
                     ApiKeyTable, params['model_inst'].api_key_id)
-
-    @classmethod
-    async def _check_validation_post(cls, params):
-
-        id = types.ApiKeyScopeId(
-            api_key_id=params['create_model'].api_key_id,
-            scope_id=params['create_model'].scope_id
-        )
-
-        if await cls.fetch_by_id(params['session'], id):
-            raise base.AlreadyExistsError(
-                cls._MODEL, id)
@@ -1,10 +1,17 @@
-from sqlmodel import SQLModel, select
-from sqlalchemy.orm import InstrumentedAttribute
+from sqlmodel import SQLModel, select, col, delete, update
+from sqlalchemy import ColumnElement, Row, UniqueConstraint, inspect as sa_inspect, event, select as sa_select
+from sqlalchemy.orm import InstrumentedAttribute, Session, ORMExecuteState, selectinload, with_loader_criteria, ONETOMANY
+from sqlalchemy.exc import IntegrityError
 from sqlmodel.sql.expression import SelectOfScalar
 from sqlmodel.ext.asyncio.session import AsyncSession
 from typing import Any, Protocol, Unpack, TypeVar, TypedDict, Generic, NotRequired, Literal, Self, ClassVar, Type, Optional
 from pydantic import BaseModel
-from collections.abc import Sequence
+from collections.abc import Sequence, Mapping, Iterable
+from contextlib import asynccontextmanager, contextmanager
+from functools import cache
+import asyncio
+import datetime as datetime_module
+import re
 
 from arbor_imago import models
 from arbor_imago.core import types
@@ -64,6 +71,18 @@ class DeleteParams(Generic[types.TId], CRUDParamsBase, WithId[types.TId]):
     pass
 
 
+class CreateManyParams(Generic[TCreateModel_contra], CRUDParamsBase):
+    create_models: Sequence[TCreateModel_contra]
+
+
+class UpdateManyParams(Generic[types.TId, TUpdateModel_contra], CRUDParamsBase):
+    update_models: Mapping[types.TId, TUpdateModel_contra]
+
+
+class DeleteManyParams(Generic[types.TId], CRUDParamsBase):
+    ids: Sequence[types.TId]
+
+
 CheckAuthorizationExistingOperation = Literal['read', 'update', 'delete']
 
 
@@ -113,11 +132,18 @@ class HasBuildSelectById(Protocol[models.TModel, types.TId_contra]):
         ...
 
 
+class HasBuildWhereByIds(Protocol[types.TId_contra]):
+    @classmethod
+    def _build_where_by_ids(cls, ids: Sequence[types.TId_contra]) -> ColumnElement[bool]:
+        ...
+
+
 class SimpleIdModelService(
     Generic[models.TSimpleModel, types.TSimpleId],
     HasModel[models.TSimpleModel],
     HasModelId[models.TSimpleModel, types.TSimpleId],
     HasBuildSelectById[models.TSimpleModel, types.TSimpleId],
+    HasBuildWhereByIds[types.TSimpleId],
 ):
 
     _MODEL: Type[models.TSimpleModel]
@@ -130,6 +156,10 @@ class SimpleIdModelService(
     def _build_select_by_id(cls, id: types.TSimpleId) -> SelectOfScalar[models.TSimpleModel]:
         return select(cls._MODEL).where(cls._MODEL.id == id)
 
+    @classmethod
+    def _build_where_by_ids(cls, ids: Sequence[types.TSimpleId]) -> ColumnElement[bool]:
+        return col(cls._MODEL.id).in_(ids)  # type: ignore
+
 
 class ServiceError(Exception):
     error_message: str
@@ -165,6 +195,256 @@ class UnauthorizedError(ServiceError):
     pass
 
 
+def is_unique_violation(error: IntegrityError) -> bool:
+    """Whether an IntegrityError was raised by a unique or primary key constraint"""
+
+    # postgres drivers expose the SQLSTATE, sqlite only has the message
+    if getattr(error.orig, 'sqlstate', None) == '23505' or getattr(error.orig, 'pgcode', None) == '23505':
+        return True
+    return 'UNIQUE constraint failed' in str(error.orig)
+
+
+# sqlite names the index of an expression index, the columns otherwise, "user.email" or "api_key.user_id, api_key.name"
+_SQLITE_UNIQUE_VIOLATION = re.compile(
+    r"UNIQUE constraint failed: (?:index '(?P<index>[^']+)'|(?P<columns>.+))")
+
+
+def violated_constraint(error: IntegrityError) -> str | None:
+    """Name of the constraint an IntegrityError was raised by, None for unnamed ones"""
+
+    # psycopg exposes it on diag, asyncpg on its own exception, which the adapted one wraps
+    for source in (getattr(error.orig, 'diag', None), error.orig, getattr(error.orig, '__cause__', None)):
+        if (constraint_name := getattr(source, 'constraint_name', None)) is not None:
+            return constraint_name
+
+    match = _SQLITE_UNIQUE_VIOLATION.search(str(error.orig))
+    if match is None:
+        return None
+    if match['index'] is not None:
+        return match['index']
+
+    table_name, column_names = None, set()
+    for qualified in match['columns'].split(','):
+        table_name, _, column_name = qualified.strip().partition('.')
+        column_names.add(column_name)
+    table = SQLModel.metadata.tables.get(table_name)
+    if table is None:
+        return None
+    for index in table.indexes:
+        if index.unique and {column.name for column in index.columns} == column_names:
+            return str(index.name)
+    for constraint in table.constraints:
+        if isinstance(constraint, UniqueConstraint) and constraint.name is not None and {column.name for column in constraint.columns} == column_names:
+            return str(constraint.name)
+    return None
+
+
+def is_foreign_key_violation(error: IntegrityError) -> bool:
+    """Whether an IntegrityError was raised by a foreign key constraint"""
+
+    if getattr(error.orig, 'sqlstate', None) == '23503' or getattr(error.orig, 'pgcode', None) == '23503':
+        return True
+    return 'FOREIGN KEY constraint failed' in str(error.orig)
+
+
+@cache
+def _column_keys(model: Type[SQLModel]) -> frozenset[str]:
+    return frozenset(sa_inspect(model).column_attrs.keys())
+
+
+def _loaded_columns(model_inst: SQLModel) -> dict[str, Any]:
+    # what is already loaded, reading an expired attribute here would mean a query
+    return {key: value for key, value in sa_inspect(model_inst).dict.items() if key in _column_keys(type(model_inst))}
+
+
+_UNIT_OF_WORK_KEY = 'unit_of_work'
+
+
+def in_unit_of_work(session: AsyncSession) -> bool:
+    return session.info.get(_UNIT_OF_WORK_KEY, False)
+
+
+@asynccontextmanager
+async def unit_of_work(session: AsyncSession):
+    """Defer the commit of every Service write made with this session until the block exits, then commit once
+
+    Service writes inside the block only flush, so they still see each other's rows and constraint errors surface
+    at the write that caused them. Any exception rolls the whole block back. Nested blocks join the outer one.
+    """
+
+    if in_unit_of_work(session):
+        yield session
+        return
+
+    session.info[_UNIT_OF_WORK_KEY] = True
+    try:
+        yield session
+        await session.commit()
+    except BaseException:
+        await session.rollback()
+        raise
+    finally:
+        del session.info[_UNIT_OF_WORK_KEY]
+
+
+_SOFT_DELETED_VISIBLE_KEY = 'soft_deleted_visible'
+
+
+def is_soft_deletable(model: type) -> bool:
+    return hasattr(model, 'deleted_at')
+
+
+@contextmanager
+def soft_deleted_visible(session: AsyncSession):
+    """Let reads made with this session return soft deleted rows, for the purge"""
+
+    previous = session.info.get(_SOFT_DELETED_VISIBLE_KEY, False)
+    session.info[_SOFT_DELETED_VISIBLE_KEY] = True
+    try:
+        yield session
+    finally:
+        session.info[_SOFT_DELETED_VISIBLE_KEY] = previous
+
+
+def build_mark_deleted(model: Type[SQLModel], *whereclause: ColumnElement[bool]):
+    """UPDATE marking the matching rows that are not deleted yet as soft deleted"""
+
+    return update(model).where(*whereclause).where(col(getattr(model, 'deleted_at')).is_(None)).values(
+        deleted_at=datetime_module.datetime.now(datetime_module.UTC)).execution_options(synchronize_session=False)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _hide_soft_deleted(orm_execute_state: ORMExecuteState) -> None:
+    # every ORM read, whichever query builder or relationship load it came from, skips soft deleted rows
+    if not orm_execute_state.is_select or orm_execute_state.is_column_load or orm_execute_state.is_relationship_load:
+        return
+    if orm_execute_state.session.info.get(_SOFT_DELETED_VISIBLE_KEY, False):
+        return
+    for mapper in orm_execute_state.all_mappers:
+        if is_soft_deletable(mapper.class_):
+            orm_execute_state.statement = orm_execute_state.statement.options(with_loader_criteria(
+                mapper.class_, lambda model: model.deleted_at == None, include_aliases=True))
+
+
+_LOADERS_KEY = 'loaders'
+
+
+class Loader(Generic[models.TModel, types.TId]):
+    """Per-session loader in the style of DataLoader
+
+    Instances already loaded are served without a query, and ids requested in the same event loop tick (e.g. from
+    asyncio.gather) are fetched together with a single `WHERE id IN (...)`. Misses are not remembered, so a row
+    added later in the session is still found.
+    """
+
+    def __init__(self, service: 'Type[Service[models.TModel, types.TId, Any, Any, Any]]', session: AsyncSession):
+        self._service = service
+        self._session = session
+        self._loaded: dict[types.TId, models.TModel] = {}
+        self._pending: dict[types.TId, asyncio.Future[models.TModel | None]] = {}
+        self._task: asyncio.Task[None] | None = None
+
+    def _get_loaded(self, id: types.TId) -> models.TModel | None:
+        model_inst = self._loaded.get(id)
+        if model_inst is None:
+            return None
+        # expired instances (e.g. after a commit) are reloaded rather than refreshed lazily
+        state = sa_inspect(model_inst)
+        if state.detached or state.expired_attributes or model_inst in self._session.deleted:
+            del self._loaded[id]
+            return None
+        return model_inst
+
+    def prime(self, model_insts: Iterable[models.TModel]) -> None:
+        for model_inst in model_insts:
+            self._loaded[self._service.model_id(model_inst)] = model_inst
+
+    def evict(self, ids: Iterable[types.TId] | None = None) -> None:
+        if ids is None:
+            self._loaded.clear()
+        else:
+            for id in ids:
+                self._loaded.pop(id, None)
+
+    async def load(self, id: types.TId) -> models.TModel | None:
+
+        if (model_inst := self._get_loaded(id)) is not None:
+            return model_inst
+
+        if id not in self._pending:
+            loop = asyncio.get_running_loop()
+            if not self._pending:
+                # the task first runs after the loads already scheduled in this tick, which join the batch. The loop
+                # only keeps a weak reference to its tasks, this one keeps it alive until it has run
+                self._task = loop.create_task(self._dispatch())
+            self._pending[id] = loop.create_future()
+
+        return await self._pending[id]
+
+    async def load_many(self, ids: Iterable[types.TId]) -> dict[types.TId, models.TModel]:
+        ids = list(dict.fromkeys(ids))
+        model_insts = await asyncio.gather(*(self.load(id) for id in ids))
+        return {id: model_inst for id, model_inst in zip(ids, model_insts) if model_inst is not None}
+
+    async def _dispatch(self) -> None:
+
+        pending, self._pending = self._pending, {}
+        try:
+            model_insts = await self._service.fetch_by_ids(self._session, list(pending))
+        except Exception as e:
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        self._loaded.update(model_insts)
+        for id, future in pending.items():
+            if not future.done():
+                future.set_result(model_insts.get(id))
+
+
+def _loaders(session: Session | AsyncSession) -> dict[Type[SQLModel], Loader]:
+    return session.info.setdefault(_LOADERS_KEY, {})
+
+
+@cache
+def _deletes_cascade_in_database(model: Type[SQLModel]) -> bool:
+    """Whether deleting a row lets the database delete or update rows of other tables"""
+    return any(relationship.passive_deletes and relationship.direction is ONETOMANY for relationship in sa_inspect(model).relationships)
+
+
+def _evict_all(session: Session) -> None:
+    for loader in _loaders(session).values():
+        loader.evict()
+
+
+@event.listens_for(Session, 'after_flush')
+def _evict_flushed(session: Session, flush_context) -> None:
+    # deleted rows must not be served again, new ones are picked up on the next load
+    loaders = _loaders(session)
+    for model_inst in session.deleted:
+        if _deletes_cascade_in_database(type(model_inst)):
+            # descendants removed by the database may be loaded anywhere
+            _evict_all(session)
+            return
+        if (loader := loaders.get(type(model_inst))) is not None:
+            loader.evict([loader._service.model_id(model_inst)])
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _evict_bulk_written(orm_execute_state: ORMExecuteState) -> None:
+    if (orm_execute_state.is_update or orm_execute_state.is_delete) and orm_execute_state.bind_mapper is not None:
+        if orm_execute_state.is_delete and _deletes_cascade_in_database(orm_execute_state.bind_mapper.class_):
+            _evict_all(orm_execute_state.session)
+        elif (loader := _loaders(orm_execute_state.session).get(orm_execute_state.bind_mapper.class_)) is not None:
+            loader.evict()
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _evict_rolled_back(session: Session, previous_transaction) -> None:
+    _evict_all(session)
+
+
 class Service(
     Generic[
         models.TModel,
@@ -177,28 +457,47 @@ class Service(
     HasModelInstFromCreateModel[models.TModel, TCreateModel],
     HasModelId[models.TModel, types.TId],
     HasBuildSelectById[models.TModel, types.TId],
-
+    HasBuildWhereByIds[types.TId],
 ):
 
+    # delete only marks the rows, they disappear from reads at once and a purge removes them later
+    _SOFT_DELETE: ClassVar[bool] = False
+
+    @classmethod
+    async def _soft_delete(cls, session: AsyncSession, ids: Sequence[types.TId]) -> None:
+        """Mark rows as deleted, services extend this to mark whatever hangs off them as well"""
+
+        await session.exec(build_mark_deleted(cls._MODEL, cls._build_where_by_ids(ids)))
+
     @classmethod
     async def fetch_one(cls, session: AsyncSession, query: SelectOfScalar[models.TModel]) -> models.TModel | None:
         return (await session.exec(query)).one_or_none()
 
     @classmethod
-    async def fetch_many(cls, session: AsyncSession, pagination: Pagination, order_bys: list[OrderBy[TOrderBy_co]] = [], query: SelectOfScalar[models.TModel] | None = None) -> Sequence[models.TModel]:
+    def _build_fetch_many(cls, pagination: Pagination, order_bys: list[OrderBy[TOrderBy_co]] = [], query: SelectOfScalar[models.TModel] | None = None) -> SelectOfScalar[models.TModel]:
 
         if query is None:
             query = select(cls._MODEL)
 
         query = cls.build_order_by(query, order_bys)
-        query = query.offset(pagination.offset).limit(pagination.limit)
+        return query.offset(pagination.offset).limit(pagination.limit)
 
-        return (await session.exec(query)).all()
+    @classmethod
+    async def fetch_many(cls, session: AsyncSession, pagination: Pagination, order_bys: list[OrderBy[TOrderBy_co]] = [], query: SelectOfScalar[models.TModel] | None = None) -> Sequence[models.TModel]:
+        return (await session.exec(cls._build_fetch_many(pagination, order_bys, query))).all()
+
+    @classmethod
+    def loader(cls, session: AsyncSession) -> Loader[models.TModel, types.TId]:
+        """The loader for this model on the session, created on first use"""
+
+        loaders = _loaders(session)
+        if cls._MODEL not in loaders:
+            loaders[cls._MODEL] = Loader(cls, session)
+        return loaders[cls._MODEL]
 
     @classmethod
     async def fetch_by_id(cls, session: AsyncSession, id: types.TId) -> models.TModel | None:
-        query = cls._build_select_by_id(id)
-        return await cls.fetch_one(session, query)
+        return await cls.loader(session).load(id)
 
     @classmethod
     async def fetch_by_id_with_exception(cls, session: AsyncSession, id: types.TId) -> models.TModel:
@@ -207,6 +506,45 @@ class Service(
             raise NotFoundError(cls._MODEL, id)
         return inst
 
+    @classmethod
+    def _build_select_by_ids(cls, ids: Sequence[types.TId]) -> SelectOfScalar[models.TModel]:
+        return select(cls._MODEL).where(cls._build_where_by_ids(ids))
+
+    @classmethod
+    async def fetch_by_ids(cls, session: AsyncSession, ids: Sequence[types.TId]) -> dict[types.TId, models.TModel]:
+        """Fetch many instances in a single query, keyed by id, missing ids are absent from the result"""
+
+        if not ids:
+            return {}
+        model_insts = (await session.exec(cls._build_select_by_ids(ids))).all()
+        cls.loader(session).prime(model_insts)
+        return {cls.model_id(inst): inst for inst in model_insts}
+
+    @classmethod
+    async def load_related(cls, session: AsyncSession, model_insts: Sequence[models.TModel], *relationships: InstrumentedAttribute) -> None:
+        """Eagerly load relationships onto instances already in the session
+
+        Relationships are declared `lazy='raise'`, so methods that walk one say so by calling this first. Each
+        relationship costs one `selectinload` query for all of the instances, and ones that are already loaded are
+        skipped.
+        """
+
+        unloaded = [relationship for relationship in relationships if any(
+            relationship.key in sa_inspect(model_inst).unloaded for model_inst in model_insts)]
+        if not model_insts or not unloaded:
+            return
+
+        await session.exec(cls._build_select_by_ids([cls.model_id(model_inst) for model_inst in model_insts]).options(
+            *(selectinload(relationship) for relationship in unloaded)))
+
+    @classmethod
+    async def fetch_by_ids_with_exception(cls, session: AsyncSession, ids: Sequence[types.TId]) -> dict[types.TId, models.TModel]:
+        insts = await cls.fetch_by_ids(session, ids)
+        for id in ids:
+            if id not in insts:
+                raise NotFoundError(cls._MODEL, id)
+        return insts
+
     @classmethod
     def build_order_by(cls, query: SelectOfScalar[models.TModel], order_by: list[OrderBy[TOrderBy_co]]):
 
@@ -219,11 +557,25 @@ class Service(
 
         return query
 
+    @classmethod
+    async def _commit(cls, session: AsyncSession) -> None:
+        """Commit a write, or only flush it when the caller owns the transaction through unit_of_work"""
+
+        if in_unit_of_work(session):
+            await session.flush()
+        else:
+            await session.commit()
+
     @classmethod
     async def _check_authorization_existing(cls, params: CheckAuthorizationExistingParams[models.TModel, types.TId]) -> None:
         """Check if the user is authorized to access the instance"""
         pass
 
+    @classmethod
+    def _build_visibility_predicate(cls, authorized_user_id: Optional[types.User.id], admin: bool) -> ColumnElement[bool] | None:
+        """SQL form of the read rule in _check_authorization_existing, applied to list queries, None if every row is visible"""
+        return None
+
     @classmethod
     async def _check_authorization_new(cls, params: CheckAuthorizationNewParams[TCreateModel]) -> None:
         """Check if the user is authorized to create a new instance"""
@@ -246,7 +598,22 @@ class Service(
 
     @classmethod
     async def _check_validation_post(cls, params: CheckValidationPostParams[TCreateModel]) -> None:
-        """Check if the user is authorized to create a new instance"""
+        """Check if a new instance is valid, uniqueness is enforced by the database on insert"""
+        pass
+
+    @classmethod
+    async def _after_create(cls, session: AsyncSession, model_insts: Sequence[models.TModel]) -> None:
+        """Called by create and create_many once the rows are flushed, in the same transaction"""
+        pass
+
+    @classmethod
+    async def _after_update(cls, session: AsyncSession, model_insts: Sequence[models.TModel], previous: Sequence[dict[str, Any]]) -> None:
+        """Called by update and update_many once the rows are flushed, `previous` holds each row's loaded columns from before"""
+        pass
+
+    @classmethod
+    async def _after_delete(cls, session: AsyncSession, model_insts: Sequence[models.TModel]) -> None:
+        """Called by delete and delete_many once the rows are deleted or marked, in the same transaction"""
         pass
 
     @classmethod
@@ -264,15 +631,90 @@ class Service(
     async def read_many(cls, params: ReadManyParams[models.TModel, TOrderBy_co]) -> Sequence[models.TModel]:
         """Used in conjunction with API endpoints, raises exceptions while trying to get a list of instances of the model"""
 
+        return (await params['session'].exec(await cls._build_read_many(params))).all()
+
+    @classmethod
+    async def read_many_columns(cls, params: ReadManyParams[models.TModel, TOrderBy_co], names: Sequence[str]) -> Sequence[Row[Any]]:
+        """The named columns of each instance read_many would return, in the same order, as plain rows
+
+        For read-only lists: rows skip the identity map and attribute instrumentation, and leave out every column not asked for.
+        """
+
+        columns = [getattr(cls._MODEL, name) for name in names]
+        return (await params['session'].exec(await cls._build_read_many(params, columns))).all()
+
+    @classmethod
+    async def read_many_versions(cls, params: ReadManyParams[models.TModel, TOrderBy_co]) -> Sequence[Row[Any]]:
+        """The primary key and updated_at of each instance read_many would return, in the same order
+
+        Whether a page changed is known from these few columns, without loading the rows.
+        """
+
+        return await cls.read_many_columns(params, [*(column.key for column in sa_inspect(cls._MODEL).primary_key), 'updated_at'])
+
+    @classmethod
+    async def _build_read_many(cls, params: ReadManyParams[models.TModel, TOrderBy_co], columns: Sequence[Any] | None = None) -> SelectOfScalar[models.TModel]:
+
         await cls._check_authorization_read_many(params)
 
-        kwargs = {}
-        if 'order_bys' in params:
-            kwargs['order_bys'] = params['order_bys']
-        if 'query' in params:
-            kwargs['query'] = params['query']
+        query = params.get('query')
+        if query is None:
+            query = select(cls._MODEL)
+
+        if columns is not None:
+            # a plain select of just these columns, with the same filters, returns rows rather than instances
+            columns_query = sa_select(*columns).select_from(cls._MODEL)
+            if query.whereclause is not None:
+                columns_query = columns_query.where(query.whereclause)
+            query = columns_query
 
-        return await cls.fetch_many(params['session'], params['pagination'], **kwargs)
+        # filtering in the query keeps pagination correct and spares a check per row
+        visibility_predicate = cls._build_visibility_predicate(
+            params['authorized_user_id'], params['admin'])
+        if visibility_predicate is not None:
+            query = query.where(visibility_predicate)
+
+        return cls._build_fetch_many(params['pagination'], params.get('order_bys', []), query)
+
+    @classmethod
+    def _unique_violation_error(cls, model_inst: models.TModel, error: IntegrityError) -> ServiceError:
+        """Translate a unique constraint violation on write into a ServiceError"""
+        return AlreadyExistsError(cls._MODEL, cls.model_id(model_inst))
+
+    @classmethod
+    def _unique_violation_error_many(cls, model_insts: Sequence[models.TModel], error: IntegrityError) -> ServiceError:
+        """Translate a unique constraint violation on a batch write, the offending row is not known"""
+        return NotAvailableError(
+            'One or more of the {} {} instances conflicts with an existing instance'.format(
+                len(model_insts), cls._MODEL.__name__)
+        )
+
+    @classmethod
+    def _foreign_key_violation_error(cls, model_insts: Sequence[models.TModel], error: IntegrityError) -> ServiceError:
+        """Translate a write referencing a row that does not exist, the offending reference is not known"""
+        return NotAvailableError(
+            '{} references a row that does not exist'.format(cls._MODEL.__name__))
+
+    @classmethod
+    @asynccontextmanager
+    async def _unique_write(cls, session: AsyncSession, *model_insts: models.TModel):
+        """Wrap a pending write, letting the database's unique and foreign key constraints decide availability"""
+
+        # the write happens inside a savepoint so a violation only unwinds this write, not the rest of the session
+        attempted: Sequence[models.TModel] = model_insts
+        try:
+            async with session.begin_nested():
+                yield
+                # a failed flush expires the instances it was writing, the errors are built from what was written
+                attempted = [type(model_inst)(**_loaded_columns(model_inst)) for model_inst in model_insts]
+        except IntegrityError as e:
+            if is_foreign_key_violation(e):
+                raise cls._foreign_key_violation_error(attempted, e) from e
+            if not is_unique_violation(e):
+                raise
+            if len(attempted) == 1:
+                raise cls._unique_violation_error(attempted[0], e) from e
+            raise cls._unique_violation_error_many(attempted, e) from e
 
     @classmethod
     async def create(cls, params: CreateParams[TCreateModel]) -> models.TModel:
@@ -281,17 +723,27 @@ class Service(
         await cls._check_authorization_new(params)
         await cls._check_validation_post(params)
 
-        model_inst = cls.model_inst_from_create_model(params['create_model'])
+        model_inst = await cls._new_model_inst(params['create_model'])
+
+        # no availability query up front, the insert itself is the check
+        # the hooks run in the write's savepoint, a row whose counters refuse it (over quota, say) goes with them
+        async with cls._unique_write(params['session'], model_inst):
+            params['session'].add(model_inst)
+            await cls._after_create(params['session'], [model_inst])
 
-        params['session'].add(model_inst)
-        await params['session'].commit()
-        await params['session'].refresh(model_inst)
+        await cls._commit(params['session'])
+        await cls._load_unloaded(params['session'], model_inst)
         return model_inst
 
     @classmethod
     def model_inst_from_create_model(cls, create_model: TCreateModel) -> models.TModel:
         return cls._MODEL(**create_model.model_dump())
 
+    @classmethod
+    async def _new_model_inst(cls, create_model: TCreateModel) -> models.TModel:
+        """The instance create and create_many insert, for services that await while building it"""
+        return cls.model_inst_from_create_model(create_model)
+
     @classmethod
     async def update(cls, params: UpdateParams[types.TId, TUpdateModel]) -> models.TModel:
         """Used in conjunction with API endpoints, raises exceptions while trying to update an instance of the model by ID"""
@@ -303,16 +755,19 @@ class Service(
         await cls._check_authorization_existing({
             'session': params['session'],
             'model_inst': model_inst,
-            'operation': 'read',
+            'operation': 'update',
             'id': params['id'],
             'admin': params['admin'],
             'authorized_user_id': params['authorized_user_id']
         })
         await cls._check_validation_patch({**params, 'model_inst': model_inst})
-        await cls._update_model_inst(model_inst, params['update_model'])
+        previous = _loaded_columns(model_inst)
+        async with cls._unique_write(params['session'], model_inst):
+            await cls._update_model_inst(model_inst, params['update_model'])
+        await cls._after_update(params['session'], [model_inst], [previous])
 
-        await params['session'].commit()
-        await params['session'].refresh(model_inst)
+        await cls._commit(params['session'])
+        await cls._load_unloaded(params['session'], model_inst)
         return model_inst
 
     @classmethod
@@ -336,8 +791,120 @@ class Service(
             'authorized_user_id': params['authorized_user_id']
         })
         await cls._check_validation_delete(params)
-        await params['session'].delete(model_inst)
-        await params['session'].commit()
+        if cls._SOFT_DELETE:
+            await cls._soft_delete(params['session'], [params['id']])
+            params['session'].expunge(model_inst)
+        else:
+            await params['session'].delete(model_inst)
+        await cls._after_delete(params['session'], [model_inst])
+        await cls._commit(params['session'])
+
+    @classmethod
+    async def _load_unloaded(cls, session: AsyncSession, *model_insts: models.TModel) -> None:
+        """Load whatever a write left unloaded, skipping the SELECT when RETURNING already brought everything back"""
+
+        # a batch reloads whatever is still missing with one SELECT, not a refresh per instance
+        unloaded = [model_inst for model_inst in model_insts if sa_inspect(model_inst).unloaded & _column_keys(cls._MODEL)]
+        if unloaded:
+            await session.exec(cls._build_select_by_ids([cls.model_id(model_inst) for model_inst in unloaded]).execution_options(
+                populate_existing=True))
+
+    @classmethod
+    async def create_many(cls, params: CreateManyParams[TCreateModel]) -> list[models.TModel]:
+        """Create many instances in one transaction, running the same checks as create for each one"""
+
+        base_params: CRUDParamsBase = {
+            'session': params['session'],
+            'admin': params['admin'],
+            'authorized_user_id': params['authorized_user_id'],
+        }
+
+        for create_model in params['create_models']:
+            await cls._check_authorization_new({**base_params, 'create_model': create_model})
+            await cls._check_validation_post({**base_params, 'create_model': create_model})
+
+        model_insts = list(await asyncio.gather(*(cls._new_model_inst(
+            create_model) for create_model in params['create_models'])))
+
+        # the unit of work batches the pending inserts of each table into a single executemany
+        async with cls._unique_write(params['session'], *model_insts):
+            params['session'].add_all(model_insts)
+            await cls._after_create(params['session'], model_insts)
+
+        await cls._commit(params['session'])
+        await cls._load_unloaded(params['session'], *model_insts)
+        return model_insts
+
+    @classmethod
+    async def update_many(cls, params: UpdateManyParams[types.TId, TUpdateModel]) -> list[models.TModel]:
+        """Update many instances in one transaction, running the same checks as update for each one"""
+
+        ids = list(params['update_models'].keys())
+        model_insts = await cls.fetch_by_ids_with_exception(params['session'], ids)
+
+        base_params: CRUDParamsBase = {
+            'session': params['session'],
+            'admin': params['admin'],
+            'authorized_user_id': params['authorized_user_id'],
+        }
+
+        for id, update_model in params['update_models'].items():
+            await cls._check_authorization_existing({
+                **base_params,
+                'model_inst': model_insts[id],
+                'operation': 'update',
+                'id': id,
+            })
+            await cls._check_validation_patch({
+                **base_params,
+                'model_inst': model_insts[id],
+                'id': id,
+                'update_model': update_model,
+            })
+
+        previous = [_loaded_columns(model_insts[id]) for id in ids]
+        # rows changing the same columns are flushed together as one executemany UPDATE
+        async with cls._unique_write(params['session'], *model_insts.values()):
+            for id, update_model in params['update_models'].items():
+                await cls._update_model_inst(model_insts[id], update_model)
+        await cls._after_update(params['session'], [model_insts[id] for id in ids], previous)
+
+        await cls._commit(params['session'])
+        await cls._load_unloaded(params['session'], *model_insts.values())
+        return [model_insts[id] for id in ids]
+
+    @classmethod
+    async def delete_many(cls, params: DeleteManyParams[types.TId]) -> None:
+        """Delete many instances in one transaction, running the same checks as delete for each one"""
+
+        ids = list(params['ids'])
+        model_insts = await cls.fetch_by_ids_with_exception(params['session'], ids)
+
+        base_params: CRUDParamsBase = {
+            'session': params['session'],
+            'admin': params['admin'],
+            'authorized_user_id': params['authorized_user_id'],
+        }
+
+        for id in ids:
+            await cls._check_authorization_existing({
+                **base_params,
+                'operation': 'delete',
+                'id': id,
+                'model_inst': model_insts[id],
+            })
+            await cls._check_validation_delete({**base_params, 'id': id})
+
+        if cls._SOFT_DELETE:
+            await cls._soft_delete(params['session'], ids)
+        else:
+            # children go with the rows through the foreign keys' ON DELETE actions
+            await params['session'].exec(delete(cls._MODEL).where(cls._build_where_by_ids(ids)))
+        await cls._after_delete(params['session'], list(model_insts.values()))
+        for model_inst in model_insts.values():
+            params['session'].expunge(model_inst)
+
+        await cls._commit(params['session'])
 
 
 '''
@@ -1,9 +1,12 @@
 from sqlmodel import select
+from collections import defaultdict
 
-from arbor_imago.core import types
+from arbor_imago import utils
+from arbor_imago.core import config, types
 from arbor_imago.models.tables import File as FileTable
 from arbor_imago.schemas import file as file_schema
 from arbor_imago.services.models import base
+from arbor_imago.services import counters
 
 
 class File(
@@ -24,3 +27,42 @@ class File(
     @classmethod
     def model_name(cls, inst: FileTable) -> str:
         return inst.stem + ('' if inst.suffix is None else inst.suffix)
+
+    @classmethod
+    def _unique_violation_error(cls, model_inst, error):
+        return base.NotAvailableError(
+            'File `{}` already exists in gallery {}'.format(cls.model_name(model_inst), model_inst.gallery_id))
+
+    @classmethod
+    def model_inst_from_create_model(cls, create_model):
+        return cls._MODEL(
+            id=types.File.id(utils.generate_uuid()),
+            **create_model.model_dump()
+        )
+
+    @classmethod
+    async def _add_to_counters(cls, session, changes: list[tuple[types.File.gallery_id, int, int]], quota: int | None = None) -> None:
+        totals: defaultdict[types.File.gallery_id, list[int]] = defaultdict(lambda: [0, 0])
+        for gallery_id, file_count, file_size in changes:
+            totals[gallery_id][0] += file_count
+            totals[gallery_id][1] += file_size
+        for gallery_id, (file_count, file_size) in totals.items():
+            await counters.add_files(session, gallery_id, file_count, file_size, quota=quota)
+
+    @classmethod
+    async def _after_create(cls, session, model_insts):
+        await cls._add_to_counters(session, [(inst.gallery_id, 1, inst.size or 0) for inst in model_insts],
+                                   quota=config.USER_STORAGE_QUOTA)
+
+    @classmethod
+    async def _after_update(cls, session, model_insts, previous):
+        changes = []
+        for inst, before in zip(model_insts, previous):
+            gallery_id, size = before.get('gallery_id', inst.gallery_id), before.get('size', inst.size)
+            if (gallery_id, size) != (inst.gallery_id, inst.size):
+                changes += [(gallery_id, -1, -(size or 0)), (inst.gallery_id, 1, inst.size or 0)]
+        await cls._add_to_counters(session, changes)
+
+    @classmethod
+    async def _after_delete(cls, session, model_insts):
+        await cls._add_to_counters(session, [(inst.gallery_id, -1, -(inst.size or 0)) for inst in model_insts])
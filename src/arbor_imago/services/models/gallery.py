@@ -1,16 +1,88 @@
-from sqlmodel import select
+from sqlmodel import select, col, or_, delete
+from sqlmodel.sql.expression import SelectOfScalar
 from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy import Select, exists, event
+from sqlalchemy.orm import aliased, Session
+from contextlib import asynccontextmanager
 import re
 import datetime as datetime_module
 import pathlib
+import asyncio
+import shutil
+import os
+from collections.abc import Sequence
 
-from arbor_imago import utils
+from arbor_imago import utils, core
 from arbor_imago.core import config, types
-from arbor_imago.models.tables import Gallery as GalleryTable
+from arbor_imago.models.tables import Gallery as GalleryTable, File as FileTable, GalleryMove as GalleryMoveTable
 from arbor_imago.services.models.gallery_permission import GalleryPermission as GalleryPermissionService, base
+from arbor_imago.services.models.file import File as FileService
+from arbor_imago.services import media_layout, counters
 from arbor_imago.schemas import gallery as gallery_schema
 
 
+_DIR_FIELDS = frozenset({'name', 'date', 'parent_id'})
+_PENDING_MOVES_KEY = 'pending_gallery_moves'
+_APPLIED_MOVES_KEY = 'applied_gallery_moves'
+
+
+def apply_moves(moves: Sequence[tuple[pathlib.Path, pathlib.Path]]) -> list[bool]:
+    """Rename directories in order, each a single os.rename however many files it holds, returns which moves are done
+
+    A move whose source is gone was already done, by an earlier attempt or another worker replaying the same journal.
+    After a directory moves, later moves starting below it are followed there. A move that fails is logged and
+    returned as not done, along with the later moves below it, which would otherwise land in a directory created
+    for them at the destination and block the failed move for good.
+    """
+
+    moves = list(moves)
+    done = [False] * len(moves)
+    failed: list[pathlib.Path] = []
+    for i, (src, dst) in enumerate(moves):
+        if any(src.is_relative_to(failed_src) for failed_src in failed):
+            continue
+
+        if src.exists():
+            if dst.exists():
+                core.LOGGER.warning(f'Not moving `{src}`, `{dst}` already exists')
+                failed.append(src)
+                continue
+
+            try:
+                dst.parent.mkdir(parents=True, exist_ok=True)
+                os.rename(src, dst)
+            except OSError:
+                # unless another worker replaying the same journal renamed it first
+                if src.exists() or not dst.exists():
+                    core.LOGGER.exception(f'Moving `{src}` to `{dst}` failed')
+                    failed.append(src)
+                    continue
+        done[i] = True
+
+        for j in range(i + 1, len(moves)):
+            later_src, later_dst = moves[j]
+            if later_src.is_relative_to(src):
+                moves[j] = (dst / later_src.relative_to(src), later_dst)
+
+    return done
+
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session: Session) -> None:
+    moves = session.info.pop(_PENDING_MOVES_KEY, None)
+    if moves:
+        done = apply_moves([(src, dst) for _, src, dst in moves])
+        # whoever journaled the moves deletes the rows of these, the others stay for replay_moves
+        session.info.setdefault(_APPLIED_MOVES_KEY, []).extend(
+            id for (id, _, _), move_done in zip(moves, done) if move_done)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _after_soft_rollback(session: Session, previous_transaction) -> None:
+    if not previous_transaction.nested:
+        session.info.pop(_PENDING_MOVES_KEY, None)
+
+
 class Gallery(
         base.Service[
             GalleryTable,
@@ -26,6 +98,7 @@ class Gallery(
 ):
 
     _MODEL = GalleryTable
+    _SOFT_DELETE = True
 
     @classmethod
     def model_folder_name(cls, inst: GalleryTable) -> types.Gallery.folder_name:
@@ -54,6 +127,15 @@ class Gallery(
                 name=folder_name
             )
 
+    @classmethod
+    def _build_select_available(cls, gallery_available_admin: gallery_schema.GalleryAdminAvailable) -> SelectOfScalar[GalleryTable]:
+        return select(cls._MODEL).where(
+            cls._MODEL.user_id == gallery_available_admin.user_id,
+            cls._MODEL.parent_id == gallery_available_admin.parent_id,
+            cls._MODEL.name == gallery_available_admin.name,
+            cls._MODEL.date == gallery_available_admin.date,
+        )
+
     @classmethod
     async def is_available(cls, session: AsyncSession, gallery_available_admin: gallery_schema.GalleryAdminAvailable) -> bool:
 
@@ -61,15 +143,26 @@ class Gallery(
         if gallery_available_admin.parent_id is not None:
             await cls.fetch_by_id_with_exception(session, gallery_available_admin.parent_id)
 
-        if (await session.exec(select(cls).where(
-            cls._MODEL.name == gallery_available_admin.name,
-            cls._MODEL.user_id == gallery_available_admin.user_id,
-            cls._MODEL.parent_id == gallery_available_admin.parent_id,
-            cls._MODEL.date == gallery_available_admin.date,
-        ))).one_or_none():
+        if (await session.exec(cls._build_select_available(gallery_available_admin))).one_or_none():
             return False
         return True
 
+    @classmethod
+    def _build_visibility_predicate(cls, authorized_user_id, admin):
+        if admin:
+            return None
+
+        public = col(cls._MODEL.visibility_level) == config.VISIBILITY_LEVEL_NAME_MAPPING['public']
+        if authorized_user_id is None:
+            return public
+
+        return or_(
+            col(cls._MODEL.user_id) == authorized_user_id,
+            public,
+            col(cls._MODEL.id).in_(
+                GalleryPermissionService._build_select_shared_gallery_ids(authorized_user_id))
+        )
+
     @classmethod
     async def _check_authorization_new(cls, params):
         if not params['admin']:
@@ -82,56 +175,178 @@ class Gallery(
     async def _check_authorization_existing(cls, params):
 
         if not params['admin']:
-            if params['authorized_user_id'] is not None and (params['authorized_user_id'] != params['model_inst'].user_id):
+            if params['authorized_user_id'] != params['model_inst'].user_id:
 
                 if params['operation'] == 'delete':
                     raise base.UnauthorizedError(
                         'Unauthorized to {operation} this gallery'.format(operation=params['operation']))
 
-                gallery_permission = await GalleryPermissionService.fetch_by_id(
-                    params['session'], types.GalleryPermissionId(
-                        gallery_id=params['id'],
-                        user_id=params['authorized_user_id']
+                # grants are inherited down the tree, the closest one wins
+                permission_level = None
+                if params['authorized_user_id'] is not None:
+                    permission_level = await GalleryPermissionService.get_effective_permission_level(
+                        params['session'], params['authorized_user_id'], params['model_inst'].id
                     )
-                )
 
                 # if the gallery is private and user has no access, pretend it doesn't exist
-                if gallery_permission is None and params['model_inst'].visibility_level == config.VISIBILITY_LEVEL_NAME_MAPPING['private']:
+                if permission_level is None and params['model_inst'].visibility_level == config.VISIBILITY_LEVEL_NAME_MAPPING['private']:
                     raise base.NotFoundError(
                         GalleryTable, params['id'])
 
                 # either public or user has access
 
-                elif params['operation'] == 'get':
-                    if gallery_permission is None or (gallery_permission.permission_level < config.PERMISSION_LEVEL_NAME_MAPPING['viewer']):
-                        raise base.UnauthorizedError(
-                            'Unauthorized to {operation} this gallery'.format(operation=params['operation']))
-
-                elif params['operation'] == 'patch':
-                    if gallery_permission is None or (gallery_permission.permission_level < config.PERMISSION_LEVEL_NAME_MAPPING['editor']):
+                elif params['operation'] == 'update':
+                    if permission_level is None or (permission_level < config.PERMISSION_LEVEL_NAME_MAPPING['editor']):
                         raise base.UnauthorizedError(
                             'Unauthorized to {operation} this gallery'.format(operation=params['operation']))
 
     @classmethod
     async def _check_validation_post(cls, params):
-        await cls.is_available(params['session'], gallery_schema.GalleryAdminAvailable(**params['create_model'].model_dump(include=set(gallery_schema.GalleryAdminAvailable.model_fields.keys()), exclude_unset=True)))
+
+        # name collisions are caught by the unique index on insert, only the parent needs checking
+        if params['create_model'].parent_id is not None:
+            await cls.fetch_by_id_with_exception(params['session'], params['create_model'].parent_id)
+
+    @classmethod
+    def _unique_violation_error(cls, model_inst, error):
+        return base.NotAvailableError(
+            'Gallery `{}` is not available for user {}'.format(
+                model_inst.name, model_inst.user_id
+            )
+        )
 
     @classmethod
     async def _check_validation_patch(cls, params):
-        # take self, overwrite it with the update_model, and see if the combined model is available
-        await cls.is_available(params['session'], gallery_schema.GalleryAdminAvailable(**{
-            **params['model_inst'].model_dump(include=set(gallery_schema.GalleryAdminAvailable.model_fields.keys())), **params['update_model'].model_dump(include=set(gallery_schema.GalleryAdminAvailable.model_fields.keys()), exclude_unset=True)
-        }))
+
+        # as on create, collisions are caught by the unique index, only a new parent needs checking
+        if 'parent_id' in params['update_model'].model_fields_set and params['update_model'].parent_id is not None:
+            await cls.fetch_by_id_with_exception(params['session'], params['update_model'].parent_id)
 
     @classmethod
     async def get_dir(cls, session: AsyncSession, gallery: GalleryTable,  root: pathlib.Path) -> pathlib.Path:
 
+        if config.MEDIA_LAYOUT == 'id':
+            return media_layout.gallery_dir(root, gallery.id)
+
         if gallery.parent_id is None:
             return root / cls.model_folder_name(gallery)
         else:
             a = await cls.get_dir(session, await cls.fetch_by_id_with_exception(session, gallery.parent_id), root)
             return a / cls.model_folder_name(gallery)
 
+    @classmethod
+    def _build_select_subtree_ids(cls, ids: Sequence[types.Gallery.id]) -> Select[tuple[types.Gallery.id]]:
+        """The galleries and all of their descendants"""
+
+        subtree = select(col(GalleryTable.id)).where(
+            col(GalleryTable.id).in_(ids)).cte('subtree', recursive=True)
+        subtree = subtree.union_all(
+            select(col(GalleryTable.id)).join(
+                subtree, col(GalleryTable.parent_id) == subtree.c.id)
+        )
+        return select(subtree.c.id)
+
+    @classmethod
+    async def _after_create(cls, session, model_insts):
+        await counters.add_galleries(session, model_insts)
+
+    @classmethod
+    async def _after_update(cls, session, model_insts, previous):
+        await counters.move_galleries(session, [
+            (inst.id, before['parent_id'], inst.parent_id) for inst, before in zip(model_insts, previous)
+            if 'parent_id' in before and before['parent_id'] != inst.parent_id])
+        await counters.change_gallery_owners(session, [
+            (inst.id, before['user_id'], inst.user_id) for inst, before in zip(model_insts, previous)
+            if 'user_id' in before and before['user_id'] != inst.user_id])
+
+    @classmethod
+    async def _soft_delete(cls, session, ids):
+        await counters.remove_galleries(session, cls._build_select_subtree_ids(ids))
+        # the whole subtree is marked, so a descendant is never readable under a deleted gallery
+        await session.exec(base.build_mark_deleted(cls._MODEL, col(cls._MODEL.id).in_(cls._build_select_subtree_ids(ids))))
+
+    @classmethod
+    def _build_select_purgeable(cls, limit: int) -> SelectOfScalar[GalleryTable]:
+        """Soft deleted galleries without children, so purging one never cascades into a whole subtree"""
+
+        child = aliased(GalleryTable)
+        return select(cls._MODEL).where(col(cls._MODEL.deleted_at).is_not(None)).where(
+            ~exists().where(col(child.parent_id) == cls._MODEL.id)).limit(limit)
+
+    @classmethod
+    async def purge(cls, session: AsyncSession, root: pathlib.Path, limit: int) -> int:
+        """Remove up to `limit` soft deleted galleries and their directories, deepest first, returns how many"""
+
+        with base.soft_deleted_visible(session):
+            galleries = (await session.exec(cls._build_select_purgeable(limit))).all()
+            dirs = [await cls.get_dir(session, gallery, root) for gallery in galleries]
+
+        # the directories go first, a purge interrupted in between finds the rows again and retries
+        for dir in dirs:
+            await asyncio.to_thread(shutil.rmtree, dir, ignore_errors=True)
+
+        if galleries:
+            await session.exec(delete(cls._MODEL).where(cls._build_where_by_ids([gallery.id for gallery in galleries])))
+            await session.commit()
+        return len(galleries)
+
+    @classmethod
+    async def get_file_path(cls, session: AsyncSession, file: FileTable, root: pathlib.Path) -> pathlib.Path:
+        """Where the file's bytes live, in the id layout without touching the database"""
+
+        if config.MEDIA_LAYOUT == 'id':
+            return media_layout.file_path(root, file)
+
+        gallery = await cls.fetch_by_id_with_exception(session, file.gallery_id)
+        return (await cls.get_dir(session, gallery, root)) / FileService.model_name(file)
+
+    @classmethod
+    async def get_all_dirs(cls, session: AsyncSession, root: pathlib.Path, layout: types.MediaLayout | None = None) -> dict[types.Gallery.id, pathlib.Path]:
+        """Directory of every gallery, resolved from one query instead of one walk up the ancestors per gallery
+
+        Galleries are few enough to hold at once, unlike their files.
+        """
+
+        layout = config.MEDIA_LAYOUT if layout is None else layout
+        galleries = {gallery.id: gallery for gallery in (await session.exec(select(cls._MODEL))).all()}
+        if layout == 'id':
+            return {id: media_layout.gallery_dir(root, id) for id in galleries}
+
+        dirs: dict[types.Gallery.id, pathlib.Path] = {}
+
+        def tree_dir(gallery: GalleryTable) -> pathlib.Path:
+            if gallery.id not in dirs:
+                parent_dir = root if gallery.parent_id is None else tree_dir(galleries[gallery.parent_id])
+                dirs[gallery.id] = parent_dir / cls.model_folder_name(gallery)
+            return dirs[gallery.id]
+
+        for gallery in galleries.values():
+            tree_dir(gallery)
+        return dirs
+
+    @classmethod
+    async def build_tree_view(cls, session: AsyncSession, root: pathlib.Path, dest: pathlib.Path) -> int:
+        """Lay out the id layout's files under `dest` as symlinks, nested and named like the tree layout
+
+        Files are streamed. Existing links are replaced, so the view can be rebuilt in place. Returns the number of
+        files linked.
+        """
+
+        dirs = await cls.get_all_dirs(session, dest, 'tree')
+        for dir in dirs.values():
+            dir.mkdir(parents=True, exist_ok=True)
+
+        n_linked = 0
+        files = await session.stream_scalars(select(FileTable).execution_options(yield_per=1000))
+        async for file in files:
+            if file.gallery_id not in dirs:
+                continue
+            link = dirs[file.gallery_id] / FileService.model_name(file)
+            link.unlink(missing_ok=True)
+            link.symlink_to(media_layout.file_path(root, file))
+            n_linked += 1
+        return n_linked
+
     @classmethod
     async def get_parents(cls, session: AsyncSession, gallery: GalleryTable) -> list[GalleryTable]:
 
@@ -143,9 +358,13 @@ class Gallery(
             parents.append(gallery)
             return parents
 
+    @classmethod
+    def _build_select_root_gallery(cls, user_id: types.Gallery.user_id) -> SelectOfScalar[GalleryTable]:
+        return select(cls._MODEL).where(cls._MODEL.user_id == user_id).where(cls._MODEL.parent_id == None)
+
     @classmethod
     async def get_root_gallery(cls, session: AsyncSession, user_id: types.Gallery.user_id) -> GalleryTable | None:
-        return (await session.exec(select(cls._MODEL).where(cls._MODEL.user_id == user_id).where(cls._MODEL.parent_id == None))).one_or_none()
+        return (await session.exec(cls._build_select_root_gallery(user_id))).one_or_none()
 
     @classmethod
     def model_inst_from_create_model(cls, create_model):
@@ -154,6 +373,86 @@ class Gallery(
             ** create_model.model_dump(exclude_unset=True, exclude_defaults=True, exclude_none=True)
         )
 
+    @classmethod
+    def _moves_dir(cls, update_model: gallery_schema.GalleryAdminUpdate) -> bool:
+        # in the id layout the directory never depends on these
+        return config.MEDIA_LAYOUT == 'tree' and not _DIR_FIELDS.isdisjoint(update_model.model_fields_set)
+
+    @classmethod
+    @asynccontextmanager
+    async def _journaled_moves(cls, session: AsyncSession, ids: Sequence[types.Gallery.id]):
+        """Journal the directory moves of the galleries updated inside the block, renaming them once committed
+
+        The moves are journaled in the same transaction as the updated rows, so either both are committed or neither
+        is. The renames run after the commit, a crash in between leaves journaled moves for replay_moves.
+        """
+
+        root = config.GALLERIES_DIR
+        galleries = await cls.fetch_by_ids(session, ids)
+        srcs = {id: await cls.get_dir(session, gallery, root) for id, gallery in galleries.items()}
+
+        journal: list[GalleryMoveTable] = []
+        async with base.unit_of_work(session):
+            yield
+
+            # shallowest first, apply_moves then finds children under wherever their parent moved to
+            for id, src in sorted(srcs.items(), key=lambda item: len(item[1].parts)):
+                dst = await cls.get_dir(session, galleries[id], root)
+                if dst == src or not src.exists():
+                    continue
+                if dst.exists():
+                    raise base.NotAvailableError(
+                        'Directory `{}` already exists'.format(dst.relative_to(root)))
+                journal.append(GalleryMoveTable(gallery_id=id, src=str(src), dst=str(dst)))
+
+            session.add_all(journal)
+            await session.flush()
+            session.info.setdefault(_PENDING_MOVES_KEY, []).extend(
+                (move.id, pathlib.Path(move.src), pathlib.Path(move.dst)) for move in journal)
+
+        # committed and renamed, unless an enclosing unit of work commits later, then replay_moves cleans up
+        if journal and not base.in_unit_of_work(session):
+            applied = session.info.pop(_APPLIED_MOVES_KEY, [])
+            if applied:
+                await session.exec(delete(GalleryMoveTable).where(col(GalleryMoveTable.id).in_(applied)))
+                await session.commit()
+
+    @classmethod
+    async def update(cls, params):
+        if not cls._moves_dir(params['update_model']):
+            return await super().update(params)
+
+        async with cls._journaled_moves(params['session'], [params['id']]):
+            return await super().update(params)
+
+    @classmethod
+    async def update_many(cls, params):
+        ids = [id for id, update_model in params['update_models'].items() if cls._moves_dir(update_model)]
+        if not ids:
+            return await super().update_many(params)
+
+        async with cls._journaled_moves(params['session'], ids):
+            return await super().update_many(params)
+
+    @classmethod
+    async def replay_moves(cls, session: AsyncSession) -> int:
+        """Finish the journaled moves a crash or a failed rename left, meant to run on startup, returns how many are done
+
+        Every worker replays on startup, concurrently with the others, so a move whose source is gone counts as done,
+        and a move that still fails is logged and kept for the next startup instead of aborting this one.
+        """
+
+        journal = (await session.exec(select(GalleryMoveTable).order_by(col(GalleryMoveTable.id)))).all()
+        if not journal:
+            return 0
+
+        done = apply_moves([(pathlib.Path(move.src), pathlib.Path(move.dst)) for move in journal])
+        applied = [move.id for move, move_done in zip(journal, done) if move_done]
+        if applied:
+            await session.exec(delete(GalleryMoveTable).where(col(GalleryMoveTable.id).in_(applied)))
+            await session.commit()
+        return len(applied)
+
     # @classmethod
     # async def update(cls, params, custom_params={}):
     #     """Used in conjunction with API endpoints, raises exceptions while trying to update an instance of the model by ID"""
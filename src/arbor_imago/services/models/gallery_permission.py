@@ -1,11 +1,31 @@
-from sqlmodel import select
+from sqlmodel import col, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlmodel import delete
+from sqlalchemy import tuple_, literal, event, inspect as sa_inspect, Select, or_, false, func
+from sqlalchemy.orm import Session, ORMExecuteState
+from collections.abc import Iterable
+from typing import ClassVar
+import itertools
 
-from arbor_imago.core import types
+from arbor_imago.core import cache, config, types
 from arbor_imago.services.models import base
-from arbor_imago.models.tables import GalleryPermission as GalleryPermissionTable
+from arbor_imago.models.tables import GalleryPermission as GalleryPermissionTable, Gallery as GalleryTable, User as UserTable, \
+    GalleryPermissionChange as GalleryPermissionChangeTable
 from arbor_imago.schemas import gallery_permission as gallery_permission_schema
 
 
+# effective permission levels keyed by (user_id, gallery_id), None meaning no grant on the gallery or its ancestors
+_SESSION_MEMO_KEY = 'effective_gallery_permission_levels'
+# the permissions version read by the session's transaction
+_SESSION_VERSION_KEY = 'gallery_permissions_version'
+# set once the session's transaction changed effective permissions, it logs a change when it commits
+_SESSION_DIRTY_KEY = 'gallery_permissions_dirty'
+
+# shared by every session of the process, holds levels of the permissions version GalleryPermission.cache_version
+EFFECTIVE_PERMISSION_LEVEL_CACHE: cache.Cache[tuple[types.User.id, types.Gallery.id], types.PermissionLevel.id | None] = cache.Cache(
+    'gallery_permissions', **config.CACHES['gallery_permissions'])
+
+
 class GalleryPermission(
         base.Service[
             GalleryPermissionTable,
@@ -17,6 +37,9 @@ class GalleryPermission(
 
     _MODEL = GalleryPermissionTable
 
+    # the permissions version EFFECTIVE_PERMISSION_LEVEL_CACHE holds, None until a session reads it
+    cache_version: ClassVar[types.GalleryPermissionChange.id | None] = None
+
     @classmethod
     def model_id(cls, inst):
         return types.GalleryPermissionId(
@@ -28,6 +51,10 @@ class GalleryPermission(
     def _build_select_by_id(cls, id):
         return select(cls._MODEL).where(cls._MODEL.gallery_id == id.gallery_id, cls._MODEL.user_id == id.user_id)
 
+    @classmethod
+    def _build_where_by_ids(cls, ids):
+        return tuple_(col(cls._MODEL.gallery_id), col(cls._MODEL.user_id)).in_(ids)
+
     @classmethod
     async def _check_authorization_new(cls, params):
 
@@ -41,28 +68,211 @@ class GalleryPermission(
     async def _check_authorization_existing(cls, params):
 
         if not params['admin']:
-            if params['model_inst'].gallery.user_id != params['authorized_user_id']:
-                authorized_user_gallery_permission = await cls.fetch_by_id_with_exception(
-                    params['session'], params['id']
-                )
+            # served from the identity map when the gallery was already loaded in this session
+            gallery = await params['session'].get(GalleryTable, params['model_inst'].gallery_id)
+            if gallery is None or gallery.user_id != params['authorized_user_id']:
 
                 blocked_operations: set[base.CheckAuthorizationExistingOperation] = {
                     'delete', 'update'}
 
                 if params['operation'] in blocked_operations:
-                    if authorized_user_gallery_permission.user_id != params['authorized_user_id']:
+                    if params['model_inst'].user_id != params['authorized_user_id']:
                         raise base.UnauthorizedError(
                             'Unauthorized to {} gallery permission with id {}'.format(params['operation'], params['id']))
 
     @classmethod
-    async def _check_validation_post(cls, params):
+    def _build_visibility_predicate(cls, authorized_user_id, admin):
+        if admin:
+            return None
+        if authorized_user_id is None:
+            return false()
 
-        id = types.GalleryPermissionId(
-            gallery_id=params['create_model'].gallery_id,
-            user_id=params['create_model'].user_id
+        # a user sees their own grants, and every grant on galleries they own
+        return or_(
+            col(cls._MODEL.user_id) == authorized_user_id,
+            col(cls._MODEL.gallery_id).in_(
+                select(col(GalleryTable.id)).where(col(GalleryTable.user_id) == authorized_user_id))
         )
 
-        if await cls.fetch_by_id(params['session'], id):
-            raise base.AlreadyExistsError(
-                cls._MODEL, id
-            )
+    @classmethod
+    def _build_select_shared_gallery_ids(cls, user_id: types.User.id) -> Select[tuple[types.Gallery.id]]:
+        """Ids of every gallery the user holds a grant on, directly or through an ancestor"""
+
+        shared = select(
+            col(cls._MODEL.gallery_id).label('id')
+        ).where(col(cls._MODEL.user_id) == user_id).cte('shared', recursive=True)
+
+        shared = shared.union(
+            select(col(GalleryTable.id)).join(
+                shared, col(GalleryTable.parent_id) == shared.c.id)
+        )
+
+        return select(shared.c.id)
+
+    @classmethod
+    def _build_select_effective_permission_levels(cls, user_id: types.User.id, gallery_ids: Iterable[types.Gallery.id]) -> Select[tuple[types.Gallery.id, types.PermissionLevel.id, int]]:
+        """Every grant the user holds on the galleries or their ancestors, with its distance up the tree"""
+
+        ancestors = select(
+            col(GalleryTable.id).label('gallery_id'),
+            col(GalleryTable.id).label('ancestor_id'),
+            literal(0).label('depth'),
+        ).where(col(GalleryTable.id).in_(gallery_ids)).cte('ancestors', recursive=True)
+
+        ancestors = ancestors.union_all(
+            select(
+                ancestors.c.gallery_id,
+                col(GalleryTable.parent_id),
+                ancestors.c.depth + 1,
+            ).join(GalleryTable, col(GalleryTable.id) == ancestors.c.ancestor_id).where(col(GalleryTable.parent_id).is_not(None))
+        )
+
+        return select(
+            ancestors.c.gallery_id, col(cls._MODEL.permission_level), ancestors.c.depth
+        ).join(
+            cls._MODEL, col(cls._MODEL.gallery_id) == ancestors.c.ancestor_id
+        ).where(col(cls._MODEL.user_id) == user_id)
+
+    @classmethod
+    async def get_effective_permission_levels(cls, session: AsyncSession, user_id: types.User.id, gallery_ids: Iterable[types.Gallery.id]) -> dict[types.Gallery.id, types.PermissionLevel.id | None]:
+        """Resolve the permission level the user has on each gallery, the closest grant up the tree winning
+
+        Results are memoised on the session for the rest of its transaction, and kept in the process wide
+        EFFECTIVE_PERMISSION_LEVEL_CACHE for the next requests, so only galleries not seen yet cost a query, and all of
+        them share that one query. The process cache is dropped once another transaction changed permissions, see
+        `sync_cache`.
+        """
+
+        use_cache = await cls.sync_cache(session)
+        generation = EFFECTIVE_PERMISSION_LEVEL_CACHE.generation
+
+        memo: dict[tuple[types.User.id, types.Gallery.id],
+                   types.PermissionLevel.id | None] = session.info.setdefault(_SESSION_MEMO_KEY, {})
+
+        permission_levels: dict[types.Gallery.id,
+                                types.PermissionLevel.id | None] = {}
+        missing: list[types.Gallery.id] = []
+
+        for gallery_id in dict.fromkeys(gallery_ids):
+            key = (user_id, gallery_id)
+            if key in memo:
+                permission_levels[gallery_id] = memo[key]
+            elif use_cache and (permission_level := EFFECTIVE_PERMISSION_LEVEL_CACHE.get(key)) is not cache.MISSING:
+                permission_levels[gallery_id] = memo[key] = permission_level
+            else:
+                missing.append(gallery_id)
+
+        if missing:
+            closest: dict[types.Gallery.id, tuple[int, types.PermissionLevel.id]] = {}
+
+            for gallery_id, permission_level, depth in (await session.exec(cls._build_select_effective_permission_levels(user_id, missing))).all():
+                if gallery_id not in closest or depth < closest[gallery_id][0]:
+                    closest[gallery_id] = (depth, permission_level)
+
+            for gallery_id in missing:
+                permission_levels[gallery_id] = memo[(user_id, gallery_id)] = \
+                    closest[gallery_id][1] if gallery_id in closest else None
+                if use_cache:
+                    # skipped if the cache was dropped while querying
+                    EFFECTIVE_PERMISSION_LEVEL_CACHE.set(
+                        (user_id, gallery_id), permission_levels[gallery_id], generation=generation)
+
+        return permission_levels
+
+    @classmethod
+    async def sync_cache(cls, session: AsyncSession) -> bool:
+        """Read the permissions version once per transaction, dropping EFFECTIVE_PERMISSION_LEVEL_CACHE if it changed
+
+        Every transaction that changes effective permissions logs a row to the gallery_permission_change table as it
+        commits, whichever worker it runs on, so the latest id is the version of the permissions. Returns whether the
+        session may use the process cache: not once its transaction changed permissions itself, nor while the cache
+        holds a version other than the one the transaction reads.
+        """
+
+        if session.info.get(_SESSION_DIRTY_KEY):
+            return False
+
+        if _SESSION_VERSION_KEY not in session.info:
+            version = (await session.exec(select(func.coalesce(func.max(col(GalleryPermissionChangeTable.id)), 0)))).one()
+            session.info[_SESSION_VERSION_KEY] = version
+            if version != cls.cache_version:
+                EFFECTIVE_PERMISSION_LEVEL_CACHE.invalidate()
+                cls.cache_version = version
+
+        return session.info[_SESSION_VERSION_KEY] == cls.cache_version
+
+    @classmethod
+    async def prune_changes(cls, session: AsyncSession) -> int:
+        """Remove every logged permission change but the latest, which holds the version, returns how many"""
+
+        result = await session.exec(delete(GalleryPermissionChangeTable).where(
+            col(GalleryPermissionChangeTable.id) < select(func.max(col(GalleryPermissionChangeTable.id))).scalar_subquery()))
+        await session.commit()
+        return result.rowcount
+
+    @classmethod
+    async def get_effective_permission_level(cls, session: AsyncSession, user_id: types.User.id, gallery_id: types.Gallery.id) -> types.PermissionLevel.id | None:
+        return (await cls.get_effective_permission_levels(session, user_id, [gallery_id]))[gallery_id]
+
+
+def _invalidate_effective_permission_levels(session: Session) -> None:
+    session.info.pop(_SESSION_MEMO_KEY, None)
+
+
+def _mark_changed(session: Session) -> None:
+    _invalidate_effective_permission_levels(session)
+    session.info[_SESSION_DIRTY_KEY] = True
+
+
+def _changes_effective_permissions(inst: object, session: Session) -> bool:
+
+    if isinstance(inst, GalleryPermissionTable):
+        return True
+    if isinstance(inst, GalleryTable):
+        # new and deleted galleries change which ancestors exist, moved ones change the path
+        return inst in session.new or inst in session.deleted or sa_inspect(inst).attrs.parent_id.history.has_changes()
+    if isinstance(inst, UserTable):
+        # the database deletes the user's galleries and permissions with them
+        return inst in session.deleted
+    return False
+
+
+@event.listens_for(Session, 'before_flush')
+def _before_flush(session: Session, flush_context, instances) -> None:
+    if any(_changes_effective_permissions(inst, session) for inst in itertools.chain(session.new, session.dirty, session.deleted)):
+        _mark_changed(session)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _do_orm_execute(orm_execute_state: ORMExecuteState) -> None:
+    if (orm_execute_state.is_update or orm_execute_state.is_delete) and orm_execute_state.bind_mapper is not None:
+        if orm_execute_state.bind_mapper.class_ in (GalleryPermissionTable, GalleryTable) or (
+                orm_execute_state.is_delete and orm_execute_state.bind_mapper.class_ is UserTable):
+            _mark_changed(orm_execute_state.session)
+
+
+# savepoints fire these too, only the outermost transaction logs the change
+@event.listens_for(Session, 'before_commit')
+def _before_commit(session: Session) -> None:
+    if session.info.get(_SESSION_DIRTY_KEY) and session.get_nested_transaction() is None:
+        session.add(GalleryPermissionChangeTable())
+
+
+# the next transaction sees what other transactions committed meanwhile, a rolled back one may have been memoised
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session: Session) -> None:
+    _invalidate_effective_permission_levels(session)
+    if session.get_nested_transaction() is None:
+        session.info.pop(_SESSION_VERSION_KEY, None)
+        if session.info.pop(_SESSION_DIRTY_KEY, False):
+            # this worker does not wait for its next request to read the new version
+            EFFECTIVE_PERMISSION_LEVEL_CACHE.invalidate()
+            GalleryPermission.cache_version = None
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _after_soft_rollback(session: Session, previous_transaction) -> None:
+    _invalidate_effective_permission_levels(session)
+    if previous_transaction.parent is None:
+        session.info.pop(_SESSION_VERSION_KEY, None)
+        session.info.pop(_SESSION_DIRTY_KEY, None)
@@ -1,4 +1,4 @@
-from sqlmodel import select
+from sqlmodel import select, col
 from typing import ClassVar
 import re
 
@@ -30,6 +30,10 @@ class ImageFileMetadata(
     def _build_select_by_id(cls, id):
         return select(cls._MODEL).where(cls._MODEL.file_id == id)
 
+    @classmethod
+    def _build_where_by_ids(cls, ids):
+        return col(cls._MODEL.file_id).in_(ids)
+
     @classmethod
     def parse_file_stem(cls, file_stem: str) -> tuple[types.ImageVersion.base_name, types.ImageVersion.version | None, types.ImageFileMetadata.scale | None]:
 
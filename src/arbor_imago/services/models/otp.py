@@ -1,11 +1,12 @@
 from sqlmodel import select
+from sqlmodel.sql.expression import SelectOfScalar
 from pydantic import BaseModel
 import string
 import secrets
 import datetime as datetime_module
 
 from arbor_imago import utils
-from arbor_imago.core import config, types
+from arbor_imago.core import config, types, utils as core_utils
 from arbor_imago.models.tables import OTP as OTPTable
 from arbor_imago.schemas import otp as otp_schema, auth_credential as auth_credential_schema
 from arbor_imago.services.models import auth_credential as auth_credential_service, base
@@ -44,13 +45,17 @@ class OTP(
         return ''.join(secrets.choice(characters) for _ in range(config.OTP_LENGTH))
 
     @classmethod
-    def hash_code(cls, code: types.OTP.code) -> types.OTP.hashed_code:
-        return utils.hash_password(code)
+    async def hash_code(cls, code: types.OTP.code) -> types.OTP.hashed_code:
+        return await core_utils.hash_password(code)
 
     @classmethod
-    def verify_code(cls, code: types.OTP.code, hashed_code: types.OTP.hashed_code) -> bool:
-        return utils.verify_password(code, hashed_code)
+    async def verify_code(cls, code: types.OTP.code, hashed_code: types.OTP.hashed_code) -> bool:
+        return await core_utils.check_password(code, hashed_code)
 
     @classmethod
     def _build_select_by_id(cls, id):
         return select(cls._MODEL).where(cls._MODEL.id == id)
+
+    @classmethod
+    def _build_select_by_user_id(cls, user_id: types.User.id) -> SelectOfScalar[OTPTable]:
+        return select(cls._MODEL).where(cls._MODEL.user_id == user_id)
@@ -1,13 +1,24 @@
-from sqlmodel import select, or_
+from sqlmodel import select, or_, col, delete
 from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy import Select, exists
 from pydantic import BaseModel
 import pathlib
 
 from arbor_imago import utils
-from arbor_imago.core import config, types
-from arbor_imago.models.tables import User as UserTable
+from arbor_imago.core import config, types, utils as core_utils
+from arbor_imago.models.tables import User as UserTable, Gallery as GalleryTable
 from arbor_imago.schemas import user as user_schema
 from arbor_imago.services.models import base
+from arbor_imago.services.models.gallery import Gallery as GalleryService
+from arbor_imago.services import counters, revocations
+
+
+# the field each named unique index of the user table guards, see tables.User
+_UNIQUE_FIELDS = {
+    'uq_user_email': 'email',
+    'uq_user_phone_number': 'phone_number',
+    'uq_user_username': 'username',
+}
 
 
 class User(
@@ -25,6 +36,7 @@ class User(
 ):
 
     _MODEL = UserTable
+    _SOFT_DELETE = True
     DEFAULT_ROLE_ID = config.USER_ROLE_NAME_MAPPING['user']
 
     @classmethod
@@ -68,27 +80,29 @@ class User(
             return None
         if user.hashed_password is None:
             return None
-        if not utils.verify_password(password, user.hashed_password):
+        if not await core_utils.check_password(password, user.hashed_password):
             return None
         return user
 
     @classmethod
     def model_inst_from_create_model(cls, create_model):
 
+        # the password is hashed by _new_model_inst, off the event loop
         d = create_model.model_dump(exclude_unset=True, exclude={'password'})
 
-        if 'password' in create_model.model_fields_set:
-            if create_model.password is None:
-                d['hashed_password'] = None
-            else:
-                d['hashed_password'] = cls.hash_password(
-                    create_model.password)
-
         return cls._MODEL(
             id=types.User.id(utils.generate_uuid()),
             ** d,
         )
 
+    @classmethod
+    async def _new_model_inst(cls, create_model):
+
+        model_inst = cls.model_inst_from_create_model(create_model)
+        if 'password' in create_model.model_fields_set and create_model.password is not None:
+            model_inst.hashed_password = await cls.hash_password(create_model.password)
+        return model_inst
+
     @classmethod
     async def _update_model_inst(cls, inst, update_model):
 
@@ -99,7 +113,7 @@ class User(
             if update_model.password is None:
                 inst.hashed_password = None
             else:
-                inst.hashed_password = cls.hash_password(
+                inst.hashed_password = await cls.hash_password(
                     update_model.password)
 
     @classmethod
@@ -114,13 +128,59 @@ class User(
         query = select(cls._MODEL).where(cls._MODEL.email == email)
         return (await session.exec(query)).one_or_none() is not None
 
+    @classmethod
+    async def _soft_delete(cls, session, ids):
+        await super()._soft_delete(session, ids)
+        # the galleries go with the user, and are purged before it
+        gallery_ids = (await session.exec(select(col(GalleryTable.id)).where(col(GalleryTable.user_id).in_(ids)))).all()
+        if gallery_ids:
+            await GalleryService._soft_delete(session, gallery_ids)
+
+    @classmethod
+    async def _after_create(cls, session, model_insts):
+        await counters.add_users(session, [inst.id for inst in model_insts])
+
+    @classmethod
+    async def _after_update(cls, session, model_insts, previous):
+        # a stateless access token carries the role's scopes, it has to be refreshed to pick up the new ones
+        await revocations.revoke_users(session, [inst.id for inst, before in zip(model_insts, previous) if before.get('user_role_id') != inst.user_role_id])
+
+    @classmethod
+    async def _after_delete(cls, session, model_insts):
+        await revocations.revoke_users(session, [inst.id for inst in model_insts])
+
+    @classmethod
+    def _build_select_purgeable_ids(cls, limit: int) -> Select[tuple[types.User.id]]:
+        """Soft deleted users whose galleries have all been purged"""
+
+        return select(col(cls._MODEL.id)).where(col(cls._MODEL.deleted_at).is_not(None)).where(
+            ~exists().where(col(GalleryTable.user_id) == cls._MODEL.id)).limit(limit)
+
+    @classmethod
+    async def purge(cls, session: AsyncSession, limit: int) -> int:
+        """Remove up to `limit` soft deleted users, returns how many"""
+
+        with base.soft_deleted_visible(session):
+            ids = (await session.exec(cls._build_select_purgeable_ids(limit))).all()
+
+        if ids:
+            await session.exec(delete(cls._MODEL).where(cls._build_where_by_ids(ids)))
+            await session.commit()
+        return len(ids)
+
+    @classmethod
+    def _build_visibility_predicate(cls, authorized_user_id, admin):
+        if admin:
+            return None
+        return or_(col(cls._MODEL.username).is_not(None), col(cls._MODEL.id) == authorized_user_id)
+
     @classmethod
     async def _check_authorization_existing(cls, params):
 
         if not params['admin']:
             if params['model_inst'].id != params['authorized_user_id']:
                 if cls.is_inst_public(params['model_inst']):
-                    if params['operation'] == 'delete' or params['operation'] == 'patch':
+                    if params['operation'] == 'delete' or params['operation'] == 'update':
                         raise base.UnauthorizedError(
                             'Unauthorized to {method} this user'.format(method=params['operation']))
                 else:
@@ -128,23 +188,13 @@ class User(
                         UserTable, params['model_inst'].id)
 
     @classmethod
-    async def _check_validation_post(cls, params):
-
-        if 'username' in params['create_model'].model_fields_set:
-            if params['create_model'].username is not None:
-                await cls.is_username_available(params['session'], params['create_model'].username)
-        if 'email' in params['create_model'].model_fields_set:
-            if params['create_model'].email is not None:
-                await cls.is_email_available(params['session'], params['create_model'].email)
+    def _unique_violation_error(cls, model_inst, error):
 
-    @classmethod
-    async def _check_validation_patch(cls, params):
-        if 'username' in params['update_model'].model_fields_set:
-            if params['update_model'].username is not None:
-                await cls.is_username_available(params['session'], params['update_model'].username)
-        if 'email' in params['update_model'].model_fields_set:
-            if params['update_model'].email is not None:
-                await cls.is_email_available(params['session'], params['update_model'].email)
+        field = _UNIQUE_FIELDS.get(base.violated_constraint(error))
+        if field is not None:
+            return base.NotAvailableError(
+                'User {} `{}` is not available'.format(field, getattr(model_inst, field)))
+        return super()._unique_violation_error(model_inst, error)
 
     @classmethod
     async def _check_authorization_new(cls, params: base.CheckAuthorizationNewParams[user_schema.UserAdminCreate]) -> None:
@@ -153,8 +203,8 @@ class User(
             raise base.UnauthorizedError('Unauthorized to create a new user.')
 
     @classmethod
-    def hash_password(cls, password: types.User.password) -> types.User.hashed_password:
-        return utils.hash_password(password)
+    async def hash_password(cls, password: types.User.password) -> types.User.hashed_password:
+        return await core_utils.hash_password(password)
 
 
 '''
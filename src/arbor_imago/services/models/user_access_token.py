@@ -1,12 +1,14 @@
-from typing import Any
-from sqlmodel import select
+from typing import Any, ClassVar
+from sqlmodel import select, col
 from pydantic import BaseModel
 import datetime as datetime_module
+from collections import Counter
 
 from arbor_imago import utils
 from arbor_imago.core import config, types
-from arbor_imago.models.tables import UserAccessToken as UserAccessTokenTable
-from arbor_imago.schemas import user_access_token as user_access_token_schema, auth_credential as auth_credential_schema
+from arbor_imago.models.tables import UserAccessToken as UserAccessTokenTable, User as UserTable
+from arbor_imago.schemas import user_access_token as user_access_token_schema, auth_credential as auth_credential_schema, user as user_schema
+from arbor_imago.services import counters, revocations
 from arbor_imago.services.models import auth_credential as auth_credential_service, base, user as user_service
 
 
@@ -37,6 +39,8 @@ class UserAccessToken(
 
     auth_type = auth_credential_schema.Type.ACCESS_TOKEN
     _MODEL = UserAccessTokenTable
+    _STATELESS_CLAIMS: ClassVar[set[str]] = {
+        'user_id', 'user_role_id', 'scopes'}
 
     @classmethod
     def model_inst_from_create_model(cls, create_model):
@@ -47,6 +51,23 @@ class UserAccessToken(
             **create_model.model_dump(exclude_unset=True, exclude_defaults=True, exclude_none=True)
         )
 
+    @classmethod
+    async def _after_create(cls, session, model_insts):
+        for user_id, count in Counter(inst.user_id for inst in model_insts).items():
+            await counters.add_to_user(session, user_id, user_access_token_count=count)
+
+    @classmethod
+    async def _after_delete(cls, session, model_insts):
+        for user_id, count in Counter(inst.user_id for inst in model_insts).items():
+            await counters.add_to_user(session, user_id, user_access_token_count=-count)
+        await revocations.revoke_user_access_tokens(session, ((inst.id, inst.user_id) for inst in model_insts))
+
+    @classmethod
+    def _build_visibility_predicate(cls, authorized_user_id, admin):
+        if admin:
+            return None
+        return col(cls._MODEL.user_id) == authorized_user_id
+
     @classmethod
     async def _check_authorization_new(cls, params):
 
@@ -70,3 +91,59 @@ class UserAccessToken(
             inst.user_id
         )).user_role_id
         ])
+
+    @staticmethod
+    def scope_ids_to_bitmask(scope_ids: set[types.Scope.id]) -> int:
+        return sum(1 << scope_id for scope_id in scope_ids)
+
+    @staticmethod
+    def bitmask_to_scope_ids(bitmask: int) -> set[types.Scope.id]:
+        return {scope_id for scope_id in range(bitmask.bit_length()) if bitmask >> scope_id & 1}
+
+    @classmethod
+    def is_stateless_jwt_payload(cls, payload: auth_credential_schema.JwtPayload[types.UserAccessToken.id]) -> bool:
+        return 'scopes' in payload
+
+    @classmethod
+    def validate_stateless_jwt_claims(cls, payload: auth_credential_schema.JwtPayload[types.UserAccessToken.id]):
+
+        missing_claims = {
+            claim for claim in cls._STATELESS_CLAIMS if claim not in payload}
+        if missing_claims:
+            raise auth_credential_service.MissingRequiredClaimsError(
+                missing_claims)
+
+    @classmethod
+    def to_stateless_jwt_payload(cls, inst: UserAccessTokenTable, user: UserTable | user_schema.UserClaims) -> user_access_token_schema.StatelessJwtPayload:
+        """A short lived access token for the user, refreshed with inst
+
+        Only what authorization needs is claimed, no profile, which would be readable by anyone holding the token and
+        stale after the user changes it.
+        """
+
+        issued = datetime_module.datetime.now().astimezone(datetime_module.UTC)
+        expiry = min(inst.expiry, issued +
+                     config.AUTH['credential_lifespans']['stateless_access_token'])
+
+        return {
+            'type': cls.auth_type.value,
+            'exp': expiry.timestamp(),
+            'iat': issued.timestamp(),
+            'sub': cls._model_sub(inst),
+            'user_id': user.id,
+            'user_role_id': user.user_role_id,
+            'scopes': cls.scope_ids_to_bitmask(config.USER_ROLE_ID_SCOPE_IDS[user.user_role_id]),
+        }
+
+    @classmethod
+    def model_inst_from_stateless_jwt_payload(cls, payload: user_access_token_schema.StatelessJwtPayload) -> UserAccessTokenTable:
+        """The refresh token as far as the access token knows it, never added to a session"""
+
+        return cls._MODEL(
+            id=payload['sub'],
+            user_id=payload['user_id'],
+            issued=datetime_module.datetime.fromtimestamp(
+                payload['iat'], tz=datetime_module.UTC),
+            expiry=datetime_module.datetime.fromtimestamp(
+                payload['exp'], tz=datetime_module.UTC),
+        )
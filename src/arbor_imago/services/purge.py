@@ -0,0 +1,56 @@
+from arbor_imago import core
+from arbor_imago.core import config
+from arbor_imago.services.models.gallery import Gallery as GalleryService
+from arbor_imago.services.models.user import User as UserService
+from arbor_imago.services.models.gallery_permission import GalleryPermission as GalleryPermissionService
+from arbor_imago.services import revocations
+
+from sqlmodel.ext.asyncio.session import AsyncSession
+import asyncio
+import pathlib
+
+
+async def purge_batch(session: AsyncSession, root: pathlib.Path, batch_size: int) -> int:
+    """Remove up to `batch_size` soft deleted rows, galleries before the users owning them, returns how many"""
+
+    purged = await GalleryService.purge(session, root, batch_size)
+    if purged < batch_size:
+        purged += await UserService.purge(session, batch_size - purged)
+    return purged
+
+
+async def purge(root: pathlib.Path | None = None, batch_size: int | None = None) -> int:
+    """Purge batch after batch until nothing soft deleted is left, returns how many rows were removed
+
+    Each batch gets its own session and transaction, so the database is never locked for the whole purge.
+    """
+
+    root = config.GALLERIES_DIR if root is None else root
+    batch_size = config.PURGE['batch_size'] if batch_size is None else batch_size
+
+    total = 0
+    while True:
+        async with core.ASYNC_SESSIONMAKER() as session:
+            purged = await purge_batch(session, root, batch_size)
+        total += purged
+        if purged == 0:
+            return total
+
+
+async def run_forever() -> None:
+    """Purge every PURGE['interval'], for as long as the app runs, along with the expired revocations and the
+    superseded gallery permission changes"""
+
+    while True:
+        try:
+            purged = await purge()
+            if purged:
+                core.LOGGER.info(f'Purged {purged} soft deleted rows')
+            if config.AUTH['stateless_access_tokens']:
+                async with core.ASYNC_SESSIONMAKER() as session:
+                    await revocations.prune(session)
+            async with core.ASYNC_SESSIONMAKER() as session:
+                await GalleryPermissionService.prune_changes(session)
+        except Exception:
+            core.LOGGER.exception('Purge failed, retrying at the next interval')
+        await asyncio.sleep(config.PURGE['interval'].total_seconds())
@@ -0,0 +1,120 @@
+"""Revoked user access tokens, for stateless access tokens to be checked against without a query
+
+A stateless access token is valid until it expires, deleting the user access token that refreshes it only stops the
+next refresh. So deletes are logged to the revocation table in the same transaction, and every worker keeps the
+log in memory, reloading it every AUTH['revocation_sync_interval']. The log only needs to cover one stateless access
+token lifespan, every access token issued before that has expired anyway, so it stays small enough to reload whole,
+which also picks up rows from transactions that committed out of order. Checking a token is a dict lookup, a revoked
+token is rejected on the worker that revoked it at once, and on the other workers after their next reload.
+"""
+
+from arbor_imago.core import config, types
+from arbor_imago.models.tables import Revocation as RevocationTable
+
+from sqlmodel import select, col, delete
+from sqlmodel.sql.expression import SelectOfScalar
+from sqlmodel.ext.asyncio.session import AsyncSession
+from collections.abc import Callable, Iterable
+import asyncio
+import datetime as datetime_module
+import time
+
+
+def _horizon() -> datetime_module.datetime:
+    return datetime_module.datetime.now(datetime_module.UTC) - config.AUTH['credential_lifespans']['stateless_access_token']
+
+
+def build_select_unexpired() -> SelectOfScalar[RevocationTable]:
+    return select(RevocationTable).where(col(RevocationTable.revoked_at) > _horizon())
+
+
+class Revocations:
+    """The revocation log of the last stateless access token lifespan, by user access token and by user
+
+    `clock` is for tests, which move time forward.
+    """
+
+    def __init__(self, clock: Callable[[], float] = time.monotonic):
+        self.clock = clock
+        self.syncs = 0
+        self._user_access_token_ids: set[types.UserAccessToken.id] = set()
+        self._users: dict[types.User.id, float] = {}
+        self._synced_at: float | None = None
+        self._lock = asyncio.Lock()
+
+    def _add(self, revocation: RevocationTable) -> None:
+        if revocation.user_access_token_id is not None:
+            self._user_access_token_ids.add(revocation.user_access_token_id)
+        else:
+            self._users[revocation.user_id] = max(
+                self._users.get(revocation.user_id, 0.0), revocation.revoked_at.timestamp())
+
+    async def _load(self, session: AsyncSession) -> None:
+
+        revocations = (await session.exec(build_select_unexpired())).all()
+
+        self._user_access_token_ids = set()
+        self._users = {}
+        for revocation in revocations:
+            self._add(revocation)
+        self.syncs += 1
+        self._synced_at = self.clock()
+
+    async def sync(self, session: AsyncSession) -> None:
+        """Reload the log if it is older than the sync interval, concurrent callers wait for a single reload"""
+
+        if self._synced_at is not None and self.clock() - self._synced_at < config.AUTH['revocation_sync_interval'].total_seconds():
+            return
+
+        seen = self.syncs
+        async with self._lock:
+            if self.syncs == seen:
+                await self._load(session)
+
+    def is_revoked(self, user_access_token_id: types.UserAccessToken.id, user_id: types.User.id, issued: float) -> bool:
+
+        if user_access_token_id in self._user_access_token_ids:
+            return True
+        revoked_at = self._users.get(user_id)
+        return revoked_at is not None and issued < revoked_at
+
+    def __len__(self) -> int:
+        return len(self._user_access_token_ids) + len(self._users)
+
+
+REVOCATIONS = Revocations()
+
+
+async def revoke(session: AsyncSession, revocations: Iterable[RevocationTable], revocation_log: Revocations = REVOCATIONS) -> None:
+    """Log the revocations in the session's transaction, and apply them to this worker right away
+
+    Nothing is logged without stateless access tokens, a user access token is checked on every request then. Should
+    the transaction roll back, the next reload drops the revocations again.
+    """
+
+    if not config.AUTH['stateless_access_tokens']:
+        return
+
+    revocations = list(revocations)
+    session.add_all(revocations)
+    await session.flush()
+    for revocation in revocations:
+        revocation_log._add(revocation)
+
+
+async def revoke_user_access_tokens(session: AsyncSession, user_access_tokens: Iterable[tuple[types.UserAccessToken.id, types.User.id]]) -> None:
+    await revoke(session, (RevocationTable(user_id=user_id, user_access_token_id=id) for id, user_id in user_access_tokens))
+
+
+async def revoke_users(session: AsyncSession, user_ids: Iterable[types.User.id]) -> None:
+    """Revoke every access token issued to the users so far"""
+
+    await revoke(session, (RevocationTable(user_id=user_id) for user_id in user_ids))
+
+
+async def prune(session: AsyncSession) -> int:
+    """Remove the revocations older than a stateless access token lifespan, returns how many"""
+
+    result = await session.exec(delete(RevocationTable).where(col(RevocationTable.revoked_at) <= _horizon()))
+    await session.commit()
+    return result.rowcount
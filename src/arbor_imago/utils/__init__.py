@@ -4,10 +4,8 @@ import secrets
 from pathlib import Path
 import os
 import json
-import yaml
-import tomllib
-import tomli_w
-import configparser
+
+# the yaml, toml and ini parsers are imported by the branch that needs them, most configs are json or absent
 
 
 def deep_merge_dicts(primary_dict: dict, secondary_dict: dict) -> dict:
@@ -59,12 +57,15 @@ def load_dict_from_file(config_path: Path) -> dict:
             with config_path.open('r') as f:
                 return json.load(f)
         case '.yaml' | '.yml':
+            import yaml
             with config_path.open('r') as f:
                 return yaml.safe_load(f)
         case '.toml':
+            import tomllib
             with config_path.open('rb') as f:
                 return tomllib.load(f)
         case '.ini':
+            import configparser
             config = configparser.ConfigParser()
             config.read(config_path)
             # Convert ConfigParser to dict
@@ -82,10 +83,13 @@ def write_dict_to_file(config: dict, config_path: Path) -> None:
         case '.json':
             config_path.write_text(json.dumps(config))
         case '.yaml' | '.yml':
+            import yaml
             config_path.write_text(yaml.dump(config))
         case '.toml':
+            import tomli_w
             config_path.write_text(tomli_w.dumps(config))
         case '.ini':
+            import configparser
             config_parser = configparser.ConfigParser()
             for section, values in config.items():
                 config_parser[section] = values
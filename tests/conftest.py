@@ -0,0 +1,51 @@
+import os
+
+# config refuses to import without a signing key
+os.environ.setdefault('ARBOR_IMAGO_JWT_SECRET_KEY', 'test-secret-key')
+
+import asyncio
+
+import pytest
+
+from arbor_imago.core import config
+
+# its helpers assert, for the detailed failures test modules get
+pytest.register_assert_rewrite('tests.database')
+from .database import Database  # noqa: E402
+
+
+@pytest.fixture
+def galleries_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'GALLERIES_DIR', tmp_path)
+    return tmp_path
+
+
+@pytest.fixture(params=['tree', 'id'])
+def media_layout(request, monkeypatch):
+    monkeypatch.setattr(config, 'MEDIA_LAYOUT', request.param)
+    return request.param
+
+
+@pytest.fixture
+def database():
+    """A database for tests that also make requests, which run on the test client's own event loop"""
+
+    database = Database()
+    asyncio.run(database.__aenter__())
+    yield database
+    asyncio.run(database.__aexit__())
+
+
+@pytest.fixture
+def client(database):
+    from fastapi.testclient import TestClient
+    from arbor_imago.app import app
+    from arbor_imago.core import dependencies
+
+    async def get_session():
+        async with database.sessionmaker() as session:
+            yield session
+
+    app.dependency_overrides[dependencies.get_session] = get_session
+    yield TestClient(app)
+    del app.dependency_overrides[dependencies.get_session]
@@ -0,0 +1,94 @@
+"""An in-memory database and the rows most service tests start from"""
+
+import datetime as datetime_module
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.pool import StaticPool
+from sqlmodel import SQLModel, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from arbor_imago import core
+from arbor_imago.core import config, utils
+from arbor_imago.models import tables
+from arbor_imago.schemas import user as user_schema, gallery as gallery_schema, user_access_token as user_access_token_schema
+from arbor_imago.services import counters
+from arbor_imago.services.models import auth_credential as auth_credential_service
+from arbor_imago.services.models.user import User as UserService
+from arbor_imago.services.models.gallery import Gallery as GalleryService
+from arbor_imago.services.models.gallery_permission import GalleryPermission as GalleryPermissionService
+from arbor_imago.services.models.user_access_token import UserAccessToken as UserAccessTokenService
+
+ADMIN = {'admin': True, 'authorized_user_id': None}
+
+
+class Database:
+    """An in-memory database, configured like the application's, recording the statements it runs"""
+
+    def __init__(self):
+        # a single connection, the database lives as long as it does
+        self.engine = create_async_engine(
+            'sqlite+aiosqlite://', poolclass=StaticPool, connect_args={'check_same_thread': False})
+        core.configure_sqlite_engine(self.engine)
+        self.sessionmaker = async_sessionmaker(
+            self.engine, class_=AsyncSession, expire_on_commit=False)
+        self.statements: list[str] = []
+        event.listen(self.engine.sync_engine, 'before_cursor_execute',
+                     self._record)
+
+    def _record(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    async def __aenter__(self) -> 'Database':
+        async with self.engine.begin() as connection:
+            await connection.run_sync(SQLModel.metadata.create_all)
+        # the permissions version starts over with the database, the levels cached from the last one must go
+        GalleryPermissionService.cache_version = None
+        self.statements.clear()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.engine.dispose()
+
+
+async def create_user(session: AsyncSession, username: str = 'user', **kwargs) -> tables.User:
+    kwargs.setdefault('email', '{}@example.com'.format(username))
+    kwargs.setdefault('user_role_id', config.USER_ROLE_NAME_MAPPING['user'])
+    return await UserService.create({'session': session, **ADMIN, 'create_model': user_schema.UserAdminCreate(
+        username=username, **kwargs)})
+
+
+async def create_gallery(session: AsyncSession, user_id: str, name: str, parent_id: str | None = None,
+                         date: datetime_module.date | None = None, visibility_level: int = 1, **kwargs) -> tables.Gallery:
+    return await GalleryService.create({'session': session, **ADMIN, 'create_model': gallery_schema.GalleryAdminCreate(
+        user_id=user_id, name=name, parent_id=parent_id, date=date, visibility_level=visibility_level, **kwargs)})
+
+
+async def bearer(session: AsyncSession, user: tables.User) -> dict[str, str]:
+    """Authorization headers of a new access token of the user"""
+
+    user_access_token = await UserAccessTokenService.create({'session': session, **ADMIN, 'create_model': user_access_token_schema.UserAccessTokenAdminCreate(
+        user_id=user.id, expiry=auth_credential_service.lifespan_to_expiry(config.AUTH['credential_lifespans']['access_token']))})
+    return {'Authorization': 'Bearer ' + utils.jwt_encode(UserAccessTokenService.to_jwt_payload(user_access_token))}
+
+
+async def snapshot(session):
+    """The counters of the galleries and users that are not soft deleted, those of the others no longer count"""
+
+    gallery_ids = set((await session.exec(select(tables.Gallery.id))).all())
+    user_ids = set((await session.exec(select(tables.User.id))).all())
+    gallery_counters = {counter.gallery_id: (counter.file_count, counter.file_size, counter.subtree_file_count, counter.subtree_file_size, counter.child_count)
+                        for counter in (await session.exec(select(tables.GalleryCounter).execution_options(populate_existing=True))).all()
+                        if counter.gallery_id in gallery_ids}
+    user_counters = {counter.user_id: (counter.file_count, counter.file_size, counter.api_key_count, counter.user_access_token_count)
+                     for counter in (await session.exec(select(tables.UserCounter).execution_options(populate_existing=True))).all()
+                     if counter.user_id in user_ids}
+    return gallery_counters, user_counters
+
+
+async def assert_rebuilt_alike(session):
+    await session.commit()
+    incremental = await snapshot(session)
+    await counters.rebuild(session)
+    assert await snapshot(session) == incremental
+    return incremental
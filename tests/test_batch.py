@@ -0,0 +1,105 @@
+import asyncio
+import datetime as datetime_module
+
+import pytest
+from sqlmodel import select
+
+from arbor_imago.core import config
+from arbor_imago.models import tables
+from arbor_imago.routers import base as base_router
+from arbor_imago.schemas import api_key as api_key_schema
+from arbor_imago.services.models.api_key import ApiKey as ApiKeyService
+
+from .database import ADMIN, Database, bearer, create_user, create_gallery
+
+PRIVATE = config.VISIBILITY_LEVEL_NAME_MAPPING['private']
+
+
+@pytest.fixture(autouse=True)
+def id_layout(galleries_dir, monkeypatch):
+    monkeypatch.setattr(config, 'MEDIA_LAYOUT', 'id')
+
+
+@pytest.fixture
+def galleries(database):
+    """The headers of a user, the id of their root gallery and of one gallery each of theirs and of another user"""
+
+    async def setup():
+        async with database.sessionmaker() as session:
+            user = await create_user(session)
+            other = await create_user(session, 'other')
+            root = await create_gallery(session, user.id, 'root')
+            own = await create_gallery(session, user.id, 'own', root.id)
+            others = await create_gallery(session, other.id, 'others', visibility_level=PRIVATE)
+            return await bearer(session, user), root.id, own.id, others.id
+
+    return asyncio.run(setup())
+
+
+def rows(database, query):
+    async def main():
+        async with database.sessionmaker() as session:
+            return (await session.exec(query)).all()
+    return asyncio.run(main())
+
+
+def test_a_failing_item_aborts_the_whole_batch(database, client, galleries):
+    headers, root_id, own_id, others_id = galleries
+    names = select(tables.Gallery.name).order_by(tables.Gallery.name)
+    before = rows(database, names)
+
+    # a duplicate, a parent that does not exist
+    for bad in ({'name': 'own', 'parent_id': root_id}, {'name': 'b', 'parent_id': 'missing'}):
+        response = client.post('/galleries/batch/', headers=headers, json=[
+            {'name': 'a', 'parent_id': root_id, 'visibility_level': PRIVATE}, {**bad, 'visibility_level': PRIVATE}])
+        assert response.status_code in (404, 409), response.text
+        assert rows(database, names) == before
+
+    response = client.patch('/galleries/batch/', headers=headers, json={
+        own_id: {'description': 'edited'}, others_id: {'description': 'edited'}})
+    assert response.status_code == 404, response.text
+    assert rows(database, select(tables.Gallery.description)) == [None] * 3
+
+    response = client.delete('/galleries/batch/', headers=headers, params={'gallery_ids': [own_id, others_id]})
+    assert response.status_code == 403, response.text
+    assert rows(database, names) == before
+
+    response = client.delete('/galleries/batch/', headers=headers, params={'gallery_ids': [own_id]})
+    assert response.status_code == 204
+    assert rows(database, names) == ['others', 'root']
+
+
+def test_batch_max_length(database, client, galleries):
+    headers, root_id, own_id, others_id = galleries
+    over = base_router.BATCH_MAX_LENGTH + 1
+
+    response = client.post('/galleries/batch/', headers=headers, json=[
+        {'name': str(i), 'parent_id': root_id, 'visibility_level': PRIVATE} for i in range(over)])
+    assert response.status_code == 422
+    response = client.patch('/galleries/batch/', headers=headers, json={
+        str(i): {'description': 'edited'} for i in range(over)})
+    assert response.status_code == 422
+    response = client.delete('/galleries/batch/', headers=headers, params={'gallery_ids': [str(i) for i in range(over)]})
+    assert response.status_code == 422
+
+    assert len(rows(database, select(tables.Gallery.id))) == 3
+
+
+def test_delete_many_is_a_single_in_delete():
+
+    async def main():
+        async with Database() as database, database.sessionmaker() as session:
+            user = await create_user(session)
+            api_keys = await ApiKeyService.create_many({'session': session, **ADMIN, 'create_models': [
+                api_key_schema.ApiKeyAdminCreate(user_id=user.id, name=str(i), expiry=datetime_module.datetime.now(
+                    datetime_module.UTC) + datetime_module.timedelta(days=1)) for i in range(3)]})
+
+            database.statements.clear()
+            await ApiKeyService.delete_many({'session': session, **ADMIN, 'ids': [api_key.id for api_key in api_keys]})
+
+            deletes = [statement for statement in database.statements if statement.startswith('DELETE')]
+            assert len(deletes) == 1
+            assert deletes[0].startswith('DELETE FROM api_key WHERE api_key.id IN (')
+            assert (await session.exec(select(tables.ApiKey))).all() == []
+
+    asyncio.run(main())
@@ -0,0 +1,58 @@
+import asyncio
+
+from sqlalchemy import text
+from sqlmodel import delete, func, select
+
+from arbor_imago.core import config
+from arbor_imago.models import tables
+
+from .database import Database, create_user, create_gallery
+
+
+async def count(session, model) -> int:
+    return (await session.exec(select(func.count()).select_from(model))).one()
+
+
+def test_one_delete_of_a_parent_removes_its_children():
+
+    async def main():
+        async with Database() as database:
+            async with database.sessionmaker() as session:
+                assert (await session.exec(text('PRAGMA foreign_keys'))).scalar() == 1
+
+                user = await create_user(session)
+                other = await create_user(session, 'other')
+                root = await create_gallery(session, user.id, 'root')
+                child = await create_gallery(session, user.id, 'child', root.id)
+                grandchild = await create_gallery(session, user.id, 'grandchild', child.id)
+                kept = await create_gallery(session, other.id, 'kept')
+                session.add_all([
+                    tables.File(id='file', stem='file', suffix='.jpg', gallery_id=grandchild.id),
+                    tables.GalleryPermission(gallery_id=child.id, user_id=other.id,
+                                             permission_level=config.PERMISSION_LEVEL_NAME_MAPPING['viewer']),
+                ])
+                await session.commit()
+
+            # a gallery takes its subtree, its files and the grants on it
+            async with database.sessionmaker() as session:
+                database.statements.clear()
+                await session.exec(delete(tables.Gallery).where(tables.Gallery.id == child.id))
+                await session.commit()
+                assert [statement for statement in database.statements if statement.startswith('DELETE')] == [
+                    'DELETE FROM gallery WHERE gallery.id = ?']
+
+                assert set((await session.exec(select(tables.Gallery.id))).all()) == {root.id, kept.id}
+                assert await count(session, tables.File) == 0
+                assert await count(session, tables.GalleryPermission) == 0
+
+            # a user takes their galleries and everything under them, the other user's are untouched
+            async with database.sessionmaker() as session:
+                database.statements.clear()
+                await session.exec(delete(tables.User).where(tables.User.id == user.id))
+                await session.commit()
+                assert len([statement for statement in database.statements if statement.startswith('DELETE')]) == 1
+
+                assert set((await session.exec(select(tables.Gallery.id))).all()) == {kept.id}
+                assert set((await session.exec(select(tables.User.id))).all()) == {other.id}
+
+    asyncio.run(main())
@@ -0,0 +1,146 @@
+import asyncio
+import datetime as datetime_module
+import email.utils
+
+import pytest
+from sqlalchemy import update
+from sqlmodel import select
+
+from arbor_imago.core import config
+from arbor_imago.models import tables
+from arbor_imago.schemas.pagination import Pagination
+from arbor_imago.services.models.gallery import Gallery as GalleryService
+
+from .database import ADMIN, bearer, create_user, create_gallery
+
+
+@pytest.fixture(autouse=True)
+def id_layout(galleries_dir, monkeypatch):
+    monkeypatch.setattr(config, 'MEDIA_LAYOUT', 'id')
+
+
+@pytest.fixture
+def owner(database):
+    """The headers of a user owning a public and a private gallery, and their ids"""
+
+    async def setup():
+        async with database.sessionmaker() as session:
+            user = await create_user(session)
+            public = await create_gallery(session, user.id, 'public')
+            private = await create_gallery(session, user.id, 'private',
+                                           visibility_level=config.VISIBILITY_LEVEL_NAME_MAPPING['private'])
+            return await bearer(session, user), public.id, private.id
+
+    return asyncio.run(setup())
+
+
+def test_if_none_match_hit_is_an_empty_304_with_the_etag(client, owner):
+    headers, public_id, private_id = owner
+
+    response = client.get('/galleries/{}'.format(public_id), headers=headers)
+    assert response.status_code == 200
+    etag = response.headers['ETag']
+    assert response.headers['Last-Modified']
+
+    response = client.get('/galleries/{}'.format(public_id), headers={**headers, 'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.content == b''
+    assert response.headers['ETag'] == etag
+    assert response.headers['Cache-Control'] == 'private, no-cache'
+
+
+def test_weak_and_listed_tags_match(client, owner):
+    headers, public_id, private_id = owner
+    etag = client.get('/galleries/{}'.format(public_id), headers=headers).headers['ETag']
+
+    for if_none_match in ('W/' + etag, '"other", ' + etag, '*'):
+        response = client.get('/galleries/{}'.format(public_id), headers={**headers, 'If-None-Match': if_none_match})
+        assert response.status_code == 304, if_none_match
+
+    response = client.get('/galleries/{}'.format(public_id), headers={**headers, 'If-None-Match': '"other"'})
+    assert response.status_code == 200
+
+
+def test_if_modified_since_is_ignored_with_if_none_match(client, owner):
+    headers, public_id, private_id = owner
+    response = client.get('/galleries/{}'.format(public_id), headers=headers)
+    last_modified = response.headers['Last-Modified']
+    later = email.utils.format_datetime(
+        email.utils.parsedate_to_datetime(last_modified) + datetime_module.timedelta(days=1), usegmt=True)
+
+    for if_modified_since in (last_modified, later):
+        response = client.get('/galleries/{}'.format(public_id), headers={**headers, 'If-Modified-Since': if_modified_since})
+        assert response.status_code == 304
+
+        response = client.get('/galleries/{}'.format(public_id), headers={
+            **headers, 'If-Modified-Since': if_modified_since, 'If-None-Match': '"other"'})
+        assert response.status_code == 200
+
+
+def test_list_etag_changes_on_edit_delete_and_page_shift(database, client, owner):
+    headers, public_id, private_id = owner
+
+    async def create_third():
+        async with database.sessionmaker() as session:
+            user = await session.get(tables.User, (await session.get(tables.Gallery, public_id)).user_id)
+            return (await create_gallery(session, user.id, 'third')).id
+
+    third_id = asyncio.run(create_third())
+    ids = [gallery['id'] for gallery in client.get('/galleries/', headers=headers).json()]
+    assert set(ids) == {public_id, private_id, third_id}
+
+    def list_etag(**params):
+        response = client.get('/galleries/', headers=headers, params=params)
+        assert response.status_code == 200
+        return response.headers['ETag']
+
+    etag = list_etag()
+    assert client.get('/galleries/', headers={**headers, 'If-None-Match': etag}).status_code == 304
+
+    # a row edit
+    assert client.patch('/galleries/{}'.format(ids[1]), headers=headers, json={'description': 'edited'}).status_code == 200
+    edited = list_etag()
+    assert edited != etag
+
+    # a row past the page going changes nothing, one before it shifts the page
+    page = list_etag(limit=1, offset=1)
+    assert client.delete('/galleries/{}'.format(ids[2]), headers=headers).status_code == 204
+    assert list_etag(limit=1, offset=1) == page
+    assert client.delete('/galleries/{}'.format(ids[0]), headers=headers).status_code == 204
+    # the page is now the row that was past it, or empty
+    assert list_etag(limit=1, offset=1) != page
+    assert list_etag() != edited
+
+
+def test_updated_at_bumps_on_core_updates(database):
+
+    async def main():
+        async with database.sessionmaker() as session:
+            user = await create_user(session)
+            gallery = await create_gallery(session, user.id, 'gallery')
+            page = Pagination(limit=10, offset=0)
+            before = await GalleryService.read_many_versions({'session': session, **ADMIN, 'pagination': page})
+
+            await session.exec(update(tables.Gallery).where(tables.Gallery.id == gallery.id).values(description='core'))
+            await session.commit()
+
+            updated_at = (await session.exec(select(tables.Gallery.updated_at).where(tables.Gallery.id == gallery.id))).one()
+            assert updated_at > before[0][1]
+            assert await GalleryService.read_many_versions({'session': session, **ADMIN, 'pagination': page}) != before
+
+    asyncio.run(main())
+
+
+def test_no_304_for_a_row_the_caller_cannot_read(database, client, owner):
+    headers, public_id, private_id = owner
+    etag = client.get('/galleries/{}'.format(private_id), headers=headers).headers['ETag']
+
+    async def stranger():
+        async with database.sessionmaker() as session:
+            return await bearer(session, await create_user(session, 'stranger'))
+
+    for other_headers in ({}, asyncio.run(stranger())):
+        for conditional in ({'If-None-Match': etag}, {'If-None-Match': '*'}):
+            response = client.get('/galleries/{}'.format(private_id), headers={**other_headers, **conditional})
+            assert response.status_code == 404
+            assert 'ETag' not in response.headers
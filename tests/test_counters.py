@@ -0,0 +1,196 @@
+import asyncio
+
+import pytest
+from sqlmodel import select
+
+from arbor_imago.core import config
+from arbor_imago.models import tables
+from arbor_imago.schemas import file as file_schema, gallery as gallery_schema
+from arbor_imago.services import counters
+from arbor_imago.services.models.file import File as FileService
+from arbor_imago.services.models.gallery import Gallery as GalleryService
+
+from .database import ADMIN, Database, assert_rebuilt_alike, bearer, create_user, create_gallery
+
+
+@pytest.fixture(autouse=True)
+def id_layout(galleries_dir, monkeypatch):
+    monkeypatch.setattr(config, 'MEDIA_LAYOUT', 'id')
+
+
+async def create_file(session, gallery_id, size, stem='a'):
+    return await FileService.create({'session': session, **ADMIN, 'create_model': file_schema.FileAdminCreate(
+        stem=stem, suffix='.jpg', gallery_id=gallery_id, size=size)})
+
+
+async def update_gallery(session, id, **fields):
+    return await GalleryService.update({'session': session, **ADMIN, 'id': id,
+                                        'update_model': gallery_schema.GalleryAdminUpdate(**fields)})
+
+
+async def make_tree(session):
+    user = await create_user(session)
+    root = await create_gallery(session, user.id, 'root')
+    parent = await create_gallery(session, user.id, 'parent', root.id)
+    child = await create_gallery(session, user.id, 'child', parent.id)
+    other = await create_gallery(session, user.id, 'other', root.id)
+    return user, root, parent, child, other
+
+
+def test_file_writes_propagate_up_the_tree():
+
+    async def main():
+        async with Database() as database, database.sessionmaker() as session:
+            user, root, parent, child, other = await make_tree(session)
+
+            await create_file(session, child.id, 10)
+            moved = await create_file(session, child.id, 20, 'b')
+            deleted = await create_file(session, parent.id, 5, 'c')
+            await create_file(session, other.id, None, 'd')
+
+            await FileService.update({'session': session, **ADMIN, 'id': moved.id,
+                                      'update_model': file_schema.FileAdminUpdate(gallery_id=other.id)})
+            await FileService.delete({'session': session, **ADMIN, 'id': deleted.id})
+
+            gallery_counters, user_counters = await assert_rebuilt_alike(session)
+            assert gallery_counters[child.id] == (1, 10, 1, 10, 0)
+            assert gallery_counters[parent.id] == (0, 0, 1, 10, 1)
+            assert gallery_counters[other.id] == (2, 20, 2, 20, 0)
+            assert gallery_counters[root.id] == (0, 0, 3, 30, 2)
+            assert user_counters[user.id][:2] == (3, 30)
+
+    asyncio.run(main())
+
+
+def test_moving_and_reowning_galleries():
+
+    async def main():
+        async with Database() as database, database.sessionmaker() as session:
+            user, root, parent, child, other = await make_tree(session)
+            new_owner = await create_user(session, 'new_owner')
+            await create_file(session, child.id, 10)
+            await create_file(session, parent.id, 7, 'b')
+
+            # parent and its child go below other
+            await update_gallery(session, parent.id, parent_id=other.id)
+            gallery_counters, _ = await assert_rebuilt_alike(session)
+            assert gallery_counters[other.id] == (0, 0, 2, 17, 1)
+            assert gallery_counters[root.id][2:] == (2, 17, 1)
+
+            # both in one batch, one below the other
+            await GalleryService.update_many({'session': session, **ADMIN, 'update_models': {
+                child.id: gallery_schema.GalleryAdminUpdate(parent_id=root.id),
+                parent.id: gallery_schema.GalleryAdminUpdate(parent_id=root.id),
+            }})
+            await assert_rebuilt_alike(session)
+
+            await update_gallery(session, child.id, user_id=new_owner.id)
+            _, user_counters = await assert_rebuilt_alike(session)
+            assert user_counters[new_owner.id][:2] == (1, 10)
+            assert user_counters[user.id][:2] == (1, 7)
+
+    asyncio.run(main())
+
+
+def test_soft_deleted_galleries_stop_counting():
+
+    async def main():
+        async with Database() as database, database.sessionmaker() as session:
+            user, root, parent, child, other = await make_tree(session)
+            await create_file(session, child.id, 10)
+            await create_file(session, other.id, 3, 'b')
+
+            await GalleryService.delete({'session': session, **ADMIN, 'id': parent.id})
+
+            gallery_counters, user_counters = await assert_rebuilt_alike(session)
+            assert gallery_counters[root.id] == (0, 0, 1, 3, 1)
+            assert user_counters[user.id][:2] == (1, 3)
+
+    asyncio.run(main())
+
+
+def test_rebuild_sets_right_writes_that_bypassed_the_services():
+
+    async def main():
+        async with Database() as database, database.sessionmaker() as session:
+            user, root, parent, child, other = await make_tree(session)
+            session.add(tables.File(id='raw', stem='raw', suffix=None, gallery_id=child.id, size=4))
+            await session.commit()
+
+            assert (await counters.fetch_gallery(session, root.id)).subtree_file_size == 0
+            assert await counters.rebuild(session) == (4, 1)
+            assert (await counters.fetch_gallery(session, root.id)).subtree_file_size == 4
+            assert (await counters.fetch_user(session, user.id)).file_size == 4
+
+    asyncio.run(main())
+
+
+def test_quota(monkeypatch):
+    monkeypatch.setattr(config, 'USER_STORAGE_QUOTA', 10)
+
+    async def main():
+        async with Database() as database, database.sessionmaker() as session:
+            user, root, parent, child, other = await make_tree(session)
+            await create_file(session, child.id, 8)
+            with pytest.raises(counters.QuotaExceededError):
+                await create_file(session, child.id, 3, 'b')
+            await create_file(session, child.id, 2, 'b')
+            assert (await counters.fetch_user(session, user.id)).file_size == 10
+            # the refused row went with its counters
+            assert sorted(file.size for file in (await session.exec(select(tables.File))).all()) == [2, 8]
+
+    asyncio.run(main())
+
+
+def test_upload_over_quota_is_refused_before_writing(database, client, galleries_dir, monkeypatch):
+    monkeypatch.setattr(config, 'USER_STORAGE_QUOTA', 10)
+
+    async def setup():
+        async with database.sessionmaker() as session:
+            user = await create_user(session)
+            gallery = await create_gallery(session, user.id, 'gallery')
+            return gallery.id, await bearer(session, user)
+
+    gallery_id, headers = asyncio.run(setup())
+
+    response = client.post('/galleries/{}/upload'.format(gallery_id), headers=headers,
+                           files={'file': ('a.jpg', b'x' * 8)})
+    assert response.status_code == 201
+    response = client.post('/galleries/{}/upload'.format(gallery_id), headers=headers,
+                           files={'file': ('b.jpg', b'x' * 3)})
+    assert response.status_code == 413
+
+    assert [path.stat().st_size for path in galleries_dir.rglob('*') if path.is_file()] == [8]
+
+    async def check():
+        async with database.sessionmaker() as session:
+            assert [file.size for file in (await session.exec(select(tables.File))).all()] == [8]
+            await assert_rebuilt_alike(session)
+
+    asyncio.run(check())
+
+
+def test_upload_of_an_existing_name_is_a_conflict(database, client, galleries_dir, monkeypatch):
+    # the tree layout names the bytes after the file
+    monkeypatch.setattr(config, 'MEDIA_LAYOUT', 'tree')
+
+    async def setup():
+        async with database.sessionmaker() as session:
+            user = await create_user(session)
+            gallery = await create_gallery(session, user.id, 'gallery')
+            return gallery.id, await bearer(session, user)
+
+    gallery_id, headers = asyncio.run(setup())
+
+    statuses = [client.post('/galleries/{}/upload'.format(gallery_id), headers=headers, files={'file': (name, b'xy')}).status_code
+                for name in ('pic.jpg', 'pic.jpg', 'pic', 'pic')]
+    assert statuses == [201, 409, 201, 409]
+
+    async def check():
+        async with database.sessionmaker() as session:
+            assert sorted((file.stem, file.suffix or '') for file in (await session.exec(select(tables.File))).all()) == [
+                ('pic', ''), ('pic', '.jpg')]
+            gallery_counters, _ = await assert_rebuilt_alike(session)
+            assert gallery_counters[gallery_id][:2] == (2, 4)
+
+    asyncio.run(check())
@@ -0,0 +1,131 @@
+import asyncio
+
+import pytest
+from sqlmodel import select
+
+from arbor_imago.core import config
+from arbor_imago.models import tables
+from arbor_imago.schemas import file as file_schema
+from arbor_imago.services import counters, fsck
+from arbor_imago.services.models.file import File as FileService
+from arbor_imago.services.models.gallery import Gallery as GalleryService
+
+from .database import ADMIN, Database, assert_rebuilt_alike, create_user, create_gallery
+
+
+async def create_file(session, gallery, stem, content: bytes | None, size=None):
+    """A row and, unless content is None, its bytes"""
+
+    file = await FileService.create({'session': session, **ADMIN, 'create_model': file_schema.FileAdminCreate(
+        stem=stem, suffix='.jpg', gallery_id=gallery.id, size=len(content) if size is None else size)})
+    if content is not None:
+        path = await GalleryService.get_file_path(session, file, config.GALLERIES_DIR)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(content)
+    return file
+
+
+async def check(session, repair=False):
+    return sorted([(problem.kind, problem.path.name) async for problem in fsck.check(session, repair=repair)])
+
+
+async def make_library(session, galleries_dir):
+    user = await create_user(session)
+    root = await create_gallery(session, user.id, 'root')
+    gallery = await create_gallery(session, user.id, 'gallery', root.id)
+    for dir in (await GalleryService.get_all_dirs(session, galleries_dir)).values():
+        dir.mkdir(parents=True, exist_ok=True)
+
+    ok = await create_file(session, gallery, 'ok', b'ok')
+    missing = await create_file(session, gallery, 'missing', None, size=7)
+    mismatched = await create_file(session, gallery, 'mismatched', b'12345', size=3)
+    gallery_dir = await GalleryService.get_dir(session, gallery, galleries_dir)
+    (gallery_dir / 'orphan.jpg').write_bytes(b'orphan')
+    (gallery_dir / 'stray').mkdir()
+    return user, root, gallery, gallery_dir, ok, missing, mismatched
+
+
+def name(file: tables.File) -> str:
+    return (file.id if config.MEDIA_LAYOUT == 'id' else file.stem) + file.suffix
+
+
+def test_detects_every_kind(galleries_dir, media_layout):
+
+    async def main():
+        async with Database() as database, database.sessionmaker() as session:
+            user, root, gallery, gallery_dir, ok, missing, mismatched = await make_library(session, galleries_dir)
+
+            assert await check(session) == sorted([
+                ('missing', name(missing)), ('size_mismatch', name(mismatched)),
+                ('orphan', 'orphan.jpg'), ('orphan_dir', 'stray')])
+
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize('page_size', [1, 2, 3, 1000])
+def test_merge_across_pages(galleries_dir, media_layout, monkeypatch, page_size):
+    monkeypatch.setattr(fsck, 'PAGE_SIZE', page_size)
+
+    async def main():
+        async with Database() as database, database.sessionmaker() as session:
+            user = await create_user(session)
+            gallery = await create_gallery(session, user.id, 'gallery')
+            (await GalleryService.get_dir(session, gallery, galleries_dir)).mkdir(parents=True)
+
+            # rows and files interleaved, so page boundaries fall between matches, orphans and missing files
+            expected = []
+            for i in range(7):
+                if i % 3 == 0:
+                    file = await create_file(session, gallery, 'f{}'.format(i), None, size=1)
+                    expected.append(('missing', name(file)))
+                else:
+                    await create_file(session, gallery, 'f{}'.format(i), b'x')
+                if i % 2 == 0:
+                    orphan = (await GalleryService.get_dir(session, gallery, galleries_dir)) / 'f{}_orphan.jpg'.format(i)
+                    orphan.write_bytes(b'x')
+                    expected.append(('orphan', orphan.name))
+
+            assert await check(session) == sorted(expected)
+
+    asyncio.run(main())
+
+
+def test_repair_keeps_counters_consistent(galleries_dir, media_layout):
+
+    async def main():
+        async with Database() as database, database.sessionmaker() as session:
+            user, root, gallery, gallery_dir, ok, missing, mismatched = await make_library(session, galleries_dir)
+
+            await check(session, repair=True)
+
+            files = {file.stem: file.size for file in (await session.exec(select(tables.File))).all()}
+            if media_layout == 'tree':
+                # the orphan is adopted
+                assert files == {'ok': 2, 'mismatched': 5, 'orphan': 6}
+                assert await check(session) == [('orphan_dir', 'stray')]
+            else:
+                # files named by id have no row to go back to
+                assert files == {'ok': 2, 'mismatched': 5}
+                assert await check(session) == [('orphan', 'orphan.jpg'), ('orphan_dir', 'stray')]
+            # bytes are never deleted
+            assert (gallery_dir / 'orphan.jpg').exists()
+
+            gallery_counters, _ = await assert_rebuilt_alike(session)
+            assert gallery_counters[root.id][3] == sum(files.values())
+
+    asyncio.run(main())
+
+
+def test_repair_of_soft_deleted_gallery_leaves_counters_alone(galleries_dir, media_layout):
+
+    async def main():
+        async with Database() as database, database.sessionmaker() as session:
+            user, root, gallery, gallery_dir, ok, missing, mismatched = await make_library(session, galleries_dir)
+            await GalleryService.delete({'session': session, **ADMIN, 'id': gallery.id})
+
+            await check(session, repair=True)
+
+            await assert_rebuilt_alike(session)
+            assert (await counters.fetch_user(session, user.id)).file_size == 0
+
+    asyncio.run(main())
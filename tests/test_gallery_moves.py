@@ -0,0 +1,177 @@
+import asyncio
+import os
+
+import pytest
+from sqlmodel import select
+
+from arbor_imago.core import config
+from arbor_imago.models import tables
+from arbor_imago.schemas import gallery as gallery_schema
+from arbor_imago.services.models import gallery as gallery_service
+from arbor_imago.services.models.gallery import Gallery as GalleryService
+
+from .database import ADMIN, Database, create_user, create_gallery
+
+
+@pytest.fixture
+def tree(galleries_dir, monkeypatch):
+    monkeypatch.setattr(config, 'MEDIA_LAYOUT', 'tree')
+    return galleries_dir
+
+
+async def make_dir(session, gallery: tables.Gallery):
+    dir = await GalleryService.get_dir(session, gallery, config.GALLERIES_DIR)
+    dir.mkdir(parents=True)
+    (dir / 'a.jpg').write_bytes(b'a')
+    return dir
+
+
+async def journal(session) -> list[tables.GalleryMove]:
+    return list((await session.exec(select(tables.GalleryMove))).all())
+
+
+async def update(session, id, **fields):
+    return await GalleryService.update({'session': session, **ADMIN, 'id': id,
+                                        'update_model': gallery_schema.GalleryAdminUpdate(**fields)})
+
+
+def test_rename(tree):
+
+    async def main():
+        async with Database() as database, database.sessionmaker() as session:
+            user = await create_user(session)
+            gallery = await create_gallery(session, user.id, 'before')
+            await make_dir(session, gallery)
+
+            await update(session, gallery.id, name='after')
+
+            assert not (tree / 'before').exists()
+            assert (tree / 'after' / 'a.jpg').read_bytes() == b'a'
+            assert await journal(session) == []
+
+    asyncio.run(main())
+
+
+def test_parent_move_carries_nested_child(tree):
+
+    async def main():
+        async with Database() as database, database.sessionmaker() as session:
+            user = await create_user(session)
+            parent = await create_gallery(session, user.id, 'parent')
+            child = await create_gallery(session, user.id, 'child', parent.id)
+            await make_dir(session, parent)
+            await make_dir(session, child)
+
+            await update(session, parent.id, name='renamed')
+
+            assert (tree / 'renamed' / 'child' / 'a.jpg').exists()
+            assert not (tree / 'parent').exists()
+            assert await GalleryService.get_dir(session, child, tree) == tree / 'renamed' / 'child'
+
+    asyncio.run(main())
+
+
+def test_update_many_moves_parent_before_child(tree):
+
+    async def main():
+        async with Database() as database, database.sessionmaker() as session:
+            user = await create_user(session)
+            parent = await create_gallery(session, user.id, 'parent')
+            child = await create_gallery(session, user.id, 'child', parent.id)
+            await make_dir(session, parent)
+            await make_dir(session, child)
+
+            # the child comes first, the moves are still made shallowest first
+            await GalleryService.update_many({'session': session, **ADMIN, 'update_models': {
+                child.id: gallery_schema.GalleryAdminUpdate(name='child2'),
+                parent.id: gallery_schema.GalleryAdminUpdate(name='parent2'),
+            }})
+
+            assert sorted(path.relative_to(tree).as_posix() for path in tree.rglob('*')) == [
+                'parent2', 'parent2/a.jpg', 'parent2/child2', 'parent2/child2/a.jpg']
+            assert await journal(session) == []
+
+    asyncio.run(main())
+
+
+def test_failed_rename_is_kept_for_replay(tree, monkeypatch):
+
+    async def main():
+        async with Database() as database, database.sessionmaker() as session:
+            user = await create_user(session)
+            parent = await create_gallery(session, user.id, 'parent')
+            child = await create_gallery(session, user.id, 'child', parent.id)
+            other = await create_gallery(session, user.id, 'other')
+            await make_dir(session, parent)
+            await make_dir(session, child)
+            await make_dir(session, other)
+
+            rename = os.rename
+
+            def failing_rename(src, dst):
+                if str(src).endswith('parent'):
+                    raise PermissionError(src)
+                rename(src, dst)
+
+            monkeypatch.setattr(os, 'rename', failing_rename)
+            await GalleryService.update_many({'session': session, **ADMIN, 'update_models': {
+                parent.id: gallery_schema.GalleryAdminUpdate(name='parent2'),
+                child.id: gallery_schema.GalleryAdminUpdate(name='child2'),
+                other.id: gallery_schema.GalleryAdminUpdate(name='other2'),
+            }})
+
+            # the child is not moved on its own into a new parent2, which would block the parent's move for good
+            assert (tree / 'parent' / 'child').exists()
+            assert not (tree / 'parent2').exists()
+            assert (tree / 'other2').exists()
+            assert sorted(move.dst for move in await journal(session)) == [
+                str(tree / 'parent2'), str(tree / 'parent2' / 'child2')]
+
+            monkeypatch.setattr(os, 'rename', rename)
+            assert await GalleryService.replay_moves(session) == 2
+            assert (tree / 'parent2' / 'child2' / 'a.jpg').exists()
+            assert not (tree / 'parent').exists()
+            assert await journal(session) == []
+
+    asyncio.run(main())
+
+
+def test_replay_after_crash(tree, monkeypatch):
+
+    async def main():
+        async with Database() as database, database.sessionmaker() as session:
+            user = await create_user(session)
+            parent = await create_gallery(session, user.id, 'parent')
+            child = await create_gallery(session, user.id, 'child', parent.id)
+            await make_dir(session, parent)
+            await make_dir(session, child)
+
+            # the process dies between the commit and the renames
+            monkeypatch.setattr(gallery_service, 'apply_moves',
+                                lambda moves: [False] * len(moves))
+            await GalleryService.update_many({'session': session, **ADMIN, 'update_models': {
+                parent.id: gallery_schema.GalleryAdminUpdate(name='parent2'),
+                child.id: gallery_schema.GalleryAdminUpdate(name='child2'),
+            }})
+            monkeypatch.undo()
+            monkeypatch.setattr(config, 'GALLERIES_DIR', tree)
+            monkeypatch.setattr(config, 'MEDIA_LAYOUT', 'tree')
+            assert len(await journal(session)) == 2
+
+            # and had moved the parent already, the child is followed there
+            os.rename(tree / 'parent', tree / 'parent2')
+
+            assert await GalleryService.replay_moves(session) == 2
+            assert (tree / 'parent2' / 'child2' / 'a.jpg').exists()
+            assert await journal(session) == []
+
+            # another worker replaying the same journal finds nothing left to do
+            assert await GalleryService.replay_moves(session) == 0
+
+    asyncio.run(main())
+
+
+def test_apply_moves_with_a_vanished_source_is_done(tmp_path):
+
+    (tmp_path / 'b').mkdir()
+    assert gallery_service.apply_moves([(tmp_path / 'a', tmp_path / 'b')]) == [True]
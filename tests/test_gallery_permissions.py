@@ -0,0 +1,187 @@
+import asyncio
+
+import pytest
+from sqlalchemy import text
+from sqlmodel import select
+
+from arbor_imago.core import config, types
+from arbor_imago.models import tables
+from arbor_imago.schemas import gallery as gallery_schema, gallery_permission as gallery_permission_schema
+from arbor_imago.services.models.gallery import Gallery as GalleryService
+from arbor_imago.services.models.gallery_permission import GalleryPermission as GalleryPermissionService
+
+from .database import ADMIN, Database, create_user, create_gallery
+
+VIEWER = config.PERMISSION_LEVEL_NAME_MAPPING['viewer']
+EDITOR = config.PERMISSION_LEVEL_NAME_MAPPING['editor']
+
+
+@pytest.fixture(autouse=True)
+def id_layout(galleries_dir, monkeypatch):
+    # re-parenting renames nothing
+    monkeypatch.setattr(config, 'MEDIA_LAYOUT', 'id')
+
+
+async def grant(session, user_id, gallery_id, permission_level):
+    await GalleryPermissionService.create({'session': session, **ADMIN, 'create_model': gallery_permission_schema.GalleryPermissionAdminCreate(
+        user_id=user_id, gallery_id=gallery_id, permission_level=permission_level)})
+
+
+async def revoke(session, user_id, gallery_id):
+    await GalleryPermissionService.delete({'session': session, **ADMIN, 'id': types.GalleryPermissionId(
+        user_id=user_id, gallery_id=gallery_id)})
+
+
+async def levels(session, user_id, *galleries):
+    permission_levels = await GalleryPermissionService.get_effective_permission_levels(
+        session, user_id, [gallery.id for gallery in galleries])
+    return [permission_levels[gallery.id] for gallery in galleries]
+
+
+async def make_tree(session):
+    owner = await create_user(session, 'owner')
+    guest = await create_user(session, 'guest')
+    root = await create_gallery(session, owner.id, 'root')
+    parent = await create_gallery(session, owner.id, 'parent', root.id)
+    child = await create_gallery(session, owner.id, 'child', parent.id)
+    other = await create_gallery(session, owner.id, 'other', root.id)
+    return guest, root, parent, child, other
+
+
+def test_inherited_from_grandparent_and_closest_grant_wins():
+
+    async def main():
+        async with Database() as database, database.sessionmaker() as session:
+            guest, root, parent, child, other = await make_tree(session)
+            await grant(session, guest.id, root.id, VIEWER)
+
+            assert await levels(session, guest.id, root, parent, child, other) == [VIEWER] * 4
+
+            await grant(session, guest.id, parent.id, EDITOR)
+            assert await levels(session, guest.id, root, parent, child, other) == [VIEWER, EDITOR, EDITOR, VIEWER]
+
+            # one query for the whole batch, the memo for the rest of the transaction
+            database.statements.clear()
+            assert await levels(session, guest.id, child, other) == [EDITOR, VIEWER]
+            assert database.statements == []
+
+    asyncio.run(main())
+
+
+def test_invalidated_by_grant_update_and_revoke():
+
+    async def main():
+        async with Database() as database, database.sessionmaker() as session:
+            guest, root, parent, child, other = await make_tree(session)
+            assert await levels(session, guest.id, child) == [None]
+
+            await grant(session, guest.id, parent.id, VIEWER)
+            assert await levels(session, guest.id, child) == [VIEWER]
+
+            await GalleryPermissionService.update({'session': session, **ADMIN, 'id': types.GalleryPermissionId(
+                user_id=guest.id, gallery_id=parent.id), 'update_model': gallery_permission_schema.GalleryPermissionAdminUpdate(permission_level=EDITOR)})
+            assert await levels(session, guest.id, child) == [EDITOR]
+
+            await revoke(session, guest.id, parent.id)
+            assert await levels(session, guest.id, child) == [None]
+
+    asyncio.run(main())
+
+
+def test_invalidated_by_reparent():
+
+    async def main():
+        async with Database() as database, database.sessionmaker() as session:
+            guest, root, parent, child, other = await make_tree(session)
+            await grant(session, guest.id, other.id, VIEWER)
+            assert await levels(session, guest.id, child) == [None]
+
+            await GalleryService.update({'session': session, **ADMIN, 'id': child.id,
+                                         'update_model': gallery_schema.GalleryAdminUpdate(parent_id=other.id)})
+            assert await levels(session, guest.id, child) == [VIEWER]
+
+    asyncio.run(main())
+
+
+def test_grant_committed_elsewhere_applies_to_the_next_request():
+
+    async def main():
+        async with Database() as database:
+            async with database.sessionmaker() as session:
+                guest, root, parent, child, other = await make_tree(session)
+                assert await levels(session, guest.id, child) == [None]
+
+            # another worker's write, none of this process' session events see it, only the change it logs
+            async with database.engine.begin() as connection:
+                await connection.execute(text('INSERT INTO gallery_permission (gallery_id, user_id, permission_level) VALUES (:gallery_id, :user_id, :permission_level)'), {
+                    'gallery_id': root.id, 'user_id': guest.id, 'permission_level': EDITOR})
+                await connection.execute(text(
+                    "INSERT INTO gallery_permission_change (changed_at) VALUES ('2000-01-01 00:00:00')"))
+
+            async with database.sessionmaker() as session:
+                assert await levels(session, guest.id, child) == [EDITOR]
+
+    asyncio.run(main())
+
+
+def recursive_queries(database):
+    return [statement for statement in database.statements if statement.startswith('WITH RECURSIVE')]
+
+
+def test_next_request_is_served_from_the_process_cache():
+
+    async def main():
+        async with Database() as database:
+            async with database.sessionmaker() as session:
+                guest, root, parent, child, other = await make_tree(session)
+                await grant(session, guest.id, root.id, VIEWER)
+                await session.commit()
+
+            async with database.sessionmaker() as session:
+                assert await levels(session, guest.id, child, other) == [VIEWER, VIEWER]
+
+            database.statements.clear()
+            async with database.sessionmaker() as session:
+                assert await levels(session, guest.id, child, other) == [VIEWER, VIEWER]
+                assert await levels(session, guest.id, parent) == [VIEWER]
+            # the version is read once per transaction, only the gallery not seen yet is queried
+            assert len([statement for statement in database.statements if 'gallery_permission_change' in statement]) == 1
+            assert len(recursive_queries(database)) == 1
+
+    asyncio.run(main())
+
+
+def test_process_cache_is_dropped_by_a_committed_change():
+
+    async def main():
+        async with Database() as database:
+            async with database.sessionmaker() as session:
+                guest, root, parent, child, other = await make_tree(session)
+                await session.commit()
+
+            async with database.sessionmaker() as session:
+                assert await levels(session, guest.id, child) == [None]
+
+            async with database.sessionmaker() as session:
+                await grant(session, guest.id, parent.id, EDITOR)
+
+            database.statements.clear()
+            async with database.sessionmaker() as session:
+                assert await levels(session, guest.id, child) == [EDITOR]
+            assert len(recursive_queries(database)) == 1
+
+            async with database.sessionmaker() as session:
+                await GalleryService.update({'session': session, **ADMIN, 'id': child.id,
+                                             'update_model': gallery_schema.GalleryAdminUpdate(parent_id=other.id)})
+
+            async with database.sessionmaker() as session:
+                assert await levels(session, guest.id, child) == [None]
+
+            # the purge keeps only the latest change, the version
+            async with database.sessionmaker() as session:
+                assert await GalleryPermissionService.prune_changes(session) > 0
+                assert len((await session.exec(select(tables.GalleryPermissionChange))).all()) == 1
+            async with database.sessionmaker() as session:
+                assert await levels(session, guest.id, child) == [None]
+
+    asyncio.run(main())
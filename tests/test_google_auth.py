@@ -0,0 +1,161 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+from google.auth import crypt, jwt as google_jwt
+
+from arbor_imago.auth import google
+
+
+AUDIENCE = 'client.apps.googleusercontent.com'
+
+
+def generate_key() -> tuple[str, str]:
+    """Public and private PKCS#1 PEMs, from whichever RSA library google-auth is using"""
+
+    try:
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa as cryptography_rsa
+    except ImportError:
+        import rsa
+        public, private = rsa.newkeys(1024)
+        return public.save_pkcs1().decode(), private.save_pkcs1().decode()
+
+    key = cryptography_rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    return (key.public_key().public_bytes(serialization.Encoding.PEM, serialization.PublicFormat.PKCS1).decode(),
+            key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL, serialization.NoEncryption()).decode())
+
+
+KEYS = {key_id: generate_key() for key_id in ('k1', 'k2')}
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class CertsEndpoint:
+    """Stand-in for Google's certificates endpoint"""
+
+    def __init__(self, key_ids: list[str], max_age: int = 3600):
+        self.key_ids = key_ids
+        self.max_age = max_age
+        self.status_code = 200
+        self.requests = 0
+
+    def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.requests += 1
+        return httpx.Response(self.status_code, headers={'Cache-Control': 'public, max-age={}, must-revalidate'.format(self.max_age)},
+                              json={key_id: KEYS[key_id][0] for key_id in self.key_ids})
+
+
+def make_certificates(endpoint: CertsEndpoint, clock: Clock) -> google.Certificates:
+    return google.Certificates(url='https://certs.test/', transport=httpx.MockTransport(endpoint), clock=clock)
+
+
+def make_token(key_id: str = 'k1', **claims) -> str:
+    signer = crypt.RSASigner.from_string(KEYS[key_id][1], key_id)
+    now = int(time.time())
+    payload = {'iss': 'https://accounts.google.com', 'aud': AUDIENCE, 'sub': '1', 'email': 'a@example.com',
+               'iat': now, 'exp': now + 3600, **claims}
+    return google_jwt.encode(signer, payload).decode()
+
+
+def test_verifies_against_cached_certificates():
+    endpoint, clock = CertsEndpoint(['k1']), Clock()
+    certificates = make_certificates(endpoint, clock)
+
+    async def main():
+        for _ in range(3):
+            claims = await google.verify_id_token(make_token(), AUDIENCE, certificates)
+            assert claims['email'] == 'a@example.com'
+
+    asyncio.run(main())
+    assert endpoint.requests == 1
+
+
+@pytest.mark.parametrize('claims', [{'aud': 'other'}, {'iss': 'https://example.com'}, {'exp': int(time.time()) - 3600, 'iat': int(time.time()) - 7200}])
+def test_rejects_invalid_claims(claims):
+    certificates = make_certificates(CertsEndpoint(['k1']), Clock())
+    with pytest.raises(ValueError):
+        asyncio.run(google.verify_id_token(
+            make_token(**claims), AUDIENCE, certificates))
+
+
+def test_rejects_malformed_token():
+    certificates = make_certificates(CertsEndpoint(['k1']), Clock())
+    with pytest.raises(ValueError):
+        asyncio.run(google.verify_id_token('not a token', AUDIENCE, certificates))
+
+
+def test_refetches_after_max_age():
+    endpoint, clock = CertsEndpoint(['k1'], max_age=600), Clock()
+    certificates = make_certificates(endpoint, clock)
+
+    async def main():
+        await google.verify_id_token(make_token(), AUDIENCE, certificates)
+        clock.now += 601
+        await google.verify_id_token(make_token(), AUDIENCE, certificates)
+
+    asyncio.run(main())
+    assert endpoint.requests == 2
+
+
+def test_refreshes_in_background_before_expiry():
+    endpoint, clock = CertsEndpoint(['k1'], max_age=600), Clock()
+    certificates = make_certificates(endpoint, clock)
+
+    async def main():
+        await google.verify_id_token(make_token(), AUDIENCE, certificates)
+        clock.now += 600 - google.REFRESH_AHEAD + 1
+        await google.verify_id_token(make_token(), AUDIENCE, certificates)
+        # answered from the cache, the refresh only started
+        assert endpoint.requests == 1
+        assert certificates._refresh_task is not None
+        await certificates._refresh_task
+
+    asyncio.run(main())
+    assert endpoint.requests == 2
+
+
+def test_refetches_for_rotated_key():
+    endpoint, clock = CertsEndpoint(['k1']), Clock()
+    certificates = make_certificates(endpoint, clock)
+
+    async def main():
+        await google.verify_id_token(make_token(), AUDIENCE, certificates)
+        endpoint.key_ids = ['k1', 'k2']
+
+        # too soon after the last fetch, an unknown key id cannot make every login refetch
+        with pytest.raises(ValueError):
+            await google.verify_id_token(make_token('k2'), AUDIENCE, certificates)
+
+        clock.now += google.MIN_REFRESH_INTERVAL
+        await google.verify_id_token(make_token('k2'), AUDIENCE, certificates)
+
+    asyncio.run(main())
+    assert endpoint.requests == 2
+
+
+def test_concurrent_cold_logins_fetch_once():
+    endpoint, clock = CertsEndpoint(['k1']), Clock()
+    certificates = make_certificates(endpoint, clock)
+
+    async def main():
+        await asyncio.gather(*(google.verify_id_token(make_token(), AUDIENCE, certificates) for _ in range(5)))
+
+    asyncio.run(main())
+    assert endpoint.requests == 1
+
+
+def test_unavailable_certificates():
+    endpoint = CertsEndpoint(['k1'])
+    endpoint.status_code = 500
+    certificates = make_certificates(endpoint, Clock())
+    with pytest.raises(google.CertificatesUnavailableError):
+        asyncio.run(google.verify_id_token(
+            make_token(), AUDIENCE, certificates))
@@ -0,0 +1,50 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+
+# modules a command pays for only on the code path that uses them
+DEFERRED = {
+    'arbor_imago.cli': {'arbor_imago.app', 'arbor_imago.routers', 'arbor_imago.services', 'arbor_imago.core.dependencies', 'fastapi', 'uvicorn',
+                        'google', 'httpx', 'requests', 'yaml', 'tomllib', 'tomli_w', 'configparser'},
+    'arbor_imago.app': {'google', 'yaml', 'tomllib', 'tomli_w', 'configparser', 'uvicorn'},
+}
+
+# budgets for what a module costs on top of sqlmodel, which every entry point imports first, as a multiple of
+# sqlmodel's own import time, so they hold on a Pi as well as on a laptop
+BUDGETS = {
+    'arbor_imago.cli': 0.5,
+    'arbor_imago.app': 2.5,
+}
+
+
+def import_times(module: str) -> dict[str, int]:
+    """Cumulative microseconds per module imported by a fresh interpreter importing module"""
+
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import sqlmodel, {}'.format(module)],
+                               capture_output=True, text=True, env=os.environ.copy(), check=True)
+
+    times: dict[str, int] = {}
+    for line in completed.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.removeprefix('import time:').split('|')
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+@pytest.mark.parametrize('module', DEFERRED.keys())
+def test_deferred_imports(module):
+    times = import_times(module)
+    imported = set(times) | {name.partition('.')[0] for name in times}
+    assert DEFERRED[module] & imported == set()
+
+
+@pytest.mark.parametrize('module', BUDGETS.keys())
+def test_import_time_budget(module):
+    # the best of a few runs, a cold disk cache or a busy machine should not fail the build
+    ratio = min(times[module] / times['sqlmodel']
+                for times in (import_times(module) for _ in range(3)))
+    assert ratio <= BUDGETS[module], '{} took {:.1f}x sqlmodel'.format(module, ratio)
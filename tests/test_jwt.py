@@ -1,42 +1,102 @@
-import pytest
-from ..src.arbor_imago.models.bases import auth_credential
-from ..src.arbor_imago.models import SignUp
-from ..src.arbor_imago.services.sign_up import SignUp as SignUpService
+import asyncio
 import datetime as datetime_module
+import types
+
+import pytest
+
+from arbor_imago.auth import utils as auth_utils
+from arbor_imago.core import cache, config, utils
+from arbor_imago.models import tables
+from arbor_imago.services.models.user_access_token import UserAccessToken as UserAccessTokenService
+
+from .database import Database
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache, 'time', types.SimpleNamespace(monotonic=clock))
+    return clock
+
+
+@pytest.fixture
+def decodes(monkeypatch):
+    """The tokens jwt_decode was called with"""
+
+    auth_utils.JWT_PAYLOAD_CACHE.invalidate()
+    tokens = []
+    jwt_decode = utils.jwt_decode
+
+    def counting_jwt_decode(token):
+        tokens.append(token)
+        return jwt_decode(token)
+
+    monkeypatch.setattr(utils, 'jwt_decode', counting_jwt_decode)
+    monkeypatch.setitem(config.AUTH, 'stateless_access_tokens', True)
+    yield tokens
+    auth_utils.JWT_PAYLOAD_CACHE.invalidate()
+
+
+def make_token(lifespan: datetime_module.timedelta = datetime_module.timedelta(days=1), **claims) -> str:
+    now = datetime_module.datetime.now(datetime_module.UTC)
+    user = tables.User(id='user', username='user', email='user@example.com', user_role_id=2)
+    user_access_token = tables.UserAccessToken(id='refresh', user_id=user.id, issued=now, expiry=now + lifespan)
+    payload = {**UserAccessTokenService.to_stateless_jwt_payload(user_access_token, user), **claims}
+    return utils.jwt_encode({k: v for k, v in payload.items() if v is not None})
+
+
+def get_auths(*tokens: str) -> list[auth_utils.GetAuthReturn]:
+
+    async def main():
+        async with Database() as database, database.sessionmaker() as session:
+            return [await auth_utils.get_auth_from_auth_credential_jwt(token=token, session=session) for token in tokens]
+
+    return asyncio.run(main())
+
+
+def test_round_trip():
+    payload = {'sub': 'user', 'exp': int(datetime_module.datetime.now(datetime_module.UTC).timestamp()) + 60}
+    assert utils.jwt_decode(utils.jwt_encode(payload)) == payload
+
 
+def test_second_request_skips_decoding(decodes):
+    token = make_token()
 
-example = SignUp(
-    expiry=datetime_module.datetime(
-        2023, 10, 1, 12, 0, 0, tzinfo=datetime_module.timezone.utc
-    ),
-    issued=datetime_module.datetime(
-        2023, 10, 12, 12, 0, 0, tzinfo=datetime_module.timezone.utc
-    ),
-    email='a@a.com',
-)
+    first, second = get_auths(token, token)
 
+    assert first.isAuthorized and second.isAuthorized
+    assert second.user == first.user
+    assert decodes == [token]
 
-# def test_from_payload():
 
-#     instance = SignUpService.from_payload(
-#         {
-#             'exp': example.expiry.timestamp(),
-#             'iat': example.issued.timestamp(),
-#             'sub': example.email,
-#             'type': example.auth_type,
-#         }
-#     )
+def test_entries_expire_at_the_token_expiry(decodes, clock):
+    token = make_token(datetime_module.timedelta(seconds=60))
 
-#     assert instance == example
+    get_auths(token)
+    clock.now += 55
+    assert get_auths(token)[0].isAuthorized
+    assert decodes == [token]
 
+    # past the expiry, well within the cache's ttl
+    clock.now += 10
+    get_auths(token)
+    assert decodes == [token, token]
 
-# def test_to_payload():
 
-#     payload = SignUp.to_payload(example)
+def test_invalid_tokens_are_never_cached(decodes):
+    malformed = 'not.a.jwt'
+    missing_claims = make_token(type=None)
 
-#     assert payload == {
-#         'exp': example.expiry,
-#         'iat': example.issued,
-#         'sub': example.email,
-#         'type': example.auth_type,
-#     }
+    for token in (malformed, missing_claims):
+        auths = get_auths(token, token)
+        assert not any(auth.isAuthorized for auth in auths)
+        assert decodes.count(token) == 2
+    assert len(auth_utils.JWT_PAYLOAD_CACHE) == 0
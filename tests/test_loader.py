@@ -0,0 +1,47 @@
+import asyncio
+
+from arbor_imago.services.models.gallery import Gallery as GalleryService
+
+from .database import Database, create_user, create_gallery
+
+
+def selects(database):
+    return [statement for statement in database.statements if statement.startswith('SELECT')]
+
+
+def test_concurrent_loads_collapse_into_one_in_query():
+
+    async def main():
+        async with Database() as database, database.sessionmaker() as session:
+            user = await create_user(session)
+            galleries = [await create_gallery(session, user.id, str(i)) for i in range(3)]
+            await session.commit()
+
+            database.statements.clear()
+            loader = GalleryService.loader(session)
+            loaded = await asyncio.gather(*(loader.load(gallery.id) for gallery in galleries), loader.load('missing'))
+
+            assert [gallery.id for gallery in loaded[:3]] == [gallery.id for gallery in galleries]
+            assert loaded[3] is None
+            assert len(selects(database)) == 1
+            assert ' IN (' in selects(database)[0]
+
+    asyncio.run(main())
+
+
+def test_repeated_id_is_served_from_the_identity_map():
+
+    async def main():
+        async with Database() as database, database.sessionmaker() as session:
+            user = await create_user(session)
+            gallery = await create_gallery(session, user.id, 'gallery')
+            await session.commit()
+
+            database.statements.clear()
+            loader = GalleryService.loader(session)
+            first = await loader.load(gallery.id)
+            assert (await loader.load_many([gallery.id, gallery.id])) == {gallery.id: first}
+            assert await GalleryService.fetch_by_id(session, gallery.id) is first
+            assert len(selects(database)) == 1
+
+    asyncio.run(main())
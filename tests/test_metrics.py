@@ -0,0 +1,123 @@
+import asyncio
+import threading
+
+import bcrypt
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import StaticPool
+
+from arbor_imago.core import metrics, utils
+
+
+def test_counter_and_labels():
+    counter = metrics.Counter('test_counter_total', 'A counter', ('path',))
+    counter.inc('/a')
+    counter.inc('/a', amount=2)
+    counter.inc('say "hi"\n')
+    assert counter.render() == ('# HELP test_counter_total A counter\n'
+                                '# TYPE test_counter_total counter\n'
+                                'test_counter_total{path="/a"} 3.0\n'
+                                'test_counter_total{path="say \\"hi\\"\\n"} 1.0\n')
+
+
+def test_unlabelled_metrics_start_at_zero():
+    assert 'test_gauge 0.0' in metrics.Gauge(
+        'test_gauge', 'A gauge').render()
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = metrics.Histogram(
+        'test_seconds', 'A histogram', ('route',), buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 5.0):
+        histogram.observe(value, '/a')
+    lines = histogram.render().splitlines()[2:]
+    assert lines == ['test_seconds_bucket{route="/a",le="0.1"} 2.0',
+                     'test_seconds_bucket{route="/a",le="1.0"} 3.0',
+                     'test_seconds_bucket{route="/a",le="+Inf"} 4.0',
+                     'test_seconds_sum{route="/a"} 5.65',
+                     'test_seconds_count{route="/a"} 4.0']
+
+
+def test_middleware_labels_route_templates():
+    app = FastAPI()
+    app.add_middleware(metrics.MetricsMiddleware)
+
+    @app.get('/items/{item_id}')
+    async def item(item_id: int):
+        return {'in_progress': metrics.HTTP_REQUESTS_IN_PROGRESS._values[()]}
+
+    client = TestClient(app)
+    before = dict(metrics.HTTP_REQUESTS._values)
+    assert client.get('/items/1').json() == {'in_progress': 1.0}
+    client.get('/items/2')
+    client.get('/nowhere/3')
+
+    def added(*labels):
+        return metrics.HTTP_REQUESTS._values.get(labels, 0) - before.get(labels, 0)
+
+    assert added('GET', '/items/{item_id}', '200') == 2
+    assert added('GET', 'unmatched', '404') == 1
+    assert metrics.HTTP_REQUESTS_IN_PROGRESS._values[()] == 0
+
+
+def test_check_password_off_the_event_loop():
+    hashed = bcrypt.hashpw(b'secret', bcrypt.gensalt(4)).decode()
+
+    async def main():
+        return await asyncio.gather(utils.check_password('secret', hashed), utils.check_password('wrong', hashed))
+
+    assert asyncio.run(main()) == [True, False]
+    assert metrics.PASSWORD_CHECKS_IN_PROGRESS._values[()] == 0
+
+
+def test_hash_password_off_the_event_loop(monkeypatch):
+    threads = []
+    hash_password = utils.utils.hash_password
+
+    def recording_hash_password(password):
+        threads.append(threading.current_thread().name)
+        return hash_password(password)
+
+    monkeypatch.setattr(utils.utils, 'hash_password', recording_hash_password)
+
+    async def main():
+        return await utils.hash_password('secret')
+
+    assert bcrypt.checkpw(b'secret', asyncio.run(main()).encode())
+    assert threads[0].startswith('bcrypt')
+    assert metrics.PASSWORD_CHECKS_IN_PROGRESS._values[()] == 0
+
+
+def test_pool_checkout_waits_and_connections(tmp_path, monkeypatch):
+    url = 'sqlite+aiosqlite:///{}'.format(tmp_path / 'metrics.db')
+    engine = create_async_engine(url, poolclass=metrics.pool_class(url))
+    # the application engine's collector is put back afterwards
+    monkeypatch.setitem(metrics.REGISTRY, 'arbor_imago_db_pool_connections',
+                        metrics.REGISTRY.get('arbor_imago_db_pool_connections'))
+    metrics.instrument_engine(engine)
+    collected = metrics.REGISTRY['arbor_imago_db_pool_connections']
+
+    async def main():
+        before = metrics.DB_POOL_CHECKOUT_WAIT._values.get((), ([], [0.0, 0.0]))[1][1]
+        async with engine.connect() as connection:
+            await connection.execute(text('SELECT 1'))
+            assert dict(collected.collect())[('checked_out',)] == 1
+        assert metrics.DB_POOL_CHECKOUT_WAIT._values[()][1][1] == before + 1
+
+        # the disposed pool is replaced, its successor is the one reported
+        await engine.dispose()
+        async with engine.connect() as connection:
+            await connection.execute(text('SELECT 1'))
+            assert dict(collected.collect())[('checked_out',)] == 1
+        await engine.dispose()
+
+    asyncio.run(main())
+    assert metrics.pool_class('sqlite+aiosqlite://') is StaticPool
+
+
+def test_render_includes_every_cache():
+    from arbor_imago.auth import utils as auth_utils
+    assert 'arbor_imago_cache_hits_total{{cache="{}"}}'.format(
+        auth_utils.JWT_PAYLOAD_CACHE.name) in metrics.render()
@@ -0,0 +1,36 @@
+import asyncio
+import re
+
+from arbor_imago.core import config
+from arbor_imago.schemas import user as user_schema
+
+from .database import bearer, create_user
+
+
+def list_selects(database, table: str) -> list[set[str]]:
+    """The columns of each paginated SELECT from the table"""
+
+    return [set(column.strip() for column in re.match(r'SELECT (.*?)\s+FROM ', statement, re.S).group(1).split(','))
+            for statement in database.statements
+            if statement.startswith('SELECT') and 'FROM {} '.format(table) in statement and 'LIMIT' in statement]
+
+
+def test_user_lists_select_only_their_schema_columns(database, client):
+
+    async def setup():
+        async with database.sessionmaker() as session:
+            admin = await create_user(session, 'admin', user_role_id=config.USER_ROLE_NAME_MAPPING['admin'], password='password')
+            await create_user(session, 'other', password='password')
+            return await bearer(session, admin)
+
+    headers = asyncio.run(setup())
+
+    for url, schema in (('/users/', user_schema.UserPublic), ('/admin/users/', user_schema.UserPrivate)):
+        database.statements.clear()
+        response = client.get(url, headers=headers)
+        assert response.status_code == 200, response.text
+        assert all('hashed_password' not in user for user in response.json())
+
+        selects = list_selects(database, 'user')
+        assert {'user.' + name for name in schema.model_fields} in selects, url
+        assert all('user.hashed_password' not in columns for columns in selects), url
@@ -0,0 +1,93 @@
+import pytest
+import datetime as datetime_module
+from sqlalchemy import create_engine
+from sqlmodel import SQLModel, select
+
+from arbor_imago.models import tables
+from arbor_imago.schemas import gallery as gallery_schema, api_key as api_key_schema
+from arbor_imago.schemas.order_by import OrderBy
+from arbor_imago.services.models.gallery import Gallery as GalleryService
+from arbor_imago.services.models.api_key import ApiKey as ApiKeyService
+from arbor_imago.services.models.otp import OTP as OTPService
+from arbor_imago.services.models.user import User as UserService
+from arbor_imago.services.models.user_access_token import UserAccessToken as UserAccessTokenService
+from arbor_imago.services.models.gallery_permission import GalleryPermission as GalleryPermissionService
+from arbor_imago.services.models.api_key_scope import ApiKeyScope as ApiKeyScopeService
+from arbor_imago.services import counters, revocations
+from arbor_imago.core import types
+
+
+@pytest.fixture(scope='module')
+def engine():
+    engine = create_engine('sqlite://')
+    SQLModel.metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+
+def query_plan(engine, query) -> list[str]:
+
+    compiled = query.compile(dialect=engine.dialect, compile_kwargs={
+                             'render_postcompile': True})
+    params = tuple(compiled.params[key] for key in compiled.positiontup)
+
+    with engine.connect() as conn:
+        rows = conn.exec_driver_sql(
+            'EXPLAIN QUERY PLAN ' + str(compiled), params).all()
+    return [row[-1] for row in rows]
+
+
+def full_table_scans(plan: list[str]) -> list[str]:
+    table_names = set(SQLModel.metadata.tables.keys())
+    return [detail for detail in plan if detail.startswith('SCAN ') and detail.split(' ')[1] in table_names]
+
+
+QUERIES = {
+    'gallery.is_available': GalleryService._build_select_available(gallery_schema.GalleryAdminAvailable(
+        user_id='u', parent_id='p', name='n', date=datetime_module.date(2024, 1, 1))),
+    'gallery.is_available.root': GalleryService._build_select_available(gallery_schema.GalleryAdminAvailable(
+        user_id='u', name='root')),
+    'gallery.get_root_gallery': GalleryService._build_select_root_gallery('u'),
+    'gallery.by_id': GalleryService._build_select_by_id('g'),
+    'gallery.list_by_user': GalleryService.build_order_by(
+        select(tables.Gallery).where(tables.Gallery.user_id == 'u'), []),
+    'api_key.is_available': ApiKeyService._build_select_available(api_key_schema.ApiKeyAdminAvailable(
+        user_id='u', name='n')),
+    'api_key.by_id': ApiKeyService._build_select_by_id('k'),
+    'otp.by_user_id': OTPService._build_select_by_user_id('u'),
+    'user.by_id': UserService._build_select_by_id('u'),
+    'user.by_email_or_username': select(tables.User).where(
+        (tables.User.username == 'a') | (tables.User.email == 'a')),
+    'user_access_token.by_id': UserAccessTokenService._build_select_by_id('t'),
+    'user_access_token.list_by_user': UserAccessTokenService.build_order_by(
+        select(tables.UserAccessToken).where(tables.UserAccessToken.user_id == 'u'), []),
+    'gallery_permission.by_id': GalleryPermissionService._build_select_by_id(
+        types.GalleryPermissionId(gallery_id='g', user_id='u')),
+    'api_key_scope.by_id': ApiKeyScopeService._build_select_by_id(
+        types.ApiKeyScopeId(api_key_id='k', scope_id=1)),
+    'gallery.visible': select(tables.Gallery).where(GalleryService._build_visibility_predicate('u', False)),
+    'gallery_permission.effective_permission_levels': GalleryPermissionService._build_select_effective_permission_levels(
+        'u', ['g1', 'g2']),
+    'gallery.subtree_ids': GalleryService._build_select_subtree_ids(['g1', 'g2']),
+    'gallery.purgeable': GalleryService._build_select_purgeable(100),
+    'user.purgeable_ids': UserService._build_select_purgeable_ids(100),
+    'counters.ancestor_ids': counters._build_select_ancestor_ids('g'),
+    'revocations.unexpired': revocations.build_select_unexpired(),
+}
+
+for _field in ('issued', 'expiry', 'name'):
+    for _ascending in (True, False):
+        QUERIES['api_key.list_by_user.{}.{}'.format(_field, 'asc' if _ascending else 'desc')] = ApiKeyService.build_order_by(
+            select(tables.ApiKey).where(tables.ApiKey.user_id == 'u'), [OrderBy[types.ApiKey.order_by](field=_field, ascending=_ascending)])
+
+
+@pytest.mark.parametrize('name', QUERIES.keys())
+def test_no_full_table_scan(engine, name):
+    plan = query_plan(engine, QUERIES[name])
+    assert full_table_scans(plan) == [], '\n'.join(plan)
+
+
+@pytest.mark.parametrize('name', [name for name in QUERIES if name.startswith('api_key.list_by_user.')])
+def test_list_order_uses_index(engine, name):
+    plan = query_plan(engine, QUERIES[name])
+    assert not any('TEMP B-TREE' in detail for detail in plan), '\n'.join(plan)
@@ -0,0 +1,87 @@
+import asyncio
+import datetime as datetime_module
+
+import pytest
+from sqlalchemy.exc import InvalidRequestError
+
+from arbor_imago.core import config
+from arbor_imago.models import tables
+from arbor_imago.schemas import api_key as api_key_schema
+from arbor_imago.services.models.api_key import ApiKey as ApiKeyService
+from arbor_imago.services.models.gallery import Gallery as GalleryService
+
+from .database import ADMIN, Database, create_user, create_gallery
+
+
+def selects(database):
+    return [statement for statement in database.statements if statement.startswith('SELECT')]
+
+
+def test_unloaded_relationships_raise_instead_of_loading():
+
+    async def main():
+        async with Database() as database:
+            async with database.sessionmaker() as session:
+                user = await create_user(session)
+                root = await create_gallery(session, user.id, 'root')
+                await create_gallery(session, user.id, 'child', root.id)
+
+            async with database.sessionmaker() as session:
+                gallery = await GalleryService.fetch_by_id(session, root.id)
+                database.statements.clear()
+                for relationship in ('children', 'user', 'files', 'gallery_permissions'):
+                    with pytest.raises(InvalidRequestError, match="lazy='raise'"):
+                        getattr(gallery, relationship)
+                assert database.statements == []
+
+    asyncio.run(main())
+
+
+def test_load_related_takes_one_query_per_relationship():
+
+    async def main():
+        async with Database() as database:
+            async with database.sessionmaker() as session:
+                user = await create_user(session)
+                roots = [await create_gallery(session, user.id, str(i)) for i in range(3)]
+                for root in roots:
+                    await create_gallery(session, user.id, 'child', root.id)
+
+            async with database.sessionmaker() as session:
+                galleries = list((await GalleryService.fetch_by_ids(session, [root.id for root in roots])).values())
+
+                database.statements.clear()
+                await GalleryService.load_related(session, galleries, tables.Gallery.children, tables.Gallery.files)
+                # the galleries themselves, then one selectinload per relationship
+                assert len(selects(database)) == 3
+                assert [[child.name for child in gallery.children] for gallery in galleries] == [['child']] * 3
+                assert [gallery.files for gallery in galleries] == [[]] * 3
+
+                # loaded relationships are skipped
+                database.statements.clear()
+                await GalleryService.load_related(session, galleries, tables.Gallery.children)
+                assert database.statements == []
+
+    asyncio.run(main())
+
+
+def test_api_key_scopes_are_loaded_by_the_service():
+
+    async def main():
+        async with Database() as database:
+            async with database.sessionmaker() as session:
+                user = await create_user(session)
+                api_key = await ApiKeyService.create({'session': session, **ADMIN, 'create_model': api_key_schema.ApiKeyAdminCreate(
+                    user_id=user.id, name='key', expiry=datetime_module.datetime.now(datetime_module.UTC) + datetime_module.timedelta(days=1))})
+                session.add_all([tables.ApiKeyScope(api_key_id=api_key.id, scope_id=config.SCOPE_NAME_MAPPING[name])
+                                 for name in ('users.read', 'users.write')])
+                await session.commit()
+
+            async with database.sessionmaker() as session:
+                api_key = await ApiKeyService.fetch_by_id(session, api_key.id)
+                with pytest.raises(InvalidRequestError):
+                    api_key.api_key_scopes
+                assert sorted(await ApiKeyService.get_scope_ids(session, api_key)) == sorted(
+                    config.SCOPE_NAME_MAPPING[name] for name in ('users.read', 'users.write'))
+
+    asyncio.run(main())
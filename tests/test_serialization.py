@@ -0,0 +1,63 @@
+import datetime as datetime_module
+import json
+import timeit
+import uuid
+
+import pytest
+from fastapi.encoders import jsonable_encoder
+
+from arbor_imago.models import tables
+from arbor_imago.routers import base
+from arbor_imago.schemas import gallery as gallery_schema
+
+
+PAGE_SIZE = 100
+
+
+def make_galleries(n: int = PAGE_SIZE) -> list[tables.Gallery]:
+    now = datetime_module.datetime.now(datetime_module.UTC)
+    return [tables.Gallery(id=str(uuid.uuid4()), user_id=str(uuid.uuid4()), name='gallery {}'.format(i),
+                           parent_id=None, description='description' * (i % 3), date=datetime_module.date(2024, 1, 1 + i % 28),
+                           visibility_level=1, updated_at=now) for i in range(n)]
+
+
+def fastapi_path(galleries: list[tables.Gallery]) -> bytes:
+    """What a route returning list[GalleryPrivate] costs without json_route
+
+    The router validates each row, then FastAPI dumps the models, validates them again against the
+    return annotation, and encodes the result with jsonable_encoder and json.dumps.
+    """
+
+    adapter = base.type_adapter(list[gallery_schema.GalleryPrivate])
+    content = [gallery_schema.GalleryPrivate.model_validate(
+        gallery).model_dump(by_alias=True) for gallery in galleries]
+    value = adapter.dump_python(adapter.validate_python(content), mode='json')
+    return json.dumps(jsonable_encoder(value), ensure_ascii=False, allow_nan=False,
+                      indent=None, separators=(',', ':')).encode('utf-8')
+
+
+def json_route_path(galleries: list[tables.Gallery]) -> bytes:
+    adapter = base.type_adapter(list[gallery_schema.GalleryPrivate])
+    return adapter.dump_json(base.validate_many(gallery_schema.GalleryPrivate, galleries))
+
+
+@pytest.mark.parametrize('n', [0, 1, PAGE_SIZE])
+def test_json_route_path_matches_fastapi_path(n):
+    galleries = make_galleries(n)
+    assert json.loads(json_route_path(galleries)) == json.loads(
+        fastapi_path(galleries))
+
+
+def test_type_adapter_is_cached():
+    assert base.type_adapter(list[gallery_schema.GalleryPublic]) is base.type_adapter(
+        list[gallery_schema.GalleryPublic])
+
+
+if __name__ == '__main__':
+    # python -m tests.test_serialization
+    galleries = make_galleries()
+    for name, path in (('fastapi', fastapi_path), ('json_route', json_route_path)):
+        number = 200
+        seconds = min(timeit.repeat(lambda: path(galleries), number=number, repeat=5)) / number
+        print('{:<12}{:>10.1f} us/page{:>8.2f} us/row'.format(name,
+              seconds * 1e6, seconds * 1e6 / PAGE_SIZE))
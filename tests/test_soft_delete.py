@@ -0,0 +1,109 @@
+import asyncio
+
+import pytest
+
+from arbor_imago.core import config
+from arbor_imago.schemas.pagination import Pagination
+from arbor_imago.services import purge
+from arbor_imago.services.models import base
+from arbor_imago.services.models.gallery import Gallery as GalleryService
+from arbor_imago.services.models.user import User as UserService
+
+from .database import ADMIN, Database, create_user, create_gallery
+
+PAGE = Pagination(limit=100, offset=0)
+
+
+@pytest.fixture(autouse=True)
+def tree(galleries_dir, monkeypatch):
+    monkeypatch.setattr(config, 'MEDIA_LAYOUT', 'tree')
+
+
+async def read_many_ids(service, session, **auth):
+    return {inst.id for inst in await service.read_many({'session': session, **(auth or ADMIN), 'pagination': PAGE})}
+
+
+async def make_galleries(session):
+    user = await create_user(session)
+    viewer = await create_user(session, 'viewer')
+    root = await create_gallery(session, user.id, 'root',
+                                visibility_level=config.VISIBILITY_LEVEL_NAME_MAPPING['private'])
+    parent = await create_gallery(session, user.id, 'parent', root.id)
+    child = await create_gallery(session, user.id, 'child', parent.id)
+    for gallery in (root, parent, child):
+        (await GalleryService.get_dir(session, gallery, config.GALLERIES_DIR)).mkdir(parents=True, exist_ok=True)
+    return user, viewer, root, parent, child
+
+
+def test_soft_deleted_gallery_and_its_subtree_are_hidden():
+
+    async def main():
+        async with Database() as database, database.sessionmaker() as session:
+            user, viewer, root, parent, child = await make_galleries(session)
+            # loaded into the session before the delete
+            assert await GalleryService.fetch_by_id(session, child.id) is not None
+            assert await read_many_ids(GalleryService, session, admin=False, authorized_user_id=viewer.id) == {parent.id, child.id}
+
+            await GalleryService.delete({'session': session, **ADMIN, 'id': parent.id})
+
+            for id in (parent.id, child.id):
+                assert await GalleryService.fetch_by_id(session, id) is None
+            assert await read_many_ids(GalleryService, session) == {root.id}
+            assert await read_many_ids(GalleryService, session, admin=False, authorized_user_id=viewer.id) == set()
+            assert await read_many_ids(GalleryService, session, admin=False, authorized_user_id=user.id) == {root.id}
+
+            with base.soft_deleted_visible(session):
+                assert await read_many_ids(GalleryService, session) == {root.id, parent.id, child.id}
+                assert await GalleryService.fetch_by_id(session, child.id) is not None
+
+    asyncio.run(main())
+
+
+def test_soft_deleted_user_and_their_galleries_are_hidden():
+
+    async def main():
+        async with Database() as database, database.sessionmaker() as session:
+            user, viewer, root, parent, child = await make_galleries(session)
+
+            await UserService.delete({'session': session, **ADMIN, 'id': user.id})
+
+            assert await UserService.fetch_by_id(session, user.id) is None
+            assert await read_many_ids(UserService, session) == {viewer.id}
+            assert await read_many_ids(UserService, session, admin=False, authorized_user_id=viewer.id) == {viewer.id}
+            assert await read_many_ids(GalleryService, session) == set()
+
+            with base.soft_deleted_visible(session):
+                assert await read_many_ids(UserService, session) == {user.id, viewer.id}
+
+    asyncio.run(main())
+
+
+def test_purge_batch_removes_leaves_first_within_batch_size(galleries_dir):
+
+    async def main():
+        async with Database() as database, database.sessionmaker() as session:
+            user, viewer, root, parent, child = await make_galleries(session)
+            root_dir, parent_dir, child_dir = [await GalleryService.get_dir(session, gallery, galleries_dir)
+                                               for gallery in (root, parent, child)]
+            await UserService.delete({'session': session, **ADMIN, 'id': user.id})
+
+            # within the batch size
+            assert await purge.purge_batch(session, galleries_dir, 1) == 1
+            assert not child_dir.exists()
+            assert parent_dir.exists()
+
+            # a batch only takes the galleries that are leaves when it starts, it never cascades into a subtree
+            assert await purge.purge_batch(session, galleries_dir, 5) == 1
+            assert not parent_dir.exists()
+            assert root_dir.exists()
+
+            # the user goes once their galleries are gone
+            assert await purge.purge_batch(session, galleries_dir, 5) == 2
+            assert not root_dir.exists()
+            assert await purge.purge_batch(session, galleries_dir, 5) == 0
+
+            with base.soft_deleted_visible(session):
+                assert await read_many_ids(UserService, session) == {viewer.id}
+                assert await read_many_ids(GalleryService, session) == set()
+
+    asyncio.run(main())
@@ -0,0 +1,174 @@
+import asyncio
+import datetime as datetime_module
+
+import pytest
+
+from arbor_imago.auth import utils as auth_utils
+from arbor_imago.core import config, utils
+from arbor_imago.models import tables
+from arbor_imago.schemas import user as user_schema, user_access_token as user_access_token_schema
+from arbor_imago.services import revocations
+from arbor_imago.services.models.user_access_token import UserAccessToken as UserAccessTokenService
+
+from .database import ADMIN, Database, create_user
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def stateless(monkeypatch):
+    monkeypatch.setitem(config.AUTH, 'stateless_access_tokens', True)
+
+
+def make_token(user_role_id: int = 2, issued: datetime_module.datetime | None = None, **claims) -> str:
+    now = datetime_module.datetime.now(datetime_module.UTC)
+    user = tables.User(id='user', username='user', email='user@example.com',
+                       user_role_id=user_role_id)
+    user_access_token = tables.UserAccessToken(
+        id='refresh', user_id=user.id, issued=now, expiry=now + datetime_module.timedelta(days=1))
+    payload = {**UserAccessTokenService.to_stateless_jwt_payload(
+        user_access_token, user), **claims}
+    if issued is not None:
+        payload['iat'] = issued.timestamp()
+    return utils.jwt_encode({k: v for k, v in payload.items() if v is not None})
+
+
+def get_auth(token: str, **kwargs) -> auth_utils.GetAuthReturn:
+
+    async def main():
+        async with Database() as database, database.sessionmaker() as session:
+            return await auth_utils.get_auth_from_auth_credential_jwt(token=token, session=session, **kwargs)
+
+    return asyncio.run(main())
+
+
+async def get_auth_with(database: Database, revocation_log: revocations.Revocations, token: str) -> auth_utils.GetAuthReturn:
+    async with database.sessionmaker() as session:
+        return await auth_utils.get_auth_from_stateless_jwt_payload(utils.jwt_decode(token), session, set(), revocation_log)
+
+
+async def revoke(database: Database, *revocation_rows: tables.Revocation, revocation_log: revocations.Revocations | None = None) -> None:
+    async with database.sessionmaker() as session:
+        await revocations.revoke(session, revocation_rows, revocations.Revocations() if revocation_log is None else revocation_log)
+        await session.commit()
+
+
+def test_scope_bitmask_round_trip():
+    for scope_ids in config.USER_ROLE_ID_SCOPE_IDS.values():
+        assert UserAccessTokenService.bitmask_to_scope_ids(
+            UserAccessTokenService.scope_ids_to_bitmask(scope_ids)) == scope_ids
+
+
+def test_authorizes_from_claims():
+    authorization = get_auth(make_token())
+    assert authorization.isAuthorized
+    assert authorization.user == user_schema.UserClaims(id='user', user_role_id=2)
+    assert authorization.scope_ids == config.USER_ROLE_ID_SCOPE_IDS[2]
+    assert authorization.auth_credential is not None and authorization.auth_credential.id == 'refresh'
+
+
+def test_carries_no_profile():
+    payload = utils.jwt_decode(make_token())
+    assert 'email' not in payload and 'username' not in payload
+
+
+def test_session_info_reads_the_profile(stateless, database, client):
+
+    async def setup():
+        async with database.sessionmaker() as session:
+            user = await create_user(session)
+            user_access_token = await UserAccessTokenService.create({'session': session, **ADMIN, 'create_model': user_access_token_schema.UserAccessTokenAdminCreate(
+                user_id=user.id, expiry=datetime_module.datetime.now(datetime_module.UTC) + datetime_module.timedelta(days=1))})
+            return utils.jwt_encode(UserAccessTokenService.to_stateless_jwt_payload(user_access_token, user))
+
+    token = asyncio.run(setup())
+    user = client.get('/auth', headers={'Authorization': 'Bearer ' + token}).json()['auth']['user']
+    assert (user['username'], user['email']) == ('user', 'user@example.com')
+
+
+def test_lives_minutes_not_days():
+    payload = utils.jwt_decode(make_token())
+    assert payload['exp'] - payload['iat'] <= config.AUTH['credential_lifespans']['stateless_access_token'].total_seconds()
+
+
+def test_required_scopes():
+    assert get_auth(make_token(), required_scopes={'admin'}).exception.status_code == 403
+
+
+def test_missing_claims():
+    assert get_auth(make_token(user_id=None)).exception.status_code == 400
+
+
+def test_not_a_refresh_token():
+    assert get_auth(make_token(), permit_stateless=False).exception.status_code == 400
+
+
+def test_revocation_log_is_read_once_per_sync_interval():
+    clock = Clock()
+    revocation_log = revocations.Revocations(clock=clock)
+
+    async def main():
+        async with Database() as database:
+            for _ in range(3):
+                assert (await get_auth_with(database, revocation_log, make_token())).isAuthorized
+            assert revocation_log.syncs == 1
+            statements = len(database.statements)
+
+            clock.now += config.AUTH['revocation_sync_interval'].total_seconds()
+            await get_auth_with(database, revocation_log, make_token())
+            assert revocation_log.syncs == 2
+            assert len(database.statements) > statements
+
+    asyncio.run(main())
+
+
+def test_revoked_user_access_token(stateless):
+    clock = Clock()
+    this_worker, other_worker = revocations.Revocations(clock=clock), revocations.Revocations(clock=clock)
+
+    async def main():
+        async with Database() as database:
+            assert (await get_auth_with(database, other_worker, make_token())).isAuthorized
+
+            await revoke(database, tables.Revocation(user_id='user', user_access_token_id='refresh'), revocation_log=this_worker)
+            assert (await get_auth_with(database, this_worker, make_token())).exception.status_code == 401
+
+            # the other worker learns at its next sync
+            assert (await get_auth_with(database, other_worker, make_token())).isAuthorized
+            clock.now += config.AUTH['revocation_sync_interval'].total_seconds()
+            assert (await get_auth_with(database, other_worker, make_token())).exception.status_code == 401
+
+    asyncio.run(main())
+
+
+def test_revoked_user_keeps_later_tokens(stateless):
+    now = datetime_module.datetime.now(datetime_module.UTC)
+
+    async def main():
+        async with Database() as database:
+            await revoke(database, tables.Revocation(user_id='user', revoked_at=now - datetime_module.timedelta(seconds=10)))
+            revocation_log = revocations.Revocations()
+            assert (await get_auth_with(database, revocation_log, make_token(issued=now - datetime_module.timedelta(seconds=20)))).exception.status_code == 401
+            assert (await get_auth_with(database, revocation_log, make_token())).isAuthorized
+
+    asyncio.run(main())
+
+
+def test_prune(stateless):
+    lifespan = config.AUTH['credential_lifespans']['stateless_access_token']
+    now = datetime_module.datetime.now(datetime_module.UTC)
+
+    async def main():
+        async with Database() as database:
+            await revoke(database, tables.Revocation(user_id='old', revoked_at=now - lifespan - datetime_module.timedelta(seconds=1)),
+                         tables.Revocation(user_id='new', revoked_at=now))
+            async with database.sessionmaker() as session:
+                assert await revocations.prune(session) == 1
+
+    asyncio.run(main())
@@ -0,0 +1,162 @@
+import asyncio
+import datetime as datetime_module
+
+import pytest
+from sqlmodel import select
+
+from arbor_imago.core import config
+from arbor_imago.models import tables
+from arbor_imago.schemas import api_key as api_key_schema, gallery as gallery_schema, user as user_schema
+from arbor_imago.services.models import base
+from arbor_imago.services.models.api_key import ApiKey as ApiKeyService
+from arbor_imago.services.models.gallery import Gallery as GalleryService
+from arbor_imago.services.models.user import User as UserService
+
+from .database import ADMIN, Database, bearer, create_user, create_gallery
+
+
+@pytest.fixture(autouse=True)
+def id_layout(galleries_dir, monkeypatch):
+    monkeypatch.setattr(config, 'MEDIA_LAYOUT', 'id')
+
+
+async def create_api_key(session, user_id, name):
+    return await ApiKeyService.create({'session': session, **ADMIN, 'create_model': api_key_schema.ApiKeyAdminCreate(
+        user_id=user_id, name=name, expiry=datetime_module.datetime.now(datetime_module.UTC) + datetime_module.timedelta(days=1))})
+
+
+def test_duplicates_are_not_available():
+
+    async def main():
+        async with Database() as database, database.sessionmaker() as session:
+            user = await create_user(session)
+            other = await create_user(session, 'other')
+            gallery = await create_gallery(session, user.id, 'gallery')
+            await create_api_key(session, user.id, 'key')
+
+            with pytest.raises(base.NotAvailableError, match='username'):
+                await create_user(session, 'user', email='else@example.com')
+            with pytest.raises(base.NotAvailableError, match='email'):
+                await create_user(session, 'else', email='user@example.com')
+            with pytest.raises(base.NotAvailableError, match='Gallery'):
+                await create_gallery(session, user.id, 'gallery')
+            with pytest.raises(base.NotAvailableError, match='API Key'):
+                await create_api_key(session, user.id, 'key')
+            with pytest.raises(base.NotAvailableError, match='Gallery'):
+                await GalleryService.update({'session': session, **ADMIN, 'id': (await create_gallery(session, user.id, 'renamed')).id,
+                                             'update_model': gallery_schema.GalleryAdminUpdate(name='gallery')})
+
+            # names are unique per user
+            await create_gallery(session, other.id, 'gallery')
+            await create_api_key(session, other.id, 'key')
+            assert (await session.get(tables.Gallery, gallery.id)).name == 'gallery'
+
+    asyncio.run(main())
+
+
+def test_updates_are_checked_by_the_named_constraints():
+
+    async def main():
+        async with Database() as database, database.sessionmaker() as session:
+            user_id = (await create_user(session)).id
+            other_id = (await create_user(session, 'other')).id
+            await create_api_key(session, user_id, 'key')
+            api_key_id = (await create_api_key(session, user_id, 'renamed')).id
+
+            with pytest.raises(base.NotAvailableError, match='username `user`') as excinfo:
+                await UserService.update({'session': session, **ADMIN, 'id': other_id,
+                                          'update_model': user_schema.UserAdminUpdate(username='user')})
+            assert base.violated_constraint(excinfo.value.__cause__) == 'uq_user_username'
+            with pytest.raises(base.NotAvailableError, match='email `user@example.com`') as excinfo:
+                await UserService.update({'session': session, **ADMIN, 'id': other_id,
+                                          'update_model': user_schema.UserAdminUpdate(email='user@example.com')})
+            assert base.violated_constraint(excinfo.value.__cause__) == 'uq_user_email'
+            with pytest.raises(base.NotAvailableError, match='API Key name `key` is not available') as excinfo:
+                await ApiKeyService.update({'session': session, **ADMIN, 'id': api_key_id,
+                                            'update_model': api_key_schema.ApiKeyAdminUpdate(name='key')})
+            assert base.violated_constraint(excinfo.value.__cause__) == 'uq_api_key_user_id_name'
+
+            # the expression indexes are named by sqlite itself
+            with pytest.raises(base.NotAvailableError) as excinfo:
+                await create_gallery(session, user_id, 'gallery')
+                await create_gallery(session, user_id, 'gallery')
+            assert base.violated_constraint(excinfo.value.__cause__) == 'uq_gallery_user_id_parent_id_name_date'
+
+            assert (await session.get(tables.User, other_id)).username == 'other'
+            assert (await session.get(tables.ApiKey, api_key_id)).name == 'renamed'
+
+    asyncio.run(main())
+
+
+def test_dangling_reference_is_not_available():
+
+    async def main():
+        async with Database() as database, database.sessionmaker() as session:
+            with pytest.raises(base.NotAvailableError, match='does not exist'):
+                await create_api_key(session, 'missing', 'key')
+            assert (await session.exec(select(tables.ApiKey))).all() == []
+
+    asyncio.run(main())
+
+
+def test_null_parent_and_date_are_equal_in_the_unique_index():
+
+    async def main():
+        async with Database() as database, database.sessionmaker() as session:
+            user = await create_user(session)
+            root = await create_gallery(session, user.id, 'name')
+
+            # root and undated galleries collide too
+            with pytest.raises(base.NotAvailableError):
+                await create_gallery(session, user.id, 'name')
+            dated = await create_gallery(session, user.id, 'name', date=datetime_module.date(2024, 1, 1))
+            with pytest.raises(base.NotAvailableError):
+                await create_gallery(session, user.id, 'name', date=datetime_module.date(2024, 1, 1))
+
+            # a different parent or date is another name
+            await create_gallery(session, user.id, 'name', root.id)
+            await create_gallery(session, user.id, 'name', dated.id)
+            await create_gallery(session, user.id, 'name', date=datetime_module.date(2024, 1, 2))
+            with pytest.raises(base.NotAvailableError):
+                await create_gallery(session, user.id, 'name', root.id)
+
+    asyncio.run(main())
+
+
+def test_failed_insert_in_unit_of_work_rolls_back_only_its_savepoint():
+
+    async def main():
+        async with Database() as database:
+            async with database.sessionmaker() as session:
+                user = await create_user(session)
+
+                async with base.unit_of_work(session):
+                    before = await create_gallery(session, user.id, 'before')
+                    with pytest.raises(base.NotAvailableError):
+                        await create_gallery(session, user.id, 'before')
+                    after = await create_gallery(session, user.id, 'after')
+
+            async with database.sessionmaker() as session:
+                assert set((await session.exec(select(tables.Gallery.id))).all()) == {before.id, after.id}
+
+    asyncio.run(main())
+
+
+def test_conflicts_are_409(database, client):
+
+    async def setup():
+        async with database.sessionmaker() as session:
+            user = await create_user(session)
+            root = await create_gallery(session, user.id, 'root')
+            await create_gallery(session, user.id, 'gallery', root.id)
+            await create_api_key(session, user.id, 'key')
+            return await bearer(session, user), root.id
+
+    headers, root_id = asyncio.run(setup())
+
+    response = client.post('/galleries/', headers=headers, json={
+        'name': 'gallery', 'parent_id': root_id, 'visibility_level': config.VISIBILITY_LEVEL_NAME_MAPPING['public']})
+    assert response.status_code == 409, response.text
+    response = client.post('/api-keys/', headers=headers, json={
+        'name': 'key', 'expiry': (datetime_module.datetime.now(datetime_module.UTC) + datetime_module.timedelta(days=1)).isoformat()})
+    assert response.status_code == 409, response.text
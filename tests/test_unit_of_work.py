@@ -0,0 +1,87 @@
+import asyncio
+
+import pytest
+from sqlmodel import select
+
+from arbor_imago.auth import utils as auth_utils
+from arbor_imago.models import tables
+from arbor_imago.services.models import base
+
+from .database import Database, create_user, create_gallery
+
+
+def count_commits(session) -> list[None]:
+    """One entry per commit of the session's transaction"""
+
+    commits = []
+    commit = session.commit
+
+    async def counting_commit():
+        commits.append(None)
+        await commit()
+
+    session.commit = counting_commit
+    return commits
+
+
+def test_exception_rolls_the_whole_block_back():
+
+    async def main():
+        async with Database() as database:
+            async with database.sessionmaker() as session:
+                with pytest.raises(RuntimeError):
+                    async with base.unit_of_work(session):
+                        user = await create_user(session)
+                        await create_gallery(session, user.id, 'gallery')
+                        raise RuntimeError
+                assert not base.in_unit_of_work(session)
+
+            async with database.sessionmaker() as session:
+                assert (await session.exec(select(tables.User))).all() == []
+                assert (await session.exec(select(tables.Gallery))).all() == []
+
+    asyncio.run(main())
+
+
+def test_nested_blocks_join_the_outer_one():
+
+    async def main():
+        async with Database() as database:
+            async with database.sessionmaker() as session:
+                commits = count_commits(session)
+                with pytest.raises(RuntimeError):
+                    async with base.unit_of_work(session):
+                        user = await create_user(session)
+                        async with base.unit_of_work(session):
+                            await create_gallery(session, user.id, 'gallery')
+                        # the inner block left the commit to the outer one
+                        assert commits == []
+                        assert base.in_unit_of_work(session)
+                        raise RuntimeError
+
+            async with database.sessionmaker() as session:
+                assert (await session.exec(select(tables.User))).all() == []
+
+    asyncio.run(main())
+
+
+def test_one_commit_per_flow():
+
+    async def main():
+        async with Database() as database, database.sessionmaker() as session:
+            user = await create_user(session)
+
+            commits = count_commits(session)
+            async with base.unit_of_work(session):
+                root = await create_gallery(session, user.id, 'root')
+                for name in ('a', 'b', 'c'):
+                    await create_gallery(session, user.id, name, root.id)
+            assert len(commits) == 1
+
+            # the second OTP replaces the first, its delete and create commit together
+            for expected in (2, 3):
+                await auth_utils.create_otp(session, user)
+                assert len(commits) == expected
+            assert len((await session.exec(select(tables.OTP).where(tables.OTP.user_id == user.id))).all()) == 1
+
+    asyncio.run(main())
@@ -0,0 +1,60 @@
+import asyncio
+
+from arbor_imago.schemas import gallery as gallery_schema
+from arbor_imago.services.models.gallery import Gallery as GalleryService
+
+from .database import ADMIN, Database, create_user, create_gallery
+
+
+def after_write(database) -> list[str]:
+    """The selects run once the write's savepoint was released, when it commits"""
+
+    statements = database.statements
+    return [statement for statement in statements[len(statements) - statements[::-1].index('RELEASE SAVEPOINT sa_savepoint_1'):]
+            if statement.startswith('SELECT')]
+
+
+def test_writes_are_not_followed_by_a_select():
+
+    async def main():
+        async with Database() as database, database.sessionmaker() as session:
+            user = await create_user(session)
+            root = await create_gallery(session, user.id, 'root')
+
+            database.statements.clear()
+            gallery = await create_gallery(session, user.id, 'gallery', root.id)
+            assert after_write(database) == []
+            assert gallery.parent_id == root.id and gallery.description is None
+
+            database.statements.clear()
+            await GalleryService.create_many({'session': session, **ADMIN, 'create_models': [gallery_schema.GalleryAdminCreate(
+                user_id=user.id, name=str(i), parent_id=root.id, visibility_level=1) for i in range(3)]})
+            assert after_write(database) == []
+            assert len([statement for statement in database.statements if statement.startswith('INSERT INTO gallery ')]) == 1
+
+            database.statements.clear()
+            await GalleryService.update({'session': session, **ADMIN, 'id': gallery.id,
+                                         'update_model': gallery_schema.GalleryAdminUpdate(description='edited')})
+            assert after_write(database) == []
+
+    asyncio.run(main())
+
+
+def test_unloaded_columns_are_reloaded_with_one_select():
+
+    async def main():
+        async with Database() as database, database.sessionmaker() as session:
+            user = await create_user(session)
+            galleries = [await create_gallery(session, user.id, str(i)) for i in range(3)]
+            for gallery in galleries:
+                session.expire(gallery, ['description'])
+
+            database.statements.clear()
+            await GalleryService._load_unloaded(session, *galleries)
+
+            selects = [statement for statement in database.statements if statement.startswith('SELECT')]
+            assert len(selects) == 1
+            assert ' IN (' in selects[0]
+            assert [gallery.description for gallery in galleries] == [None] * 3
+
+    asyncio.run(main())